@@ -86,14 +86,10 @@ def create_app(config_class=None):
         if response.content_type == 'application/json':
             try:
                 data = response.get_json()
-                if isinstance(data, dict):
-                    unwanted_keys = [
-                        'context', 'total_duration', 
-                        'prompt_eval_duration', 'eval_count', 
-                        'eval_duration'
-                    ]
-                    for key in unwanted_keys:
-                        data.pop(key, None)
+                # Ollama timing stats are recorded as metrics (/metrics) by LLMProcessor;
+                # only the raw token context is dropped here
+                if isinstance(data, dict) and 'context' in data:
+                    data.pop('context', None)
                     response.data = jsonify(data).data
             except Exception as e:
                 logger.error(f"Error during response cleaning: {str(e)}")
@@ -109,5 +105,11 @@ def create_app(config_class=None):
         except Exception as e:
             logger.error(f"❌ Error during database migration: {str(e)}")
     
+    # Load the LLM in the background so the first request does not pay the model load time
+    from app.core.llm_processor import load_config
+    if load_config().get("LLM_WARMUP_ON_STARTUP", True):
+        from app.core.warmup import start_model_warmup
+        start_model_warmup()
+
     logger.info("✅ MedMatchINT Application Initialized Successfully")
     return app
@@ -1,25 +1,37 @@
 import os
 import json
 import logging
+import queue
+import threading
+import time
+import uuid
+import contextvars
 import subprocess
-from flask import Blueprint, request, jsonify, render_template, current_app, send_from_directory
+from flask import Blueprint, Response, request, jsonify, render_template, current_app, send_from_directory, stream_with_context, g
 from werkzeug.utils import secure_filename
 from app.api import bp
 from app.utils import (
-    extract_text_from_pdf,
     clean_expired_files,
     get_all_trials
 )
-from app.core.feature_extraction import highlight_sources, extract_features_with_llm, match_trials_llm
-from app.core.llm_processor import get_llm_processor
-from app import logger 
-from app.core.feature_extraction import extract_features_with_llm, extract_text_from_pdf
+from app.core.feature_extraction import feature_highlights, extract_features_with_llm, match_trials_llm
+from app.core.llm_processor import get_llm_processor, get_llm_stats
+from app.core.llm_cache import bypass_llm_cache
+from app.core.debug_artifacts import request_scope
+from app.core.metrics import render_metrics, scheduler_gauges
+from app.core.warmup import readiness
+from app.core.scheduler import BusyError, INTERACTIVE, STANDARD, PRIORITY_CLASSES, llm_priority
+from app.core.pdf_extraction import extract_text_from_pdf
 from app.core.medication_extraction import extract_medications_from_pdf
 from app.core.timeline_extraction import extract_timeline_from_pdf
+from app.core.combined_extraction import extract_all
 
 
 bp = Blueprint('api', __name__)
 logger = logging.getLogger(__name__)
+
+# Emit a progress event every N generated tokens while streaming feature extraction
+STREAM_PROGRESS_EVERY = 32
        
  
 @bp.route('/')
@@ -44,6 +56,13 @@ def update_settings():
     if request.method == 'POST':
         data = request.json
         try:
+            # Merge so that keys not shown in the settings page are preserved
+            settings = {}
+            if os.path.exists("config.json"):
+                with open("config.json", "r") as f:
+                    settings = json.load(f)
+            settings.update(data)
+            data = settings
             with open("config.json", "w") as f:
                 json.dump(data, f, indent=4)
             logger.info("✅ Settings updated")
@@ -74,66 +93,256 @@ def get_models():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@bp.route('/process', methods=['POST'])
-def process():
+@bp.route('/api/llm/stats')
+def llm_stats():
     try:
-        upload_dir = current_app.config.get('UPLOAD_FOLDER', 'uploads')
-        os.makedirs(upload_dir, exist_ok=True)
-
-        file = request.files.get('file')
-        raw_text = request.form.get('text', '').strip()
-        text = ''
-        pdf_filename = None
-
-        if file and file.filename.endswith('.pdf'):
-            pdf_filename = secure_filename(file.filename)
-            upload_path = os.path.join(upload_dir, pdf_filename)
-            file.save(upload_path)
-
-            with open(upload_path, 'rb') as f:
-                text = extract_text_from_pdf(f)
-
-            logger.info(f"📄 PDF '{pdf_filename}' uploaded and text extracted ({len(text)} chars)")
-
-        elif raw_text:
-            text = raw_text
-            logger.info(f"📝 Raw text received ({len(text)} chars)")
-
-        else:
-            logger.warning("❌ No input provided")
-            return jsonify({'error': 'Please upload a PDF or enter clinical text.'}), 400
+        return jsonify(get_llm_stats()), 200
+    except Exception as e:
+        logger.error(f"❌ Failed to retrieve LLM stats: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
 
-        if not text:
-            logger.warning("❌ Extracted text is empty")
-            return jsonify({'error': 'Extracted text is empty.'}), 400
+@bp.route('/ready')
+def ready():
+    """Readiness per il load balancer: 200 solo se il modello è caricato e caldo."""
+    try:
+        status = readiness()
+    except Exception as e:
+        logger.error(f"❌ Readiness check failed: {e}")
+        return jsonify({'ready': False, 'error': str(e)}), 503
+    return jsonify(status), 200 if status['ready'] else 503
 
-        logger.info("🤖 Calling LLM for feature extraction...")
-        llm_text = extract_features_with_llm(text)
+@bp.route('/metrics')
+def metrics():
+    """Metriche LLM in formato Prometheus (per processo/worker)."""
+    try:
+        text = render_metrics(scheduler_gauges(get_llm_processor().scheduler.stats()))
+    except Exception as e:
+        logger.error(f"❌ Failed to render metrics: {e}")
+        text = render_metrics()
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+def wants_cache_bypass() -> bool:
+    """Bypass della cache LLM richiesto con ?no_cache=1, campo form no_cache o header X-LLM-Cache: bypass."""
+    flag = request.args.get('no_cache') or request.form.get('no_cache') or ''
+    return flag.lower() in ('1', 'true', 'yes') or request.headers.get('X-LLM-Cache', '').lower() == 'bypass'
+
+def request_priority(default: str) -> str:
+    """
+    Classe di priorità LLM della richiesta: quella della route, che il client può
+    solo abbassare (header X-LLM-Priority o ?priority=, es. "batch" per i re-screening).
+    """
+    requested = (request.headers.get('X-LLM-Priority') or request.args.get('priority') or '').lower()
+    if requested in PRIORITY_CLASSES and PRIORITY_CLASSES.index(requested) > PRIORITY_CLASSES.index(default):
+        return requested
+    return default
+
+def busy_response(error: BusyError):
+    logger.warning(f"🚦 {error}")
+    response = jsonify({'error': 'The LLM service is busy, please retry shortly.', 'busy': True})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def read_process_input():
+    """
+    Legge il PDF caricato o il testo incollato della richiesta corrente.
+    Restituisce (testo, nome del PDF, risposta di errore o None).
+    """
+    upload_dir = current_app.config.get('UPLOAD_FOLDER', 'uploads')
+    os.makedirs(upload_dir, exist_ok=True)
+
+    file = request.files.get('file')
+    raw_text = request.form.get('text', '').strip()
+    text = ''
+    pdf_filename = None
+
+    if file and file.filename.endswith('.pdf'):
+        pdf_filename = secure_filename(file.filename)
+        upload_path = os.path.join(upload_dir, pdf_filename)
+        file.save(upload_path)
+
+        # By path: the extraction workers open the file themselves instead of receiving its bytes
+        text = extract_text_from_pdf(upload_path)
+
+        logger.info(f"📄 PDF '{pdf_filename}' uploaded and text extracted ({len(text)} chars)")
+
+    elif raw_text:
+        text = raw_text
+        logger.info(f"📝 Raw text received ({len(text)} chars)")
+
+    else:
+        logger.warning("❌ No input provided")
+        return text, pdf_filename, (jsonify({'error': 'Please upload a PDF or enter clinical text.'}), 400)
+
+    if not text:
+        logger.warning("❌ Extracted text is empty")
+        return text, pdf_filename, (jsonify({'error': 'Extracted text is empty.'}), 400)
+
+    return text, pdf_filename, None
+
+def request_id() -> str:
+    """ID della richiesta (header X-Request-ID o generato): nomina gli artefatti di debug."""
+    if 'request_id' not in g:
+        supplied = request.headers.get('X-Request-ID', '').strip()
+        g.request_id = supplied[:64] if supplied else uuid.uuid4().hex[:16]
+    return g.request_id
+
+@bp.after_request
+def add_request_id(response):
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
 
-        if not isinstance(llm_text, dict) or not llm_text:
-            logger.error("❌ Invalid or empty response from LLM")
-            return jsonify({'error': 'LLM returned an invalid or empty response.'}), 500
-        
-        logger.info(f"✅ Extracted Features: {json.dumps(llm_text, indent=2)}")
-    
-        logger.info("🤖 Calling LLM for trial matching (Batched)...")
-        logger.debug(f"🔍 DEBUG: Calling match_trials_llm with features: {json.dumps(llm_text, indent=2)}")
+@bp.route('/process', methods=['POST'])
+def process():
+    try:
+        text, pdf_filename, error = read_process_input()
+        if error:
+            return error
+
+        with bypass_llm_cache(wants_cache_bypass()), llm_priority(request_priority(INTERACTIVE)), \
+                request_scope(request_id()):
+            logger.info("🤖 Calling LLM for feature extraction...")
+            llm_text = extract_features_with_llm(text)
+
+            if not isinstance(llm_text, dict) or not llm_text:
+                logger.error("❌ Invalid or empty response from LLM")
+                return jsonify({'error': 'LLM returned an invalid or empty response.'}), 500
+            
+            logger.info(f"✅ Extracted Features: {json.dumps(llm_text, indent=2)}")
         
-        matched_trials = match_trials_llm(llm_text)
-        logger.info(f"✅ Matched Trials: {len(matched_trials)} trials found.")
+            logger.info("🤖 Calling LLM for trial matching (Batched)...")
+            logger.debug(f"🔍 DEBUG: Calling match_trials_llm with features: {json.dumps(llm_text, indent=2)}")
+            
+            matched_trials = match_trials_llm(llm_text)
+            logger.info(f"✅ Matched Trials: {len(matched_trials)} trials found.")
         
         return jsonify({
             'features': llm_text,
             'text': text,
+            'highlights': feature_highlights(text, llm_text),
             'pdf_filename': pdf_filename,
             'matched_trials': matched_trials
         })
 
+    except BusyError as e:
+        return busy_response(e)
     except Exception as e:
         logger.exception("❌ Unhandled exception in /process")
         return jsonify({'error': str(e)}), 500
 
 
+@bp.route('/process_all', methods=['POST'])
+def process_all():
+    """
+    Estrazione combinata: il PDF viene letto una sola volta; farmaci e timeline usano
+    prompt che condividono il testo del documento, le feature lo stesso percorso di /process.
+    """
+    try:
+        text, pdf_filename, error = read_process_input()
+        if error:
+            return error
+
+        with bypass_llm_cache(wants_cache_bypass()), llm_priority(request_priority(INTERACTIVE)), \
+                request_scope(request_id()):
+            logger.info("🤖 Calling LLM for combined extraction (features, medications, timeline)...")
+            results = extract_all(text)
+
+        return jsonify({
+            'features': results['features'],
+            'medications': results['medications'],
+            'timeline': results['timeline'],
+            'timings': results['timings'],
+            'text': text,
+            'highlights': feature_highlights(text, results['features']),
+            'pdf_filename': pdf_filename
+        })
+
+    except BusyError as e:
+        return busy_response(e)
+    except Exception as e:
+        logger.exception("❌ Unhandled exception in /process_all")
+        return jsonify({'error': str(e)}), 500
+
+
+@bp.route('/process_stream', methods=['POST'])
+def process_stream():
+    """
+    Variante in streaming di /process (NDJSON, un evento JSON per riga):
+    document → progress* → features → [screened] → trials (uno per batch, appena pronto) → done.
+    In caso di errore viene emesso un evento "error" e lo stream termina.
+    """
+    try:
+        text, pdf_filename, error = read_process_input()
+        if error:
+            return error
+    except Exception as e:
+        logger.exception("❌ Unhandled exception in /process_stream")
+        return jsonify({'error': str(e)}), 500
+
+    events = queue.Queue()
+    started = time.perf_counter()
+
+    def emit(event, **data):
+        data['event'] = event
+        data['elapsed'] = round(time.perf_counter() - started, 3)
+        events.put(data)
+
+    def run_pipeline():
+        try:
+            tokens = {'count': 0}
+
+            def on_token(fragment):
+                tokens['count'] += 1
+                if tokens['count'] == 1 or tokens['count'] % STREAM_PROGRESS_EVERY == 0:
+                    emit('progress', stage='features', tokens=tokens['count'])
+
+            logger.info("🤖 Calling LLM for feature extraction (streaming)...")
+            llm_text = extract_features_with_llm(text, on_token=on_token)
+            if not isinstance(llm_text, dict) or not llm_text:
+                logger.error("❌ Invalid or empty response from LLM")
+                emit('error', error='LLM returned an invalid or empty response.')
+                return
+            emit('features', features=llm_text, highlights=feature_highlights(text, llm_text))
+
+            def on_batch(batch_index, total_batches, verdicts):
+                emit('trials', batch=batch_index + 1, total_batches=total_batches, verdicts=verdicts)
+
+            def on_screened(verdicts, escalated):
+                emit('screened', verdicts=verdicts, escalated=escalated)
+
+            logger.info("🤖 Calling LLM for trial matching (streaming)...")
+            matched_trials = match_trials_llm(llm_text, on_batch=on_batch, on_screened=on_screened)
+            logger.info(f"✅ Matched Trials: {len(matched_trials)} trials found.")
+            emit('done', matched_trials=matched_trials)
+        except BusyError as e:
+            logger.warning(f"🚦 {e}")
+            emit('error', error='The LLM service is busy, please retry shortly.', busy=True)
+        except Exception as e:
+            logger.exception("❌ Unhandled exception in /process_stream pipeline")
+            emit('error', error=str(e))
+        finally:
+            events.put(None)
+
+    with bypass_llm_cache(wants_cache_bypass()), llm_priority(request_priority(INTERACTIVE)), \
+            request_scope(request_id()):
+        pipeline_context = contextvars.copy_context()
+    threading.Thread(target=pipeline_context.run, args=(run_pipeline,), name="process-stream", daemon=True).start()
+
+    def generate():
+        yield json.dumps({'event': 'document', 'text': text, 'pdf_filename': pdf_filename}) + "\n"
+        while True:
+            event = events.get()
+            if event is None:
+                break
+            yield json.dumps(event) + "\n"
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # disable proxy buffering (nginx)
+    return response
+
+
 @bp.route('/api/trials', methods=['GET'])
 def get_trials():
     try:
@@ -197,12 +406,15 @@ def handle_feature_extraction(extract_func, label):
             pdf_filename = secure_filename(file.filename)
             path = os.path.join(upload_dir, pdf_filename)
             file.save(path)
-            with open(path, 'rb') as f:
+            with open(path, 'rb') as f, bypass_llm_cache(wants_cache_bypass()), \
+                    llm_priority(request_priority(STANDARD)), request_scope(request_id()):
                 features = extract_func(f)
             logger.info(f"📄 Processed {label} PDF: {pdf_filename}")
 
         elif raw_text:
-            features = extract_func(raw_text)
+            with bypass_llm_cache(wants_cache_bypass()), llm_priority(request_priority(STANDARD)), \
+                    request_scope(request_id()):
+                features = extract_func(raw_text)
             logger.info(f"📝 Processed {label} raw text ({len(raw_text)} chars)")
 
         else:
@@ -213,6 +425,8 @@ def handle_feature_extraction(extract_func, label):
             'pdf_filename': pdf_filename
         })
 
+    except BusyError as e:
+        return busy_response(e)
     except Exception as e:
         logger.exception(f"❌ Error processing {label}")
         return jsonify({'error': str(e)}), 500
\ No newline at end of file
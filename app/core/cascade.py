@@ -0,0 +1,115 @@
+import math
+import logging
+import threading
+from typing import Dict, Any, List, Set, Tuple
+
+from app.core.metrics import cascade_trials
+
+logger = logging.getLogger(__name__)
+
+# Stage (and LLM_STAGE_PROFILES key) of the small screening model
+SCREEN_STAGE = "matching_screen"
+
+
+def cascade_settings(config: dict) -> Dict[str, Any]:
+    """
+    Parametri della cascata di matching da config.json:
+    TRIAL_MATCHING_CASCADE_ENABLED, TRIAL_MATCHING_CASCADE_BAND ([min, max] dei punteggi
+    incerti, estremi inclusi) e TRIAL_MATCHING_CASCADE_MAX_ESCALATION_RATE (quota massima
+    di trial rivalutati per le sole incertezze; null = nessun limite).
+    """
+    low, high = config.get("TRIAL_MATCHING_CASCADE_BAND", [25, 75])
+    max_rate = config.get("TRIAL_MATCHING_CASCADE_MAX_ESCALATION_RATE")
+    return {
+        "enabled": bool(config.get("TRIAL_MATCHING_CASCADE_ENABLED", False)),
+        "band": (float(low), float(high)),
+        "max_escalation_rate": float(max_rate) if max_rate is not None else None,
+    }
+
+
+def _score(verdict: Dict[str, Any]):
+    score = verdict.get("match_score")
+    if isinstance(score, bool) or not isinstance(score, (int, float)) or not 0 <= score <= 100:
+        return None
+    return score
+
+
+def select_escalations(verdicts: List[Dict[str, Any]], band: Tuple[float, float],
+                       max_rate: float = None) -> Tuple[Set[str], Dict[str, str]]:
+    """
+    Sceglie i verdetti del modello piccolo da far rivalutare al modello grande:
+    sempre quelli malformati (non valutati o senza punteggio valido), poi quelli con
+    punteggio nella banda incerta. Con `max_rate` le incertezze sono limitate a
+    ceil(max_rate * n), partendo da quelle più vicine al centro della banda.
+    Restituisce (trial_id da rivalutare, motivo per trial_id).
+    """
+    low, high = band
+    middle = (low + high) / 2
+    reasons = {}
+    uncertain = []
+    for verdict in verdicts:
+        trial_id = str(verdict.get("trial_id"))
+        score = _score(verdict)
+        if verdict.get("evaluated") is False or score is None:
+            reasons[trial_id] = "malformed"
+        elif low <= score <= high:
+            uncertain.append((abs(score - middle), trial_id))
+
+    uncertain.sort()
+    if max_rate is not None:
+        budget = math.ceil(max_rate * len(verdicts))
+        if len(uncertain) > budget:
+            logger.info(f"🎚️ Cascade: {len(uncertain)} uncertain verdicts, escalating the {budget} "
+                        f"closest to the band centre (max rate {max_rate:.0%})")
+        uncertain = uncertain[:budget]
+    for _, trial_id in uncertain:
+        reasons[trial_id] = "uncertain"
+    return set(reasons), reasons
+
+
+class CascadeStats:
+    """Contatori della cascata: trial valutati dal modello piccolo e quanti sono stati rivalutati."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {
+            "patients": 0,
+            "trials_screened": 0,
+            "escalated_uncertain": 0,
+            "escalated_malformed": 0,
+            "screen_gpu_seconds": 0.0,
+            "full_gpu_seconds": 0.0,
+        }
+
+    def record(self, screened: int, reasons: Dict[str, str], screen_seconds: float, full_seconds: float):
+        uncertain = sum(1 for reason in reasons.values() if reason == "uncertain")
+        malformed = len(reasons) - uncertain
+        with self._lock:
+            self.counters["patients"] += 1
+            self.counters["trials_screened"] += screened
+            self.counters["escalated_uncertain"] += uncertain
+            self.counters["escalated_malformed"] += malformed
+            self.counters["screen_gpu_seconds"] += screen_seconds
+            self.counters["full_gpu_seconds"] += full_seconds
+        cascade_trials.inc(screened - len(reasons), outcome="accepted")
+        cascade_trials.inc(uncertain, outcome="escalated_uncertain")
+        cascade_trials.inc(malformed, outcome="escalated_malformed")
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.counters)
+        escalated = stats["escalated_uncertain"] + stats["escalated_malformed"]
+        stats["escalation_rate"] = round(escalated / stats["trials_screened"], 4) if stats["trials_screened"] else 0.0
+        stats["gpu_seconds_per_patient"] = round(
+            (stats["screen_gpu_seconds"] + stats["full_gpu_seconds"]) / stats["patients"], 3
+        ) if stats["patients"] else 0.0
+        stats["screen_gpu_seconds"] = round(stats["screen_gpu_seconds"], 3)
+        stats["full_gpu_seconds"] = round(stats["full_gpu_seconds"], 3)
+        return stats
+
+
+_cascade_stats = CascadeStats()
+
+
+def get_cascade_stats() -> CascadeStats:
+    return _cascade_stats
@@ -0,0 +1,68 @@
+import time
+import logging
+from typing import Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+
+from app.core.llm_processor import submit_with_context
+from app.core.feature_extraction import extract_features_with_llm, get_matching_concurrency
+from app.core.medication_extraction import MEDICATION_EXTRACTION_PROMPT, extract_medications
+from app.core.timeline_extraction import TIMELINE_EXTRACTION_PROMPT, extract_timeline
+from app.core.drug_normalization import annotate_drug_names
+
+logger = logging.getLogger(__name__)
+
+DOCUMENT_HEADER = "CLINICAL DOCUMENT:\n"
+TASK_HEADER = "\n### TASK\n"
+
+
+def build_shared_prompt(text: str, instructions: str) -> str:
+    """
+    Prompt con il documento all'inizio e le istruzioni del singolo task in fondo:
+    le tre richieste condividono lo stesso prefisso, quindi Ollama valuta il testo
+    del paziente una volta sola e riusa la KV cache per le altre.
+    """
+    return f"{DOCUMENT_HEADER}{annotate_drug_names(text)}\n{TASK_HEADER}{instructions.strip()}\n"
+
+
+def extract_all(text: str) -> Dict[str, Any]:
+    """
+    Estrazione combinata di feature, farmaci e timeline dallo stesso testo.
+    Le feature seguono lo stesso percorso di /process (cache per documento,
+    pre-estrazione, chunking, normalizzazione e riparazione), così i risultati non
+    cambiano tra i due endpoint. Farmaci e timeline condividono il prefisso del
+    documento: la prima richiesta viene eseguita da sola per caricarlo nella KV cache,
+    le altre partono poi in parallelo (se OLLAMA_NUM_PARALLEL > 1).
+    """
+    tasks = {
+        "medications": lambda: extract_medications(
+            text, prompt=build_shared_prompt(text, MEDICATION_EXTRACTION_PROMPT)),
+        "timeline": lambda: extract_timeline(
+            text, prompt=build_shared_prompt(text, TIMELINE_EXTRACTION_PROMPT)),
+        "features": lambda: extract_features_with_llm(text),
+    }
+    timings = {}
+    results = {}
+
+    def run(name):
+        started = time.perf_counter()
+        try:
+            return tasks[name]()
+        finally:
+            timings[name] = round(time.perf_counter() - started, 3)
+
+    started = time.perf_counter()
+    names = list(tasks)
+    results[names[0]] = run(names[0])
+    concurrency = min(get_matching_concurrency(), len(names) - 1)
+    if concurrency <= 1:
+        for name in names[1:]:
+            results[name] = run(name)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="extract-all") as executor:
+            futures = {name: submit_with_context(executor, run, name) for name in names[1:]}
+            for name, future in futures.items():
+                results[name] = future.result()
+
+    timings["total"] = round(time.perf_counter() - started, 3)
+    logger.info(f"⏱️ Combined extraction in {timings['total']:.2f}s ({timings})")
+    return {**results, "timings": timings}
@@ -0,0 +1,248 @@
+import os
+import gzip
+import json
+import time
+import uuid
+import queue
+import random
+import logging
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Dict
+
+from app.core.storage_crypto import EncryptionUnavailable, encryption_settings, get_storage_cipher
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ARTIFACTS_DIR = "logs/debug"
+ARTIFACT_SUFFIX = ".json.gz"
+# With ENCRYPT_AT_REST: the gzip bytes encrypted with the storage key
+ENCRYPTED_SUFFIX = ".json.gz.enc"
+# Retention is enforced every N writes (and on startup), not on every file
+RETENTION_EVERY = 50
+
+# (request id, per-request sequence) set by request_scope() for the duration of a request
+_request = contextvars.ContextVar("debug_request", default=None)
+_process_sequence = itertools.count(1)
+
+
+@contextmanager
+def request_scope(request_id: str = None):
+    """
+    Associa un ID richiesta al blocco: gli artefatti di debug scritti dentro (anche dai
+    thread avviati con submit_with_context) si chiamano `{stage}_{id}_{seq}.json.gz`.
+    """
+    token = _request.set((request_id or uuid.uuid4().hex[:16], itertools.count(1)))
+    try:
+        yield _request.get()[0]
+    finally:
+        _request.reset(token)
+
+
+def current_request_id() -> str:
+    scope = _request.get()
+    return scope[0] if scope else None
+
+
+def _next_name(stage: str, suffix: str = ARTIFACT_SUFFIX) -> str:
+    scope = _request.get()
+    if scope:
+        request_id, sequence = scope[0], next(scope[1])
+    else:
+        # Outside a request (scripts, warmup): the pid keeps names unique across workers
+        request_id, sequence = f"pid{os.getpid()}", next(_process_sequence)
+    safe_id = "".join(c if c.isalnum() or c in "-." else "-" for c in request_id)[:64]
+    return f"{stage}_{safe_id}_{sequence:04d}{suffix}"
+
+
+class DebugArtifactWriter:
+    """
+    Scrive gli artefatti di debug (prompt/risposte LLM) da un thread in background.
+    submit() non blocca mai: se la coda è piena l'artefatto viene scartato e contato.
+    I file sono JSON compressi (gzip), cifrati se c'è un `cipher` (ENCRYPT_AT_REST),
+    e la cartella è tenuta entro `max_bytes` e `max_age_seconds`, eliminando prima i
+    file più vecchi.
+    """
+
+    def __init__(self, directory: str = DEFAULT_ARTIFACTS_DIR, queue_size: int = 256,
+                 max_bytes: int = 512 * 1024 * 1024, max_age_seconds: float = 7 * 86400,
+                 sampling: Dict[str, float] = None, cipher=None):
+        self.directory = directory
+        self.cipher = cipher
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.sampling = sampling or {"default": 1.0}
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._counts = {"written": 0, "dropped": 0, "sampled_out": 0, "failed": 0, "pruned": 0}
+        self._thread = None
+
+    def sample_rate(self, stage: str) -> float:
+        return float(self.sampling.get(stage, self.sampling.get("default", 1.0)))
+
+    def _count(self, key: str, amount: int = 1):
+        with self._lock:
+            self._counts[key] += amount
+
+    def submit(self, stage: str, data: Any) -> bool:
+        rate = self.sample_rate(stage)
+        if rate <= 0 or (rate < 1 and random.random() >= rate):
+            self._count("sampled_out")
+            return False
+        self._ensure_started()
+        try:
+            self.queue.put_nowait((_next_name(stage, ENCRYPTED_SUFFIX if self.cipher else ARTIFACT_SUFFIX), data))
+            return True
+        except queue.Full:
+            self._count("dropped")
+            return False
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="debug-artifacts", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.enforce_retention()
+        for written in itertools.count(1):
+            name, data = self.queue.get()
+            try:
+                self._write(name, data)
+                self._count("written")
+            except Exception as e:
+                self._count("failed")
+                logger.warning(f"⚠️ Failed to write debug artifact {name}: {e}")
+            finally:
+                self.queue.task_done()
+            if written % RETENTION_EVERY == 0:
+                self.enforce_retention()
+
+    def _write(self, name: str, data: Any):
+        # Serialization happens here, off the request thread
+        path = os.path.join(self.directory, name)
+        partial = path + ".part"
+        if self.cipher:
+            encoded = json.dumps(data, ensure_ascii=False, default=str).encode("utf-8")
+            with open(partial, "wb") as f:
+                f.write(self.cipher.encrypt(gzip.compress(encoded)))
+        else:
+            with gzip.open(partial, "wt", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, default=str)
+        os.replace(partial, path)
+        logger.debug(f"💾 Saved debug artifact {path}")
+
+    def enforce_retention(self):
+        try:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and entry.name.endswith((ARTIFACT_SUFFIX, ENCRYPTED_SUFFIX)):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except FileNotFoundError:
+            return
+        entries.sort()
+        cutoff = time.time() - self.max_age_seconds
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for mtime, size, path in entries:
+            if mtime >= cutoff and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+                total -= size
+            except OSError as e:
+                logger.warning(f"⚠️ Could not remove old debug artifact {path}: {e}")
+        if removed:
+            self._count("pruned", removed)
+            logger.info(f"🧹 Removed {removed} old debug artifact(s) from {self.directory}")
+
+    def flush(self):
+        """Attende che gli artefatti in coda siano scritti (script e test)."""
+        if self._thread is not None:
+            self.queue.join()
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self._counts)
+        return {**counts, "queued": self.queue.qsize(), "directory": self.directory, "sampling": self.sampling,
+                "encrypted": bool(self.cipher)}
+
+
+_writer = None
+_writer_settings = None
+_writer_lock = threading.Lock()
+
+
+def get_artifact_writer(config: dict = None):
+    """
+    Writer del processo, o None con DEBUG_ARTIFACTS_ENABLED=false (o con ENCRYPT_AT_REST
+    senza chiave: meglio nessun artefatto che prompt clinici in chiaro).
+    """
+    global _writer, _writer_settings
+    if config is None:
+        from app.core.llm_processor import get_config
+        config = get_config()
+    if not config.get("DEBUG_ARTIFACTS_ENABLED", True):
+        return None
+
+    settings = (
+        config.get("DEBUG_ARTIFACTS_DIR", DEFAULT_ARTIFACTS_DIR),
+        int(config.get("DEBUG_ARTIFACTS_QUEUE_SIZE", 256)),
+        int(float(config.get("DEBUG_ARTIFACTS_MAX_MB", 512)) * 1024 * 1024),
+        float(config.get("DEBUG_ARTIFACTS_MAX_AGE_HOURS", 168)) * 3600,
+        json.dumps(config.get("DEBUG_ARTIFACTS_SAMPLING", {"default": 1.0}), sort_keys=True),
+        encryption_settings(config),
+    )
+    with _writer_lock:
+        if settings != _writer_settings:
+            if _writer is not None:
+                # Keep what the old writer already accepted; its thread drains the queue
+                logger.info("🔧 Debug artifact settings changed, starting a new writer")
+            directory, queue_size, max_bytes, max_age, sampling, _ = settings
+            _writer_settings = settings
+            try:
+                _writer = DebugArtifactWriter(directory, queue_size, max_bytes, max_age, json.loads(sampling),
+                                              get_storage_cipher(config))
+            except EncryptionUnavailable as e:
+                logger.error(f"❌ Debug artifacts disabled, encryption requested but unavailable: {e}")
+                _writer = None
+        return _writer
+
+
+def write_debug_artifact(stage: str, data: Any, config: dict = None) -> bool:
+    """
+    Accoda un artefatto di debug per `stage` (features, medications, timeline, matching,
+    matched_trials). Non solleva eccezioni e non blocca: restituisce False se
+    l'artefatto è stato scartato (campionamento, coda piena o writer disattivato).
+    """
+    try:
+        writer = get_artifact_writer(config)
+        return writer.submit(stage, data) if writer else False
+    except Exception as e:
+        logger.warning(f"⚠️ Debug artifact for {stage} not queued: {e}")
+        return False
+
+
+def read_debug_artifact(path: str, config: dict = None) -> Any:
+    """Legge un artefatto (.json.gz, .json.gz.enc con la chiave di ENCRYPT_AT_REST, o .json)."""
+    if path.endswith(ENCRYPTED_SUFFIX):
+        if config is None:
+            from app.core.llm_processor import get_config
+            config = get_config()
+        cipher = get_storage_cipher({**config, "ENCRYPT_AT_REST": True})
+        with open(path, "rb") as f:
+            return json.loads(gzip.decompress(cipher.decrypt(f.read())).decode("utf-8"))
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def debug_artifact_stats(config: dict) -> dict:
+    writer = get_artifact_writer(config)
+    return writer.stats() if writer else {"enabled": False}
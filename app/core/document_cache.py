@@ -0,0 +1,160 @@
+import re
+import json
+import inspect
+import hashlib
+import logging
+import threading
+import unicodedata
+from functools import lru_cache
+from typing import Any, Callable, List
+
+from app.core.llm_cache import TieredCache, is_cache_bypassed
+from app.core.storage_crypto import EncryptionUnavailable, encryption_settings, get_storage_cipher
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DOCUMENT_CACHE_PATH = "cache/documents.sqlite"
+
+
+def normalize_text(text: str) -> str:
+    """
+    Forma canonica del testo estratto: Unicode NFKC, senza trattini morbidi e con
+    gli spazi compressi, così la stessa lettera riletta da PDF dà la stessa impronta.
+    """
+    text = unicodedata.normalize("NFKC", text or "").replace("\u00ad", "")
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def document_fingerprint(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+def prompt_version(*parts) -> str:
+    """Versione del prompt: hash di template, schema e modelli. Cambia se cambia uno di essi."""
+    encoded = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+@lru_cache(maxsize=None)
+def code_version(*objects) -> str:
+    """
+    Hash del sorgente di funzioni e moduli che producono un risultato (costruzione
+    del prompt, chunking, riparazione, ...): modificarli invalida le voci in cache
+    come modificare un template.
+    """
+    digest = hashlib.sha256()
+    for obj in objects:
+        try:
+            source = inspect.getsource(obj).encode("utf-8")
+        except (OSError, TypeError):
+            # No source on disk (bytecode-only install): fall back to the compiled code
+            code = getattr(obj, "__code__", None)
+            source = code.co_code if code is not None else repr(obj).encode("utf-8")
+        digest.update(source)
+    return digest.hexdigest()[:16]
+
+
+class DocumentCache:
+    """
+    Risultati strutturati (feature, farmaci, timeline) per impronta del documento,
+    stage e versione del prompt. Usa TieredCache per LRU, TTL, limite di dimensione
+    e cifratura su disco (ENCRYPT_AT_REST).
+    """
+
+    def __init__(self, store: TieredCache):
+        self.store = store
+
+    def get(self, key: str):
+        value = self.store.get(key)
+        if value is None:
+            return None
+        try:
+            return json.loads(value)
+        except ValueError as e:
+            # Corrupted entry: treat as a miss, it will be overwritten
+            logger.warning(f"⚠️ Unreadable document cache entry, ignoring it: {type(e).__name__}")
+            return None
+
+    def set(self, key: str, result: Any):
+        self.store.set(key, json.dumps(result, ensure_ascii=False))
+
+    def stats(self) -> dict:
+        return self.store.stats()
+
+
+_cache = None
+_cache_settings = None
+_cache_lock = threading.Lock()
+
+
+def get_document_cache(config: dict):
+    """
+    Cache dei risultati per documento del processo, o None se disattivata
+    (DOCUMENT_CACHE_ENABLED=false). Con ENCRYPT_AT_REST senza chiave (o senza
+    `cryptography`) la cache resta spenta piuttosto che salvare cartelle cliniche in chiaro.
+    """
+    global _cache, _cache_settings
+    if not config.get("DOCUMENT_CACHE_ENABLED", True):
+        return None
+
+    settings = (
+        config.get("DOCUMENT_CACHE_PATH", DEFAULT_DOCUMENT_CACHE_PATH) or None,
+        int(config.get("DOCUMENT_CACHE_MEMORY_ENTRIES", 128)),
+        int(config.get("DOCUMENT_CACHE_MAX_ENTRIES", 2000)),
+        float(config.get("DOCUMENT_CACHE_TTL_SECONDS", 604800)),
+        encryption_settings(config),
+    )
+    with _cache_lock:
+        if settings != _cache_settings:
+            path, memory_entries, disk_entries, ttl, _ = settings
+            _cache_settings = settings
+            try:
+                _cache = DocumentCache(TieredCache("Document", path, memory_entries, disk_entries, ttl,
+                                                   get_storage_cipher(config)))
+            except EncryptionUnavailable as e:
+                logger.error(f"❌ Document cache disabled, encryption requested but unavailable: {e}")
+                _cache = None
+        return _cache
+
+
+def model_signature(stage: str) -> List[Any]:
+    """Modelli, contesto e parametri di generazione usati per `stage`: parte della versione."""
+    from app.core.llm_processor import get_llm_processor
+    llm = get_llm_processor()
+    rules = llm.stage_profiles.get(stage) or [llm.resolve_profile(stage)]
+    return [rules, llm.temperature, llm.structured_output]
+
+
+def cached_document_result(stage: str, text: str, templates: List[Any], compute: Callable[[], Any],
+                           config: dict = None):
+    """
+    Restituisce il risultato di `stage` per il documento dalla cache, oppure lo calcola
+    con `compute()` e lo memorizza (solo se non vuoto). La chiave unisce impronta del
+    testo normalizzato, stage e versione (`templates`: template del prompt, schema,
+    code_version() del codice che lo costruisce e lo post-elabora, opzioni; più i
+    modelli), quindi modificare un prompt in app/core/*_extraction.py invalida le voci
+    esistenti.
+    """
+    if config is None:
+        from app.core.llm_processor import get_config
+        config = get_config()
+    cache = get_document_cache(config)
+    if cache is None or is_cache_bypassed():
+        return compute()
+
+    fingerprint = document_fingerprint(text)
+    key = f"{stage}:{prompt_version(templates, model_signature(stage))}:{fingerprint}"
+    cached = cache.get(key)
+    if cached is not None:
+        logger.info(f"📇 Document cache hit for {stage} (document {fingerprint[:12]})")
+        return cached
+
+    result = compute()
+    if result:
+        cache.set(key, result)
+    return result
+
+
+def document_cache_stats(config: dict) -> dict:
+    cache = get_document_cache(config)
+    return cache.stats() if cache else {"enabled": False}
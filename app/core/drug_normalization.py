@@ -0,0 +1,287 @@
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+import unicodedata
+from functools import lru_cache
+from typing import Dict, Any, List, Tuple, get_args
+
+from app.core.schema_validation import SystemicTherapy
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DICTIONARY_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "drug_dictionary.json")
+SYSTEMIC_THERAPIES = set(get_args(SystemicTherapy))
+NOT_MENTIONED = "not mentioned"
+
+# Dose/form words that end the drug name in "Omeprazolo 20 mg cpr", "Lasix 1 fl ev", ...
+_DOSE_WORDS = {"mg", "mcg", "g", "ml", "ui", "cpr", "cp", "compresse", "compressa", "fl", "fiale", "bustine",
+               "gtt", "gocce", "die", "ev", "os", "sc", "im", "x", "al", "giorno", "retard", "rp"}
+_END = ""  # terminal key in both tries (tokens and characters are never empty)
+_LENGTHS = "\0"  # character trie: (shortest, longest) alias below the node
+
+
+def fold(text: str) -> str:
+    """Minuscolo senza accenti: 'Tachipirìna' → 'tachipirina'."""
+    text = text.lower()
+    if text.isascii():
+        return text
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+
+def clean_name(text: str) -> str:
+    """Forma di confronto: minuscolo, senza accenti, punteggiatura come spazio."""
+    return " ".join(re.findall(r"\w+", fold(text)))
+
+
+def max_edits(term: str) -> int:
+    # Short names are only matched exactly: one edit already turns them into other drugs
+    return 0 if len(term) < 5 else 1 if len(term) < 9 else 2
+
+
+class DrugNormalizer:
+    """
+    Nomi di farmaci (generici italiani, brand, refusi) → INN inglese, da un dizionario
+    {INN: [alias]}. Un trie di token trova le menzioni esatte (anche su più parole)
+    in un solo passaggio sul testo; un trie di caratteri fa la ricerca con distanza di
+    edit limitata (Levenshtein, rami potati appena superano il limite) per i refusi.
+    """
+
+    def __init__(self, dictionary: Dict[str, List[str]]):
+        self.exact = {}
+        self.tokens = {}
+        self.chars = {}
+        for inn, aliases in dictionary.items():
+            if inn.startswith("_"):
+                continue
+            for alias in [inn, *aliases]:
+                key = clean_name(alias)
+                if not key:
+                    continue
+                if self.exact.get(key, inn) != inn:
+                    logger.warning(f"⚠️ Drug alias '{alias}' listed for both {self.exact[key]} and {inn}")
+                    continue
+                self.exact[key] = inn
+                node = self.tokens
+                for token in key.split():
+                    node = node.setdefault(token, {})
+                node[_END] = inn
+                node = self.chars
+                for char in key:
+                    node = node.setdefault(char, {})
+                    shortest, longest = node.get(_LENGTHS, (len(key), len(key)))
+                    node[_LENGTHS] = (min(shortest, len(key)), max(longest, len(key)))
+                node[_END] = inn
+        encoded = json.dumps(dictionary, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        self.version = hashlib.sha256(encoded).hexdigest()[:12]
+        self.lookup_all = lru_cache(maxsize=8192)(self._lookup_all)
+
+    def _walk(self, tokens: List[str], start: int) -> Tuple[int, str]:
+        """Menzione più lunga che inizia al token `start`: (token dopo la fine, INN)."""
+        node, end, inn = self.tokens, start, None
+        for index in range(start, len(tokens)):
+            node = node.get(tokens[index])
+            if node is None:
+                break
+            if _END in node:
+                end, inn = index + 1, node[_END]
+        return end, inn
+
+    def fuzzy(self, term: str, limit: int) -> List[Tuple[int, str]]:
+        """
+        Alias a distanza di edit <= `limit` da `term`: [(distanza, INN)]. La prima lettera
+        deve coincidere (i refusi raramente la toccano), quindi la ricerca parte dal suo
+        sottoalbero; per ogni nodo si calcola solo la banda |i - profondità| <= limit
+        della riga di Levenshtein, e si scartano i rami che superano il limite o che
+        contengono solo alias di lunghezza incompatibile.
+        """
+        found, root = [], self.chars.get(term[:1])
+        if root is None:
+            return found
+        size, beyond = len(term), limit + 1
+        # Row after the shared first letter
+        first = [1] + [index - 1 for index in range(1, size + 1)]
+        stack = [(child, char, first, 2) for char, child in root.items() if char not in (_END, _LENGTHS)]
+        while stack:
+            node, char, previous, depth = stack.pop()
+            row = [beyond] * (size + 1)
+            low, high = max(0, depth - limit), min(size, depth + limit)
+            if low == 0:
+                row[0] = depth
+            for index in range(max(1, low), high + 1):
+                row[index] = min(row[index - 1] + 1, previous[index] + 1,
+                                 previous[index - 1] + (term[index - 1] != char))
+            if row[size] <= limit and _END in node:
+                found.append((row[size], node[_END]))
+            if low <= high and min(row[low:high + 1]) <= limit:
+                # Only subtrees holding aliases of a compatible length
+                stack.extend((child, next_char, row, depth + 1)
+                             for next_char, child in node.items()
+                             if next_char not in (_END, _LENGTHS)
+                             and child[_LENGTHS][0] - limit <= size <= child[_LENGTHS][1] + limit)
+        return found
+
+    def _lookup_all(self, term: str) -> Tuple[str, ...]:
+        key = clean_name(term)
+        if not key:
+            return ()
+        if key in self.exact:
+            return (self.exact[key],)
+
+        # Known names inside a longer string: "Losaprex (losartan) 50 mg", "carboplatino + pemetrexed"
+        tokens, inns, index = key.split(), [], 0
+        while index < len(tokens):
+            end, inn = self._walk(tokens, index)
+            if inn and inn not in inns:
+                inns.append(inn)
+            index = max(end, index + 1)
+        if inns:
+            return tuple(inns)
+
+        # Misspelled name: edit distance on the words before the dose
+        head = []
+        for token in tokens:
+            if token in _DOSE_WORDS or any(c.isdigit() for c in token):
+                break
+            head.append(token)
+        for candidate in dict.fromkeys((" ".join(head[:3]), head[0] if head else "")):
+            if max_edits(candidate):
+                matches = self.fuzzy(candidate, max_edits(candidate))
+                if matches:
+                    best = min(distance for distance, _ in matches)
+                    closest = {inn for distance, inn in matches if distance == best}
+                    # Two different drugs equally close: better no answer than a wrong one
+                    return (closest.pop(),) if len(closest) == 1 else ()
+        return ()
+
+    def lookup(self, term: str):
+        """INN di `term`, o None se sconosciuto o ambiguo."""
+        inns = self.lookup_all(term) if isinstance(term, str) else ()
+        return inns[0] if len(inns) == 1 else None
+
+    def find_mentions(self, text: str) -> List[Tuple[int, int, str]]:
+        """Menzioni esatte di farmaci nel testo: [(inizio, fine, INN)] (le più lunghe vincono)."""
+        words = list(re.finditer(r"\w+", text))
+        tokens = [fold(word.group(0)) for word in words]
+        mentions, index = [], 0
+        while index < len(tokens):
+            if tokens[index] in self.tokens:
+                end, inn = self._walk(tokens, index)
+                if inn:
+                    mentions.append((words[index].start(), words[end - 1].end(), inn))
+                    index = end
+                    continue
+            index += 1
+        return mentions
+
+    def annotate(self, text: str) -> str:
+        """
+        Aggiunge l'INN dopo brand e nomi italiani ('Losaprex' → 'Losaprex [losartan]'),
+        salvo quando è già scritto subito dopo ('Losaprex (losartan)').
+        """
+        parts, position = [], 0
+        for start, end, inn in self.find_mentions(text):
+            if clean_name(text[start:end]) == clean_name(inn) or inn in fold(text[end:end + len(inn) + 40]):
+                continue
+            parts.extend((text[position:end], f" [{inn}]"))
+            position = end
+        parts.append(text[position:])
+        return "".join(parts)
+
+
+_normalizer = None
+_normalizer_path = None
+_normalizer_lock = threading.Lock()
+
+
+def get_drug_normalizer(config: dict = None):
+    """Normalizzatore del processo, o None con DRUG_NORMALIZATION_ENABLED=false."""
+    global _normalizer, _normalizer_path
+    if config is None:
+        from app.core.llm_processor import get_config
+        config = get_config()
+    if not config.get("DRUG_NORMALIZATION_ENABLED", True):
+        return None
+    path = config.get("DRUG_DICTIONARY_PATH") or DEFAULT_DICTIONARY_PATH
+    with _normalizer_lock:
+        if path != _normalizer_path:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    _normalizer = DrugNormalizer(json.load(f))
+                logger.info(f"💊 Drug dictionary loaded: {len(_normalizer.exact)} names ({path})")
+            except Exception as e:
+                logger.error(f"❌ Unable to load drug dictionary {path}: {e}")
+                _normalizer = None
+            _normalizer_path = path
+        return _normalizer
+
+
+def drug_normalization_version(config: dict = None):
+    """Parte della versione dei risultati in cache: dizionario e opzioni in uso."""
+    if config is None:
+        from app.core.llm_processor import get_config
+        config = get_config()
+    normalizer = get_drug_normalizer(config)
+    if normalizer is None:
+        return None
+    return [normalizer.version, bool(config.get("DRUG_NORMALIZATION_ANNOTATE", True))]
+
+
+def annotate_drug_names(text: str, config: dict = None) -> str:
+    """Testo per il prompt, con gli INN accanto ai nomi commerciali (DRUG_NORMALIZATION_ANNOTATE)."""
+    if config is None:
+        from app.core.llm_processor import get_config
+        config = get_config()
+    normalizer = get_drug_normalizer(config)
+    if normalizer is None or not text or not config.get("DRUG_NORMALIZATION_ANNOTATE", True):
+        return text
+    return normalizer.annotate(text)
+
+
+def _normalize_list(values, normalizer, systemic: bool):
+    normalized = []
+    for value in values:
+        if not isinstance(value, str) or value == NOT_MENTIONED or (systemic and value in SYSTEMIC_THERAPIES):
+            items = [value]
+        else:
+            inns = normalizer.lookup_all(value)
+            if systemic:
+                # The schema has a closed list of therapies: known drugs outside it become "other"
+                items = [inn if inn in SYSTEMIC_THERAPIES else "other" for inn in inns] or [value]
+            else:
+                items = list(inns) or [value]
+        normalized.extend(item for item in items if item not in normalized)
+    return normalized
+
+
+def normalize_feature_drugs(features: Dict[str, Any], config: dict = None) -> Dict[str, Any]:
+    """
+    Porta `prior_systemic_therapies` e `concomitant_treatments` agli INN inglesi
+    (le terapie fuori dallo schema diventano "other"). I valori sconosciuti restano
+    invariati e passano alla validazione/riparazione.
+    """
+    normalizer = get_drug_normalizer(config)
+    if normalizer is None or not isinstance(features, dict):
+        return features
+    features = dict(features)
+    for field, systemic in (("prior_systemic_therapies", True), ("concomitant_treatments", False)):
+        if isinstance(features.get(field), list):
+            features[field] = _normalize_list(features[field], normalizer, systemic)
+    return features
+
+
+def normalize_medications(medications: List[Dict[str, Any]], config: dict = None) -> List[Dict[str, Any]]:
+    """Sostituisce `medication` con l'INN; il nome come scritto nel testo resta in `name_in_text`."""
+    normalizer = get_drug_normalizer(config)
+    if normalizer is None:
+        return medications
+    normalized = []
+    for medication in medications:
+        name = medication.get("medication") if isinstance(medication, dict) else None
+        inn = normalizer.lookup(name) if isinstance(name, str) else None
+        if inn and clean_name(inn) != clean_name(name):
+            medication = {**medication, "medication": inn, "name_in_text": name}
+        normalized.append(medication)
+    return normalized
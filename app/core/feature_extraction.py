@@ -3,12 +3,26 @@ import time
 import re
 import json
 import logging
-import pdfplumber
 from typing import Dict, Any, Union, List
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from flask import current_app
-from app.core.llm_processor import get_llm_processor
-from app.core.schema_validation import ClinicalFeatures, ValidationError
+from app.core.llm_processor import get_config, get_llm_processor, submit_with_context
+from app.core.scheduler import BusyError
+from app.core.schema_validation import (
+    ClinicalFeatures, TrialVerdictBatch, ValidationError, ollama_format_schema, record_parse
+)
+from app.core.token_budget import estimate_tokens, pack_trials
+from app.core.cascade import SCREEN_STAGE, cascade_settings, get_cascade_stats, select_escalations
+from app.core.sections import plan_chunks, reduce_features
+from app.core.pre_extraction import FEATURE_FIELDS, PRE_EXTRACTION_VERSION, merge_features, pre_extract
+from app.core.document_cache import cached_document_result, code_version
+from app.core import drug_normalization, feature_repair, pre_extraction, schema_validation, sections
+from app.core.feature_repair import validate_and_repair
+from app.core.highlighting import collect_sources, find_source_spans, render_highlights
+from app.core.debug_artifacts import write_debug_artifact
+from app.core.pdf_extraction import extract_text_from_pdf
+from app.core.drug_normalization import annotate_drug_names, drug_normalization_version, normalize_feature_drugs
 from app.utils import get_all_trials
 
 from app import logger
@@ -16,69 +30,21 @@ from app import logger
 # Ensure the logs folder exists
 os.makedirs("logs", exist_ok=True)
  
-def extract_text_from_pdf(pdf_file: Union[str, bytes]) -> str:
-    try:
-        text = ""
-        with pdfplumber.open(pdf_file) as pdf:
-            for page in pdf.pages:
-                text += (page.extract_text() or "")
-        return text.strip()
-    except Exception as e:
-        logger.error(f"Error extracting text from PDF: {str(e)}")
-        raise Exception(f"Unable to extract text from PDF: {str(e)}")
-
-def extract_features_with_llm(text: str) -> Dict[str, Any]:
-    from app.core.llm_processor import get_llm_processor
-    llm = get_llm_processor()
-    # prompt = f"""
-    # You are a medical AI assistant. Extract clinical features from the clinical text below. For each field, return:
-    # - The extracted value
-    # - And the corresponding *_source_text used to infer it
-
-    # Return ONLY a valid JSON object with this structure:
-
-    # {{
-    # "age": integer or null,
-    # "age_source_text": string or null,
-    # "gender": "male" | "female" | "not mentioned",
-    # "gender_source_text": string or null,
-    # "diagnosis": string or null,
-    # "diagnosis_source_text": string or null,
-    # "stage": string or null,
-    # "stage_source_text": string or null,
-    # "ecog": string or null,
-    # "ecog_source_text": string or null,
-    # "mutations": list of strings,
-    # "mutations_source_text": list of strings,
-    # "metastases": list of strings,
-    # "metastases_source_text": list of strings,
-    # "previous_treatments": list of strings,
-    # "previous_treatments_source_text": list of strings,
-    # "lab_values": dict,
-    # "lab_values_source_text": dict
-    # }}
-
-    # TEXT:
-    # {text}
-
-    # JSON ONLY OUTPUT:
-    # """
-    prompt = f"""
+# Istruzioni statiche: restano in testa al prompt (prefisso identico tra le chiamate,
+# riutilizzabile dalla cache KV di Ollama); il testo del paziente va sempre in fondo.
+FEATURE_EXTRACTION_PROMPT = """
 Sei un modello NLP per l’assegnazione a studi clinici sul carcinoma polmonare.
 
-Data la seguente cartella clinica STRUTTURATA usando l’estrazione BASATA SU SEZIONI:
-
-Testo:
-{text}
+Ti viene fornita una cartella clinica STRUTTURATA; usa l’estrazione BASATA SU SEZIONI.
 
 Restituisci UNO e SOLO UNO oggetto JSON che rispetti ESATTAMENTE lo schema e le regole seguenti.
 - Output: SOLO l’oggetto JSON. Nessun testo prima/dopo. Nessun markdown. Nessun commento. Nessun code fence.
 - Se un valore non è ricavabile dal testo, scrivi esattamente "not mentioned" (per TUTTI i campi, inclusi i numerici).
 - Quando sono richieste liste, restituisci un array JSON. Se non è menzionato nulla, restituisci ["not mentioned"].
-- Normalizza i nomi in inglese quando possibile (es. carboplatino → carboplatin; linfonodali → lymph nodes).
+- Normalizza i nomi in inglese quando possibile (es. linfonodali → lymph nodes). I farmaci riportali come scritti nel testo.
 
 Schema (senza commenti inline):
-{{
+{
   "age": int | "not mentioned",
   "gender": "male" | "female" | "not mentioned",
   "ecog_ps": 0 | 1 | 2 | "not mentioned",
@@ -91,7 +57,7 @@ Schema (senza commenti inline):
   "prior_systemic_therapies": ["carboplatin" | "cisplatin" | "etoposide" | "pemetrexed" | "paclitaxel" | "docetaxel" | "pembrolizumab" | "nivolumab" | "atezolizumab" | "durvalumab" | "osimertinib" | "erlotinib" | "gefitinib" | "sotorasib" | "adagrasib" | "divarasib" | "savolitinib" | "alectinib" | "crizotinib" | "other"] | ["not mentioned"],
   "comorbidities": ["string"] | ["not mentioned"],
   "concomitant_treatments": ["string"] | ["not mentioned"],
-}}
+}
 
 Linee guida operative (commenti fuori dallo schema):
 - Per "line_of_therapy": se il testo dice "candidata a terapia sistemica di I linea" → line_of_therapy="1L".
@@ -110,27 +76,174 @@ Linee guida operative (commenti fuori dallo schema):
     • "il paziente risulta candidabile a trattamento chemio-immunoterapico di 1° linea a base di sali di platino + etoposide + atezolizumab." → "prior_systemic_therapies": ["not mentioned"]
 - Per "comorbidities": estrarre SOLO dalla sezione "COMORBIDITÀ".
 - Per "concomitant_treatments": estrarre SOLO dalla sezione "terapie domiciliari" (solo nomi, senza dosi/date).
-  Esempio: "Losaprex (losartan)... Omeprazolo..." → ["losartan","omeprazolo"]
+  Esempio: "Losaprex 50 mg 1 cp... Omeprazolo 20 mg..." → ["Losaprex","Omeprazolo"]
 - Per metastasi, preferire i reperti della TC/PET più recente.
 - Qualsiasi informazione assente → "not mentioned" (mai null).
 """
 
+def build_feature_prompt(text: str, fields: List[str] = None, partial: bool = False) -> str:
+    """
+    Prompt di estrazione. Con `fields` il modello restituisce solo quei campi (gli
+    altri sono già noti); `partial` indica che il testo è un chunk della cartella.
+    Le istruzioni restano identiche in testa, così il prefisso è riusato dalla KV cache.
+    """
+    scope = "Il testo è solo una parte della cartella. " if partial else ""
+    if fields:
+        scope += f"Restituisci SOLO i campi: {', '.join(fields)}.\n"
+    return f"{FEATURE_EXTRACTION_PROMPT}\n{scope}Testo:\n{annotate_drug_names(text)}\n"
+
+# Output riservato a ogni chiamata di estrazione (il JSON delle feature è breve)
+FEATURE_OUTPUT_TOKENS = 1024
+
+
+def feature_chunk_budget(llm, config: Dict[str, Any] = None) -> int:
+    """
+    Token di testo clinico che entrano in una sola richiesta di estrazione:
+    FEATURE_EXTRACTION_CHUNK_TOKENS se impostato, altrimenti il contesto del profilo
+    "features" (il più ampio, se ce ne sono più di uno) meno istruzioni e output.
+    """
+    config = config if config is not None else get_config()
+    configured = config.get("FEATURE_EXTRACTION_CHUNK_TOKENS")
+    if configured:
+        return int(configured)
+    context_size = llm.resolve_profile("features", prompt_tokens=float("inf"))["context_size"]
+    instructions = estimate_tokens(build_feature_prompt("", FEATURE_FIELDS, partial=True))
+    return max(context_size - instructions - FEATURE_OUTPUT_TOKENS, 512)
+
+
+def extract_features_chunked(text: str, budget: int, fields: List[str] = None) -> Dict[str, Any]:
+    """
+    Map-reduce per cartelle più lunghe del contesto: ogni gruppo di campi riceve solo
+    le sezioni pertinenti (vedi app.core.sections), i chunk vengono estratti in
+    parallelo e i JSON parziali uniti dal reducer deterministico. Con `fields` si
+    estraggono solo quei campi (i gruppi già risolti non generano richieste).
+    """
+    chunks = plan_chunks(text, budget)
+    if fields is not None:
+        for chunk in chunks:
+            chunk["fields"] = [field for field in chunk["fields"] if field in fields]
+        chunks = [chunk for chunk in chunks if chunk["fields"]]
+    started = time.perf_counter()
+
+    def run_chunk(chunk):
+        features = extract_features_with_llm(
+            chunk["text"], prompt=build_feature_prompt(chunk["text"], chunk["fields"], partial=True),
+            max_tokens=FEATURE_OUTPUT_TOKENS, fields=chunk["fields"],
+        )
+        return {"chunk": chunk, "features": features}
+
+    concurrency = min(get_matching_concurrency(), len(chunks)) or 1
+    if concurrency <= 1:
+        partials = [run_chunk(chunk) for chunk in chunks]
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="feature-chunk") as executor:
+            futures = [submit_with_context(executor, run_chunk, chunk) for chunk in chunks]
+            partials = [future.result() for future in futures]
+
+    partials = [partial for partial in partials if partial["features"]]
+    if not partials:
+        logger.error("❌ No chunk produced a valid feature object")
+        return {}
+    features = reduce_features(partials)
+    logger.info(f"🧩 Merged {len(partials)}/{len(chunks)} chunk extractions in "
+                f"{time.perf_counter() - started:.2f}s")
+    return features
+
+
+def extract_document_features(text: str, on_token=None, max_tokens: int = None,
+                              config: Dict[str, Any] = None) -> Dict[str, Any]:
+    """Feature dell'intero documento: campi deterministici in locale, il resto all'LLM."""
+    config = config if config is not None else get_config()
+    if not config.get("PRE_EXTRACTION_ENABLED", True):
+        return extract_features_with_llm(text, on_token=on_token, prompt=build_feature_prompt(text),
+                                         max_tokens=max_tokens)
+    local = pre_extract(text)
+    if not local["residual"]:
+        return merge_features({}, local["features"])
+    features = extract_features_with_llm(text, on_token=on_token, max_tokens=max_tokens,
+                                         fields=local["residual"])
+    return merge_features(features, local["features"]) if features else {}
+
+
+def extract_features_with_llm(text: str, on_token=None, prompt: str = None,
+                              max_tokens: int = None, fields: List[str] = None) -> Dict[str, Any]:
+    from app.core.llm_processor import get_llm_processor
+    config = get_config()
+    if prompt is None and fields is None:
+        # Whole document: document cache first, then pre-extraction + LLM
+        return cached_document_result(
+            "features", text,
+            [FEATURE_EXTRACTION_PROMPT, ollama_format_schema(ClinicalFeatures), PRE_EXTRACTION_VERSION,
+             config.get("PRE_EXTRACTION_ENABLED", True), drug_normalization_version(config),
+             config.get("FEATURE_EXTRACTION_CHUNKING", True), config.get("FEATURE_EXTRACTION_CHUNK_TOKENS"),
+             code_version(build_feature_prompt, feature_chunk_budget, extract_features_chunked,
+                          extract_document_features, extract_features_with_llm, sections, pre_extraction,
+                          feature_repair, schema_validation, drug_normalization)],
+            lambda: extract_document_features(text, on_token, max_tokens, config),
+            config,
+        )
+    llm = get_llm_processor()
+    if config.get("FEATURE_EXTRACTION_CHUNKING", True):
+        budget = feature_chunk_budget(llm, config)
+        if estimate_tokens(text) > budget:
+            logger.info(f"📚 Document exceeds the {budget}-token extraction budget, using section chunking")
+            return extract_features_chunked(text, budget, fields)
+    # prompt = f"""
+    # You are a medical AI assistant. Extract clinical features from the clinical text below. For each field, return:
+    # - The extracted value
+    # - And the corresponding *_source_text used to infer it
+
+    # Return ONLY a valid JSON object with this structure:
+
+    # {{
+    # "age": integer or null,
+    # "age_source_text": string or null,
+    # "gender": "male" | "female" | "not mentioned",
+    # "gender_source_text": string or null,
+    # "diagnosis": string or null,
+    # "diagnosis_source_text": string or null,
+    # "stage": string or null,
+    # "stage_source_text": string or null,
+    # "ecog": string or null,
+    # "ecog_source_text": string or null,
+    # "mutations": list of strings,
+    # "mutations_source_text": list of strings,
+    # "metastases": list of strings,
+    # "metastases_source_text": list of strings,
+    # "previous_treatments": list of strings,
+    # "previous_treatments_source_text": list of strings,
+    # "lab_values": dict,
+    # "lab_values_source_text": dict
+    # }}
+
+    # TEXT:
+    # {text}
+
+    # JSON ONLY OUTPUT:
+    # """
+    # Missing fields are re-extracted on their own only for standard (non-chunk, non-combined) prompts
+    reextract = None
+    if prompt is None:
+        reextract = lambda missing: extract_features_with_llm(
+            text, prompt=build_feature_prompt(text, missing), max_tokens=max_tokens, fields=missing
+        )
+    prompt = prompt or build_feature_prompt(text, fields)
+
     logger.info(f"Prompt sent to LLM:\n{prompt[:2000]}")  # Log the prompt snippet
     
     try:
         # Send prompt to LLM and receive response
-        response = llm.generate_response(prompt)
+        response = llm.generate_response(
+            prompt, on_token=on_token, max_tokens=max_tokens,
+            format_schema=ollama_format_schema(ClinicalFeatures, fields), stage="features"
+        )
         logger.info(f"🧠 LLM Raw Response: {response[:1000]}")
+        if not response:
+            logger.error("❌ Empty response from LLM")
+            return {}
+
+        write_debug_artifact("features", {"prompt": prompt, "response": response})
 
-        try:
-            os.makedirs("logs", exist_ok=True)
-            filename = f"logs/llm_raw_debug_{int(time.time())}.json"
-            with open(filename, "w") as f:
-                json.dump({"prompt": prompt, "response": response}, f, indent=2)
-            logger.info(f"💾 Saved LLM debug output to {filename}")
-        except Exception as e:
-            logger.warning(f"⚠️ Failed to write raw debug log: {e}")
-        
         
         # Parse the LLM response to get 'llm_text'
         resp_json = json.loads(response)      
@@ -138,28 +251,39 @@ Linee guida operative (commenti fuori dallo schema):
         llm_text = json.loads(llm_text_str)  if isinstance(llm_text_str, str) else llm_text_str
 
         if not isinstance(llm_text, dict):
+            record_parse("features", llm.structured_output, False)
             logger.error(f"❌ LLM response is not a valid JSON object: {llm_text}")
             return {}
 
+        record_parse("features", llm.structured_output, True)
+        # Brand and Italian drug names → INN before validation, so they do not need repairing
+        llm_text = normalize_feature_drugs(llm_text, config)
+        llm_text = validate_and_repair(llm_text, fields, llm=llm, reextract=reextract)
         logger.info(f"✅ Extracted Features (llm_text): {json.dumps(llm_text, indent=2)}")
         return llm_text
 
     except json.JSONDecodeError as e:
+        record_parse("features", llm.structured_output, False)
         logger.error(f"❌ JSON decoding error: {str(e)} - Raw response: {response}")
         return {}
+    except BusyError:
+        raise
     except Exception as e:
         logger.error(f"❌ Unexpected error in feature extraction: {e}")
         return {}
 
 def highlight_sources(text: str, features: Dict[str, Any]) -> str:
-    for key, value in features.items():
-        if key.endswith('_source_text') and isinstance(value, str) and value.strip():
-            try:
-                escaped = re.escape(value.strip())
-                text = re.sub(f"({escaped})", r'<mark>\1</mark>', text, flags=re.IGNORECASE)
-            except Exception as e:
-                logger.warning(f"⚠️ Failed to highlight '{value}': {e}")
-    return text
+    """Evidenzia con <mark> i testi `*_source_text` delle feature (un solo passaggio, sovrapposizioni unite)."""
+    return render_highlights(text, find_source_spans(text, collect_sources(features)))
+
+
+def feature_highlights(text: str, features: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Intervalli {"start", "end", "fields"} da evidenziare lato client: testi sorgente
+    delle feature ed evidence della pre-estrazione.
+    """
+    evidence = pre_extract(text)["evidence"] if get_config().get("PRE_EXTRACTION_ENABLED", True) else {}
+    return find_source_spans(text, collect_sources(features, evidence))
 
 
 
@@ -292,6 +416,8 @@ from typing import Dict, Any, List
 def parse_llm_response(raw_response: str) -> list:
     """
     Estrae e parsifica il JSON dei trial dalla chiave 'response' all'interno di raw_response.
+    Con l'output strutturato la risposta è già un oggetto {"verdicts": [...]}; la ricerca
+    del blocco ```json``` resta solo come fallback per le risposte in testo libero.
     """
     try:
         # Decodifica il JSON dalla stringa di raw_response
@@ -302,24 +428,284 @@ def parse_llm_response(raw_response: str) -> list:
         if not llm_text_response:
             raise ValueError("❌ Nessuna risposta trovata nella chiave 'response'.")
 
-        # Cerca il blocco JSON nella risposta usando regex
-        json_match = re.search(r"```json\s*(\[.*?\])\s*```", llm_text_response, re.DOTALL)
-        if not json_match:
-            json_match = re.search(r"```(.*?)```", llm_text_response, re.DOTALL)
-
-        if json_match:
-            json_text = json_match.group(1).strip()
-            parsed_json = json.loads(json_text)
-            return parsed_json if isinstance(parsed_json, list) else []
-
-        else:
-            raise ValueError("❌ Nessun blocco JSON trovato nella risposta LLM.")
+        try:
+            parsed_json = json.loads(llm_text_response)
+        except json.JSONDecodeError:
+            # Cerca il blocco JSON nella risposta usando regex
+            json_match = re.search(r"```json\s*(\[.*?\])\s*```", llm_text_response, re.DOTALL)
+            if not json_match:
+                json_match = re.search(r"```(.*?)```", llm_text_response, re.DOTALL)
+            if not json_match:
+                raise ValueError("❌ Nessun blocco JSON trovato nella risposta LLM.")
+            parsed_json = json.loads(json_match.group(1).strip())
+
+        if isinstance(parsed_json, dict):
+            parsed_json = parsed_json.get("verdicts", [])
+        return [entry for entry in parsed_json if isinstance(entry, dict)] if isinstance(parsed_json, list) else []
 
     except (json.JSONDecodeError, ValueError) as e:
         logger.error(f"❌ Errore durante il parsing della risposta LLM: {str(e)}")
         return []
 
-def match_trials_llm(llm_text: Dict[str, Any]) -> List[Dict[str, Any]]:
+def get_matching_concurrency() -> int:
+    """
+    Numero massimo di batch inviati in parallelo a Ollama.
+    Da allineare con OLLAMA_NUM_PARALLEL del server (default: 1, cioè seriale).
+    """
+    config = get_config()
+    value = config.get("TRIAL_MATCHING_CONCURRENCY", os.getenv("OLLAMA_NUM_PARALLEL", 1))
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        logger.warning(f"⚠️ Invalid TRIAL_MATCHING_CONCURRENCY '{value}', falling back to 1")
+        return 1
+
+# Prefisso condiviso da tutti i batch dello stesso paziente: istruzioni, formato di
+# output e feature del paziente. I trial (la parte che cambia) vanno sempre in fondo.
+MATCHING_PROMPT_HEADER = """
+You are a clinical AI assistant. Is the following patient eligible for the trials listed at the end?
+
+Explain me why you decided the eligibility or not through a JSON object with one verdict per trial, in the following strict format :
+{
+  "verdicts": [
+    {
+      "trial_id": string,
+      "title": string,
+      "description": string,
+      "match_score": integer (0 to 100),
+      "overall_recommendation": string,
+      "criteria_analysis": string,
+      "summary": string
+    }
+  ]
+}
+"""
+
+TRIALS_SECTION_HEADER = "\n### TRIALS:\n"
+
+def build_matching_prefix(llm_text: Dict[str, Any]) -> str:
+    return f"{MATCHING_PROMPT_HEADER}\nPATIENT FEATURES:\n{json.dumps(llm_text, indent=2)}\n"
+
+def not_evaluated_trial(trial: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "trial_id": trial.get("id"),
+        "title": trial.get("title", "Unknown Trial"),
+        "description": trial.get("description", "No description provided."),
+        "match_score": 0,
+        "recommendation": "NOT EVALUATED",
+        "criteria_analysis": None,
+        "summary": "The LLM service did not answer for this trial (timeout or unavailable); please retry.",
+        "evaluated": False
+    }
+
+def match_trial_batch(llm, prompt_prefix: str, batch: List[Dict[str, Any]], batch_index: int, total_batches: int,
+                      max_tokens: int = None, stage: str = "matching"):
+    """
+    Valuta un singolo batch di trial. Restituisce (trial valutati, voci di debug)
+    senza toccare stato condiviso, così può girare in un thread separato.
+    """
+    logger.info(f"🔹 Processing batch {batch_index + 1} of {total_batches}...")
+    matched = []
+    debug_entries = []
+
+    prompt = f"""{prompt_prefix}{TRIALS_SECTION_HEADER}{json.dumps([trial for trial in batch], indent=2)}
+"""
+    try:
+        response = llm.generate_response(
+            prompt, max_tokens=max_tokens, hedge=True, format_schema=ollama_format_schema(TrialVerdictBatch),
+            stage=stage
+        )
+        logger.info(f"🔧 LLM Raw Response (Batch {batch_index + 1}): {response[:1000]}")
+
+        if not response:
+            logger.error(f"❌ Empty response from LLM for Batch {batch_index + 1}")
+            debug_entries.append({
+                "batch_index": batch_index + 1,
+                "response": "EMPTY RESPONSE"
+            })
+            # Keep the trials in the result so a failed batch is visible instead of silently dropped
+            matched.extend(not_evaluated_trial(trial) for trial in batch)
+            return matched, debug_entries
+
+        # Save the raw response in debug data
+        debug_entries.append({
+            "batch_index": batch_index + 1,
+            "raw_response": response
+        })
+
+        # ✅ Parsing the JSON response using the robust function
+        match_results = parse_llm_response(response)
+        record_parse(stage, llm.structured_output, bool(match_results))
+
+        if match_results:
+            # Verdicts are matched by trial_id; position is only a fallback for missing ids
+            by_id = {str(result.get("trial_id")): result for result in match_results}
+            for position, trial in enumerate(batch):
+                match_result = by_id.get(str(trial.get("id")))
+                if match_result is None and position < len(match_results) and not match_results[position].get("trial_id"):
+                    match_result = match_results[position]
+                if match_result is None:
+                    logger.warning(f"⚠️ No verdict for trial {trial.get('id')} in Batch {batch_index + 1}")
+                    matched.append(not_evaluated_trial(trial))
+                    continue
+                matched.append({
+                    "trial_id": trial.get("id"),
+                    "title": trial.get("title", "Unknown Trial"),
+                    "description": trial.get("description", "No description provided."),
+                    "match_score": match_result.get("match_score", 0),
+                    "recommendation": match_result.get("overall_recommendation", "UNKNOWN"),
+                    "criteria_analysis": match_result.get("criteria_analysis"),
+                    "summary": match_result.get("summary", "No summary available.")
+                })
+        else:
+            logger.error(f"❌ Invalid JSON structure for Batch {batch_index + 1}")
+            matched.extend(not_evaluated_trial(trial) for trial in batch)
+
+    except BusyError:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error in LLM matching for batch {batch_index + 1}: {str(e)}")
+        debug_entries.append({
+            "batch_index": batch_index + 1,
+            "error": str(e)
+        })
+        # Verdicts parsed before the error are discarded too: the whole batch is reported as not evaluated
+        matched = [not_evaluated_trial(trial) for trial in batch]
+
+    return matched, debug_entries
+
+def response_gpu_seconds(response: str) -> float:
+    """Secondi di calcolo riportati da Ollama (total_duration) per una risposta grezza."""
+    try:
+        return (json.loads(response).get("total_duration") or 0) / 1e9
+    except (ValueError, AttributeError):
+        return 0.0
+
+def run_matching_pass(llm, prompt_prefix: str, trials: List[Dict[str, Any]], config: Dict[str, Any],
+                      stage: str = "matching", on_batch=None):
+    """
+    Valuta `trials` a batch con il profilo di `stage` (packing per token, batch in
+    parallelo). Restituisce (verdetti in ordine di batch, voci di debug, secondi GPU).
+    """
+    output_tokens_per_trial = int(config.get("TRIAL_MATCHING_OUTPUT_TOKENS_PER_TRIAL", 400))
+    trial_batches, packing = pack_trials(
+        trials,
+        prefix_tokens=estimate_tokens(prompt_prefix) + estimate_tokens(TRIALS_SECTION_HEADER),
+        context_size=llm.resolve_profile(stage)["context_size"],
+        output_tokens_per_trial=output_tokens_per_trial,
+        max_trials_per_batch=int(config.get("TRIAL_MATCHING_BATCH_SIZE", 4)) or None,
+        headroom=int(config.get("TRIAL_MATCHING_CONTEXT_HEADROOM", 256)),
+    )
+    logger.info(
+        f"📦 [{stage}] Packed {len(trials)} trials into {packing['batches']} batches "
+        f"(mean context fill {packing['mean_fill_ratio']:.0%}, per batch {packing['fill_ratios']})"
+    )
+
+    concurrency = min(get_matching_concurrency(), len(trial_batches))
+    logger.info(f"⚙️ Matching {len(trial_batches)} batches with concurrency {concurrency}")
+    started = time.perf_counter()
+
+    batch_results = [None] * len(trial_batches)
+
+    def run_batch(batch_index, batch):
+        # Cap generation to what the verdicts of this batch need
+        return match_trial_batch(llm, prompt_prefix, batch, batch_index, len(trial_batches),
+                                 max_tokens=len(batch) * output_tokens_per_trial, stage=stage)
+
+    def collect(batch_index, result):
+        batch_results[batch_index] = result
+        if on_batch is not None:
+            try:
+                on_batch(batch_index, len(trial_batches), result[0])
+            except Exception as e:
+                logger.warning(f"⚠️ Batch callback failed for batch {batch_index + 1}: {e}")
+
+    pending = list(enumerate(trial_batches))
+    if concurrency > 1 and config.get("TRIAL_MATCHING_PRIME_PREFIX", True):
+        # Run the first batch alone so the shared prefix is already in Ollama's KV cache
+        # when the remaining batches are sent in parallel
+        batch_index, batch = pending.pop(0)
+        collect(batch_index, run_batch(batch_index, batch))
+
+    if concurrency <= 1:
+        for batch_index, batch in pending:
+            collect(batch_index, run_batch(batch_index, batch))
+    elif pending:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="trial-match") as executor:
+            futures = {
+                submit_with_context(executor, run_batch, batch_index, batch): batch_index
+                for batch_index, batch in pending
+            }
+            for future in as_completed(futures):
+                collect(futures[future], future.result())
+
+    # Merge in batch order, so results and debug output stay deterministic
+    matched, debug_entries = [], []
+    for batch_matched, batch_debug in batch_results:
+        matched.extend(batch_matched)
+        debug_entries.extend(batch_debug)
+    gpu_seconds = sum(response_gpu_seconds(entry.get("raw_response", "")) for entry in debug_entries)
+
+    logger.info(f"⏱️ [{stage}] Matched {len(trial_batches)} batches in {time.perf_counter() - started:.2f}s "
+                f"({gpu_seconds:.1f} GPU-seconds)")
+    return matched, debug_entries, gpu_seconds
+
+def match_trials_cascade(llm, prompt_prefix: str, trials: List[Dict[str, Any]], config: Dict[str, Any],
+                         settings: Dict[str, Any], on_batch=None, on_screened=None):
+    """
+    Cascata: il modello piccolo (profilo "matching_screen") valuta tutti i trial;
+    solo i verdetti incerti o malformati vengono rivalutati dal modello di "matching".
+    `on_screened(verdicts accettati, numero di trial da rivalutare)` segnala la fine dello
+    screening; `on_batch` riceve solo i batch della rivalutazione, numerati tra loro.
+    Restituisce (verdetti nell'ordine dei trial, voci di debug, riepilogo della cascata).
+    """
+    screened, screen_debug, screen_seconds = run_matching_pass(llm, prompt_prefix, trials, config,
+                                                               stage=SCREEN_STAGE)
+    escalate, reasons = select_escalations(screened, settings["band"], settings["max_escalation_rate"])
+    accepted = [dict(verdict, escalated=False) for verdict in screened
+                if str(verdict.get("trial_id")) not in escalate]
+    escalated_trials = [trial for trial in trials if str(trial.get("id")) in escalate]
+    if on_screened is not None:
+        try:
+            on_screened(accepted, len(escalated_trials))
+        except Exception as e:
+            logger.warning(f"⚠️ Screening callback failed: {e}")
+
+    full, full_debug, full_seconds = [], [], 0.0
+    if escalated_trials:
+        full, full_debug, full_seconds = run_matching_pass(llm, prompt_prefix, escalated_trials, config,
+                                                           stage="matching", on_batch=on_batch)
+
+    screen_scores = {str(verdict.get("trial_id")): verdict.get("match_score") for verdict in screened}
+    final = {str(verdict.get("trial_id")): verdict for verdict in accepted}
+    for verdict in full:
+        trial_id = str(verdict.get("trial_id"))
+        final[trial_id] = dict(verdict, escalated=True, escalation_reason=reasons.get(trial_id),
+                               screen_score=screen_scores.get(trial_id))
+    ordered = [final[str(trial.get("id"))] for trial in trials if str(trial.get("id")) in final]
+
+    get_cascade_stats().record(len(screened), reasons, screen_seconds, full_seconds)
+    summary = {
+        "screened": len(screened),
+        "escalated": len(escalated_trials),
+        "escalation_rate": round(len(escalated_trials) / len(screened), 4) if screened else 0.0,
+        "reasons": reasons,
+        "screen_gpu_seconds": round(screen_seconds, 3),
+        "full_gpu_seconds": round(full_seconds, 3),
+    }
+    logger.info(f"🪜 Cascade: {summary['escalated']}/{summary['screened']} trials escalated "
+                f"({summary['escalation_rate']:.0%}), GPU-seconds screen {screen_seconds:.1f} + full {full_seconds:.1f}")
+    return ordered, screen_debug + full_debug, summary
+
+def match_trials_llm(llm_text: Dict[str, Any], on_batch=None, cascade: bool = None,
+                     on_screened=None) -> List[Dict[str, Any]]:
+    """
+    Valuta tutti i trial a batch. Se `on_batch` è passato viene chiamata, appena un
+    batch termina, con (indice batch, numero batch, trial valutati nel batch).
+    `cascade` forza on/off la cascata modello piccolo → grande
+    (default: TRIAL_MATCHING_CASCADE_ENABLED); con la cascata `on_screened` riceve i
+    verdetti accettati dallo screening e `on_batch` i batch della rivalutazione.
+    """
     logger.info("✅ Starting LLM Trial Matching (Batched)...")
     print("✅ Starting LLM Trial Matching (Batched)...")  # Immediate feedback
 
@@ -333,98 +719,38 @@ def match_trials_llm(llm_text: Dict[str, Any]) -> List[Dict[str, Any]]:
         print("❌ No trials found in database")
         return []
 
-    matched_trials = []
-    logger.info("🔍 Matching Trials using LLM with Batching (4 Trials per Batch)...")
-    print("🔍 Matching Trials using LLM with Batching (4 Trials per Batch)...")
+    logger.info("🔍 Matching Trials using LLM with token-budget batching...")
+    print("🔍 Matching Trials using LLM with token-budget batching...")
 
-    batch_size = 3
-    trial_batches = [trials[i:i + batch_size] for i in range(0, len(trials), batch_size)]
-    debug_filename = f"logs/llm_match_debug_{int(time.time())}.json"
+    config = get_config()
+    prompt_prefix = build_matching_prefix(llm_text)
     debug_data = {"llm_text": llm_text, "batch_responses": []}
-    logger.info(f"✅ Debug file initialized: {debug_filename}")
-
-    for batch_index, batch in enumerate(trial_batches):
-        logger.info(f"🔹 Processing batch {batch_index + 1} of {len(trial_batches)}...")
-
-        prompt = f"""
-You are a clinical AI assistant. Is the following patient eligible for this trials? 
-
-PATIENT FEATURES:
-{json.dumps(llm_text, indent=2)}
-
-### TRIALS:
-{json.dumps([trial for trial in batch], indent=2)}
-
-Explain me why you decided the eligibility or not through a JSON list where each object is in the following strict format :
-[
-  {{
-    "trial_id": string,
-    "title": string,
-    "description": string,
-    "match_score": integer (0 to 100),
-    "overall_recommendation": string,
-    "criteria_analysis": string,
-    "summary": string
-  }}
-]
-"""
-        try:
-            response = llm.generate_response(prompt)
-            logger.info(f"🔧 LLM Raw Response (Batch {batch_index + 1}): {response[:1000]}")
-
-            if not response:
-                logger.error(f"❌ Empty response from LLM for Batch {batch_index + 1}")
-                debug_data["batch_responses"].append({
-                    "batch_index": batch_index + 1,
-                    "response": "EMPTY RESPONSE"
-                })
-                continue
-
-            # Save the raw response in debug data
-            debug_data["batch_responses"].append({
-                "batch_index": batch_index + 1,
-                "raw_response": response
-            })
-
-            # ✅ Parsing the JSON response using the robust function
-            match_results = parse_llm_response(response)
-
-            if isinstance(match_results, list):
-                for trial, match_result in zip(batch, match_results):
-                    matched_trials.append({
-                        "trial_id": trial.get("id"),
-                        "title": trial.get("title", "Unknown Trial"),
-                        "description": trial.get("description", "No description provided."),
-                        "match_score": match_result.get("match_score", 0),
-                        "recommendation": match_result.get("overall_recommendation", "UNKNOWN"),
-                        "criteria_analysis": match_result.get("criteria_analysis"),
-                        "summary": match_result.get("summary", "No summary available.")
-                    })
-            else:
-                logger.error(f"❌ Invalid JSON structure for Batch {batch_index + 1}")
-
-        except Exception as e:
-            logger.error(f"❌ Error in LLM matching for batch {batch_index + 1}: {str(e)}")
-            debug_data["batch_responses"].append({
-                "batch_index": batch_index + 1,
-                "error": str(e)
-            })
 
-    # Save the full debug data to the debug file
-    with open(debug_filename, "w") as f:
-        json.dump(debug_data, f, indent=2)
-    logger.info(f"💾 Saved LLM trial matching debug output to {debug_filename}")
-    print(f"💾 Saved LLM trial matching debug output to {debug_filename}")
+    settings = cascade_settings(config)
+    use_cascade = settings["enabled"] if cascade is None else cascade
+    if use_cascade and SCREEN_STAGE not in llm.stage_profiles:
+        logger.warning(f"⚠️ Matching cascade enabled but LLM_STAGE_PROFILES has no '{SCREEN_STAGE}' "
+                       f"profile: using the matching model only")
+        use_cascade = False
+
+    if use_cascade:
+        matched_trials, debug_entries, debug_data["cascade"] = match_trials_cascade(
+            llm, prompt_prefix, trials, config, settings, on_batch=on_batch, on_screened=on_screened
+        )
+    else:
+        matched_trials, debug_entries, _ = run_matching_pass(llm, prompt_prefix, trials, config,
+                                                             on_batch=on_batch)
+    debug_data["batch_responses"].extend(debug_entries)
+
+    # Queued for the background writer (logs/debug/matching_<request>_<seq>.json.gz)
+    write_debug_artifact("matching", debug_data, config)
 
     # ✅ Sort matched trials by Match Score (High to Low)
     matched_trials.sort(key=lambda x: x.get('match_score', 0), reverse=True)
     logger.info(f"✅ Trial matching completed. {len(matched_trials)} trials matched.")
 
     # Save matched trials for further review
-    matched_trials_filename = f"logs/matched_trials_{int(time.time())}.json"
-    with open(matched_trials_filename, "w") as f:
-        json.dump(matched_trials, f, indent=2)
-    logger.info(f"💾 Matched trials saved to {matched_trials_filename}")
+    write_debug_artifact("matched_trials", list(matched_trials), config)
 
     return matched_trials
 
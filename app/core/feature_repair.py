@@ -0,0 +1,186 @@
+import re
+import json
+import logging
+from typing import Dict, Any, List, Callable
+
+from app.core.schema_validation import (
+    ClinicalFeatures, ollama_format_schema, record_repair, validate_fields
+)
+from app.core.pre_extraction import FEATURE_FIELDS, pdl1_bucket, vocabulary_matches
+from app.core.scheduler import BusyError
+
+logger = logging.getLogger(__name__)
+
+NOT_MENTIONED = "not mentioned"
+LIST_FIELDS = {"brain_metastasis", "prior_systemic_therapies", "comorbidities", "concomitant_treatments"}
+REPAIR_STAGE = "features_repair"
+
+# Short prompt: no document, only the values to map onto the schema
+REPAIR_PROMPT = """Alcuni campi estratti da una cartella clinica non rispettano lo schema richiesto.
+Per ogni campo sotto, restituisci il valore ammesso dallo schema che corrisponde al valore indicato.
+Se nessun valore ammesso corrisponde, scrivi "not mentioned" (per le liste ["not mentioned"]).
+Restituisci SOLO un oggetto JSON con questi campi.
+
+Campi da correggere:
+{fields}
+"""
+
+_EMPTY = {"", "null", "none", "n/a", "na", "nd", "n.d.", "unknown", "sconosciuto", "non noto",
+          "non menzionato", "non riportato", "not reported", "not available", "-"}
+_GENDER = {"m": "male", "maschio": "male", "maschile": "male", "uomo": "male", "man": "male",
+           "f": "female", "femmina": "female", "femminile": "female", "donna": "female", "woman": "female"}
+_BOOLEAN = {"true": "true", "yes": "true", "si": "true", "sì": "true", "presente": "true", "presenti": "true",
+            "positive": "true", "positivo": "true", "false": "false", "no": "false", "assente": "false",
+            "assenti": "false", "negative": "false", "negativo": "false"}
+_LINES = [
+    (r"neo-?ad?iuvant|neoadjuvant", "neoadjuvant"),
+    (r"ad?iuvant|adjuvant", "adjuvant"),
+    (r"mantenimento|maintenance", "maintenance"),
+    (r"\b(?:1l|1st|first|prima|i)\b|^1$", "1L"),
+    (r"\b(?:2l|2nd|second|seconda|ii)\b|^2$", "2L"),
+    (r"\b(?:[3-9]l|3rd|third|terza|iii|iv|>= ?3l?)\b|^[3-9]$", ">=3L"),
+]
+_ROMAN = {"1": "I", "2": "II", "3": "III", "4": "IV"}
+
+
+def _is_empty(value) -> bool:
+    return value is None or (isinstance(value, str) and value.strip().lower() in _EMPTY)
+
+
+def _as_list(value) -> list:
+    if isinstance(value, list):
+        return value
+    if isinstance(value, str):
+        return [item.strip() for item in re.split(r"[;,\n]", value) if item.strip()]
+    return [value]
+
+
+def _normalize_scalar(field: str, value):
+    text = str(value).strip().lower()
+    if field == "age":
+        match = re.search(r"\d{1,3}", text)
+        return int(match.group(0)) if match else None
+    if field == "gender":
+        return _GENDER.get(text)
+    if field == "ecog_ps":
+        match = re.search(r"[0-4]", text)
+        return int(match.group(0)) if match else None
+    if field == "current_stage":
+        match = re.search(r"\b(iv|iii|ii|i|[1-4])[abc]?\d?\b", text.replace("stadio", "").replace("stage", ""))
+        if not match:
+            return None
+        return _ROMAN.get(match.group(1), match.group(1).upper())
+    if field == "line_of_therapy":
+        for pattern, canonical in _LINES:
+            if re.search(pattern, text):
+                return canonical
+        return None
+    if field == "pd_l1_tps":
+        match = re.search(r"([<>≥≤]=?)?\s*(\d{1,3}(?:[.,]\d+)?)\s*%?", text)
+        return pdl1_bucket(match.group(1), match.group(2)) if match else None
+    if field in ("histology", "biomarkers"):
+        # "non squamoso", "ALK negativo", ...: a negated term is left to the LLM
+        if re.search(r"\b(?:non|not|no)\b(?![- ]?(?:a[- ]piccole|small))|negativ|wild", text):
+            return None
+        matches = [m for m in vocabulary_matches(str(value), field) if m != "nsclc"]
+        return matches[0] if len(matches) == 1 else None
+    return None
+
+
+def normalize_field(field: str, value):
+    """
+    Correzione locale di un valore fuori schema (sinonimi, maiuscole, numeri come
+    testo, liste come stringhe, ...). Restituisce il valore normalizzato, oppure
+    None se non è possibile senza l'LLM.
+    """
+    if field in LIST_FIELDS:
+        items = [item for item in _as_list(value) if not _is_empty(item)]
+        if not items:
+            return [NOT_MENTIONED]
+        if field == "brain_metastasis":
+            flags = {_BOOLEAN.get(str(item).strip().lower()) for item in items}
+            return [flags.pop()] if len(flags) == 1 and None not in flags else None
+        if field == "prior_systemic_therapies":
+            drugs = []
+            for item in items:
+                # Therapies outside the vocabulary are kept as "other", like the prompt asks
+                for drug in vocabulary_matches(str(item), field) or ["other"]:
+                    if drug not in drugs:
+                        drugs.append(drug)
+            return drugs
+        return [str(item) for item in items]
+    if _is_empty(value):
+        return NOT_MENTIONED
+    if isinstance(value, list) and len(value) == 1:
+        value = value[0]
+    if isinstance(value, (list, dict)):
+        return None
+    return _normalize_scalar(field, value)
+
+
+def repair_prompt(invalid: Dict[str, Any]) -> str:
+    lines = "\n".join(f"- {field}: {json.dumps(value, ensure_ascii=False)}" for field, value in invalid.items())
+    return REPAIR_PROMPT.format(fields=lines)
+
+
+def _ask_repair(llm, invalid: Dict[str, Any]) -> Dict[str, Any]:
+    fields = list(invalid)
+    response = llm.generate_response(
+        repair_prompt(invalid), max_tokens=64 * len(fields),
+        format_schema=ollama_format_schema(ClinicalFeatures, fields), stage=REPAIR_STAGE,
+    )
+    repaired = json.loads(json.loads(response)["response"])
+    return repaired if isinstance(repaired, dict) else {}
+
+
+def validate_and_repair(features: Dict[str, Any], fields: List[str] = None, llm=None,
+                        reextract: Callable[[List[str]], Dict[str, Any]] = None,
+                        stage: str = "features") -> Dict[str, Any]:
+    """
+    Valida le feature estratte campo per campo contro ClinicalFeatures:
+    1. i valori fuori schema vengono normalizzati in locale quando possibile;
+    2. i restanti vanno all'LLM con un breve prompt di riparazione (senza documento);
+    3. i campi mancanti vengono ri-estratti da soli con `reextract`, se fornito.
+    Quello che resta non valido diventa "not mentioned". Restituisce i soli `fields`.
+    """
+    fields = fields or FEATURE_FIELDS
+    valid, invalid, missing = validate_fields(ClinicalFeatures, features, fields)
+    for field in LIST_FIELDS & set(valid):
+        if not valid[field]:
+            valid[field] = [NOT_MENTIONED]
+
+    still_invalid = {}
+    for field, value in invalid.items():
+        normalized = normalize_field(field, value)
+        checked, _, _ = validate_fields(ClinicalFeatures, {field: normalized}, [field])
+        if field in checked:
+            valid[field] = checked[field]
+        else:
+            still_invalid[field] = value
+    record_repair(stage, "normalized", len(invalid) - len(still_invalid))
+
+    if still_invalid and llm is not None:
+        logger.info(f"🩹 Repairing {len(still_invalid)} invalid field(s): {', '.join(still_invalid)}")
+        try:
+            repaired, _, _ = validate_fields(ClinicalFeatures, _ask_repair(llm, still_invalid), list(still_invalid))
+            valid.update(repaired)
+            record_repair(stage, "repaired", len(repaired))
+        except BusyError:
+            raise
+        except Exception as e:
+            logger.warning(f"⚠️ Field repair failed: {e}")
+
+    if missing and reextract is not None:
+        logger.info(f"🔁 Re-extracting missing field(s): {', '.join(missing)}")
+        recovered, _, _ = validate_fields(ClinicalFeatures, reextract(missing) or {}, missing)
+        valid.update(recovered)
+        record_repair(stage, "reextracted", len(recovered))
+
+    defaulted = [field for field in fields if field not in valid]
+    if defaulted:
+        logger.warning(f"⚠️ Fields left invalid or missing, set to 'not mentioned': {', '.join(defaulted)}")
+        record_repair(stage, "defaulted", len(defaulted))
+    return {
+        field: valid.get(field, [NOT_MENTIONED] if field in LIST_FIELDS else NOT_MENTIONED)
+        for field in fields
+    }
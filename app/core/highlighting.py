@@ -0,0 +1,84 @@
+import re
+import logging
+from typing import Dict, Any, List
+
+logger = logging.getLogger(__name__)
+
+SOURCE_SUFFIX = "_source_text"
+
+
+def collect_sources(features: Dict[str, Any], evidence: Dict[str, List[str]] = None) -> Dict[str, List[str]]:
+    """
+    Testi sorgente da evidenziare → campi a cui si riferiscono. Legge le chiavi
+    `*_source_text` delle feature (stringhe o liste) e, se presente, l'evidence della
+    pre-estrazione ({campo: [testo trovato]}).
+    """
+    sources = {}
+
+    def add(snippet, field):
+        if isinstance(snippet, str) and snippet.strip():
+            fields = sources.setdefault(snippet.strip(), [])
+            if field not in fields:
+                fields.append(field)
+
+    for key, value in (features or {}).items():
+        if key.endswith(SOURCE_SUFFIX):
+            for snippet in value if isinstance(value, list) else [value]:
+                add(snippet, key[:-len(SOURCE_SUFFIX)])
+    for field, snippets in (evidence or {}).items():
+        for snippet in snippets:
+            add(snippet, field)
+    return sources
+
+
+def _snippet_pattern(snippet: str) -> str:
+    # Whitespace in a source may be a line break in the PDF text and vice versa
+    return r"\s+".join(re.escape(word) for word in snippet.split())
+
+
+def find_source_spans(text: str, sources: Dict[str, List[str]]) -> List[Dict[str, Any]]:
+    """
+    Trova tutte le occorrenze dei testi sorgente con un solo `finditer`: l'alternativa
+    (sorgenti più lunghe prima) sta in un lookahead, quindi ogni match è vuoto e la
+    scansione avanza di un carattere, trovando anche le sorgenti che iniziano dentro
+    un'altra. Gli intervalli sovrapposti vengono uniti. Restituisce
+    [{"start", "end", "fields"}] ordinati per offset, usabili dalla UI per evidenziare
+    lato client.
+    """
+    if not text or not sources:
+        return []
+    snippets = sorted(sources, key=len, reverse=True)
+    alternatives = {True: [], False: []}
+    for index, snippet in enumerate(snippets):
+        alternatives[bool(re.match(r"\w", snippet))].append(f"(?P<s{index}>{_snippet_pattern(snippet)})")
+    # Sources that start with a word character are only tried at word starts, which lets
+    # the engine skip most positions (several times faster on long letters)
+    branches = []
+    if alternatives[True]:
+        branches.append(r"\b(?=\w)(?=" + "|".join(alternatives[True]) + ")")
+    if alternatives[False]:
+        branches.append("(?=" + "|".join(alternatives[False]) + ")")
+    pattern = re.compile("|".join(branches), re.IGNORECASE)
+
+    spans = []
+    for match in pattern.finditer(text):
+        start, end = match.span(match.lastgroup)
+        fields = sources[snippets[int(match.lastgroup[1:])]]
+        if spans and start < spans[-1]["end"]:
+            # Overlaps the previous span: extend it instead of opening a new <mark>
+            last = spans[-1]
+            last["end"] = max(last["end"], end)
+            last["fields"] += [field for field in fields if field not in last["fields"]]
+        else:
+            spans.append({"start": start, "end": end, "fields": list(fields)})
+    return spans
+
+
+def render_highlights(text: str, spans: List[Dict[str, Any]], tag: str = "mark") -> str:
+    """Inserisce i tag attorno agli intervalli (già ordinati e disgiunti) con un solo join."""
+    parts, position = [], 0
+    for span in spans:
+        parts.extend((text[position:span["start"]], f"<{tag}>", text[span["start"]:span["end"]], f"</{tag}>"))
+        position = span["end"]
+    parts.append(text[position:])
+    return "".join(parts)
@@ -0,0 +1,246 @@
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import logging
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from app.core.storage_crypto import EncryptionUnavailable, encryption_settings, get_storage_cipher
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = "cache/llm_responses.sqlite"
+
+# Set by bypass_llm_cache() for the duration of a request (or any block of code)
+_bypass = contextvars.ContextVar("llm_cache_bypass", default=False)
+
+
+@contextmanager
+def bypass_llm_cache(enabled: bool = True):
+    """Disattiva la cache delle risposte LLM all'interno del blocco."""
+    token = _bypass.set(enabled)
+    try:
+        yield
+    finally:
+        _bypass.reset(token)
+
+
+def is_cache_bypassed() -> bool:
+    return _bypass.get()
+
+
+def make_cache_key(payload: dict) -> str:
+    """
+    Chiave content-addressed: hash SHA-256 di tutti i parametri che influenzano
+    la generazione (modello, prompt, temperatura, num_ctx, ...). Il flag `stream`
+    viene ignorato perché non cambia il contenuto della risposta.
+    """
+    material = {k: v for k, v in payload.items() if k != "stream"}
+    encoded = json.dumps(material, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class TieredCache:
+    """
+    Cache a due livelli: LRU in memoria (per processo) e SQLite su disco,
+    condiviso tra i worker gunicorn. Entrambi i livelli applicano TTL e limite
+    di dimensione. Memorizza solo la chiave hash e il valore, mai il prompt.
+    Con un `cipher` (ENCRYPT_AT_REST) il livello su disco contiene solo valori
+    cifrati e chiavi HMAC.
+    """
+
+    def __init__(self, name: str, path: str = None, max_memory_entries: int = 256,
+                 max_disk_entries: int = 5000, ttl_seconds: float = 86400, cipher=None):
+        self.name = name
+        self.path = path
+        self.cipher = cipher
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl_seconds = ttl_seconds
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "rejected": 0,
+            "evictions": 0,
+            "errors": 0,
+        }
+        if self.path:
+            self._init_disk()
+
+    # --- disk tier -------------------------------------------------------
+
+    @contextmanager
+    def _connect(self):
+        # One short-lived connection per operation: safe across threads and processes
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_disk(self):
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with self._connect() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS entries ("
+                    " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                    " created REAL NOT NULL, accessed REAL NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_accessed ON entries (accessed)")
+            logger.info(f"✅ {self.name} cache on disk: {self.path}")
+        except Exception as e:
+            logger.error(f"❌ Unable to open {self.name} cache at {self.path}, using memory only: {e}")
+            self.path = None
+
+    def _disk_get(self, key: str, now: float):
+        if self.cipher:
+            key = self.cipher.name(key)
+        with self._connect() as conn:
+            row = conn.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, created = row
+            if self.ttl_seconds and now - created > self.ttl_seconds:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._count("evictions")
+                return None
+            conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+        # A wrong (rotated) key raises here and the entry is read as a miss
+        return self.cipher.decrypt_text(value) if self.cipher else value
+
+    def _disk_set(self, key: str, value: str, now: float):
+        if self.cipher:
+            key, value = self.cipher.name(key), self.cipher.encrypt_text(value)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            evicted = 0
+            if self.ttl_seconds:
+                evicted += conn.execute(
+                    "DELETE FROM entries WHERE created < ?", (now - self.ttl_seconds,)
+                ).rowcount
+            if self.max_disk_entries:
+                evicted += conn.execute(
+                    "DELETE FROM entries WHERE key IN ("
+                    " SELECT key FROM entries ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                    (self.max_disk_entries,)
+                ).rowcount
+            if evicted:
+                self._count("evictions", evicted)
+
+    # --- public API ------------------------------------------------------
+
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, value = entry
+                if self.ttl_seconds and now - created > self.ttl_seconds:
+                    del self._memory[key]
+                    self.counters["evictions"] += 1
+                else:
+                    self._memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return value
+
+        if self.path:
+            try:
+                value = self._disk_get(key, now)
+                if value is not None:
+                    self._count("disk_hits")
+                    self._remember(key, value, now)
+                    return value
+            except Exception as e:
+                self._count("errors")
+                logger.warning(f"⚠️ {self.name} cache read failed: {e}")
+
+        self._count("misses")
+        return None
+
+    def _remember(self, key: str, value: str, created: float):
+        with self._lock:
+            self._memory[key] = (created, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        self._remember(key, value, now)
+        self._count("stores")
+        if self.path:
+            try:
+                self._disk_set(key, value, now)
+            except Exception as e:
+                self._count("errors")
+                logger.warning(f"⚠️ {self.name} cache write failed: {e}")
+
+    def reject(self):
+        """Conta una risposta non memorizzata perché troncata o non valida."""
+        self._count("rejected")
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.counters)
+            stats["memory_entries"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_ratio"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 4) if lookups else 0.0
+        stats["disk_path"] = self.path
+        stats["encrypted"] = bool(self.cipher)
+        return stats
+
+
+_cache = None
+_cache_settings = None
+_cache_lock = threading.Lock()
+
+
+def get_llm_cache(config: dict):
+    """
+    Restituisce la cache delle risposte LLM del processo, o None se disattivata
+    (LLM_CACHE_ENABLED=false, o ENCRYPT_AT_REST senza chiave). Viene ricreata solo
+    se cambiano i parametri.
+    """
+    global _cache, _cache_settings
+    if not config.get("LLM_CACHE_ENABLED", True):
+        return None
+
+    settings = (
+        config.get("LLM_CACHE_DISK_PATH", DEFAULT_CACHE_PATH) or None,
+        int(config.get("LLM_CACHE_MEMORY_ENTRIES", 256)),
+        int(config.get("LLM_CACHE_DISK_MAX_ENTRIES", 5000)),
+        float(config.get("LLM_CACHE_TTL_SECONDS", 86400)),
+        encryption_settings(config),
+    )
+    with _cache_lock:
+        if settings != _cache_settings:
+            path, memory_entries, disk_entries, ttl, _ = settings
+            _cache_settings = settings
+            try:
+                _cache = TieredCache("LLM response", path, memory_entries, disk_entries, ttl,
+                                     get_storage_cipher(config))
+            except EncryptionUnavailable as e:
+                logger.error(f"❌ LLM response cache disabled, encryption requested but unavailable: {e}")
+                _cache = None
+        return _cache
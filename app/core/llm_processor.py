@@ -1,8 +1,24 @@
 import os
+import time
 import logging
+import threading
 import requests
 import json
 import sys
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+from app.core.llm_cache import get_llm_cache, make_cache_key, is_cache_bypassed
+from app.core.ollama_pool import get_ollama_pool
+from app.core.resilience import LLMRequestError, backoff_delay, get_circuit_breaker, get_call_stats
+from app.core.schema_validation import parse_stats
+from app.core.single_flight import get_single_flight
+from app.core.scheduler import BusyError, get_scheduler
+from app.core.metrics import record_llm_call, record_llm_outcome
+from app.core.token_budget import estimate_tokens
+from app.core.cascade import get_cascade_stats
+from app.core.document_cache import document_cache_stats
+from app.core.debug_artifacts import debug_artifact_stats
 
 logging.basicConfig(
     level=logging.INFO,
@@ -13,10 +29,18 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+CONFIG_PATH = "config.json"
+DEFAULT_POOL_SIZE = 10
+DEFAULT_KEEP_ALIVE = "30m"
+MAX_BACKENDS = 32
+
+# Runs the primary and the hedge copy of hedged requests
+_hedge_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm-hedge")
+
 # Carica i parametri dal file di configurazione
 def load_config():
     try:
-        with open("config.json", "r") as f:
+        with open(CONFIG_PATH, "r") as f:
             config = json.load(f)
         return config
     except Exception as e:
@@ -27,40 +51,461 @@ def load_config():
             "LLM_TEMPERATURE": 0.1
         }
 
+
+def _config_mtime():
+    try:
+        return os.path.getmtime(CONFIG_PATH)
+    except OSError:
+        return None
+
+
+def build_session(pool_size: int) -> requests.Session:
+    """
+    Crea una sessione HTTP con connessioni keep-alive verso Ollama.
+    `pool_size` limita le connessioni aperte per host (di solito = richieste concorrenti);
+    viene tenuto un pool per ciascun backend Ollama, fino a MAX_BACKENDS.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=MAX_BACKENDS, pool_maxsize=pool_size, pool_block=False)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def default_max_tokens(context_size: int) -> int:
+    return min(context_size - 512, context_size // 2)
+
+
+def cacheable_response(text: str, format_schema: dict = None, validate=None) -> bool:
+    """
+    Se una risposta di Ollama può andare in cache: non troncata (done_reason "length")
+    e, quando la chiamata chiede JSON (`format_schema`), con un JSON leggibile nel testo
+    generato. `validate(testo generato) -> bool` permette al chiamante di confermarla.
+    Una generazione sbagliata in cache verrebbe riproposta a ogni ricaricamento fino al TTL.
+    """
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return False
+    if not isinstance(data, dict) or data.get("done_reason") == "length":
+        return False
+    generated = data.get("response", "")
+    if format_schema is not None:
+        # Without structured output the JSON may be wrapped in prose: read from the first bracket
+        starts = [i for i in (generated.find("{"), generated.find("[")) if i != -1]
+        try:
+            json.JSONDecoder().raw_decode(generated, min(starts)) if starts else json.loads(generated)
+        except ValueError:
+            return False
+    return validate is None or bool(validate(generated))
+
+
+def parse_stage_profiles(raw: dict, model: str, context_size: int, connect_timeout: float = 5,
+                         read_timeout: float = 300) -> dict:
+    """
+    Normalizza LLM_STAGE_PROFILES: per ogni stage (features, matching, medications,
+    timeline, warmup) un profilo {"model", "context_size", "max_tokens", "connect_timeout",
+    "read_timeout"} oppure una lista di profili con "max_prompt_tokens", provati in ordine;
+    l'ultimo senza limite fa da fallback. I campi mancanti ereditano LLM_MODEL /
+    LLM_CONTEXT_SIZE / LLM_CONNECT_TIMEOUT / LLM_READ_TIMEOUT.
+    """
+    profiles = {}
+    for stage, rules in (raw or {}).items():
+        normalized = []
+        for rule in (rules if isinstance(rules, list) else [rules]):
+            ctx = int(rule.get("context_size") or context_size)
+            normalized.append({
+                "model": rule.get("model") or model,
+                "context_size": ctx,
+                "max_tokens": int(rule.get("max_tokens") or default_max_tokens(ctx)),
+                "max_prompt_tokens": rule.get("max_prompt_tokens"),
+                "connect_timeout": float(rule.get("connect_timeout") or connect_timeout),
+                "read_timeout": float(rule.get("read_timeout") or read_timeout),
+            })
+        if normalized:
+            profiles[stage] = normalized
+    return profiles
+
+
 class LLMProcessor:
-    def __init__(self):
-        config = load_config()
-        self.api_url = os.getenv("OLLAMA_SERVER_URL", "http://127.0.0.1:11434/api/generate")
+    def __init__(self, config=None, session=None):
+        config = config if config is not None else load_config()
+        self.config = config
         self.model = config.get("LLM_MODEL")
         self.context_size = config.get("LLM_CONTEXT_SIZE")
         self.temperature = config.get("LLM_TEMPERATURE")
-        self.max_tokens = min(self.context_size - 512, self.context_size // 2)
+        self.pool_size = int(config.get("LLM_POOL_SIZE", DEFAULT_POOL_SIZE))
+        # Keep the model (and its prompt cache) resident between requests
+        self.keep_alive = config.get("LLM_KEEP_ALIVE", DEFAULT_KEEP_ALIVE)
+        # Constrain outputs to the JSON schema passed by each stage (Ollama "format")
+        self.structured_output = bool(config.get("LLM_STRUCTURED_OUTPUT", True))
+        self.max_tokens = default_max_tokens(self.context_size)
+        self.connect_timeout = float(config.get("LLM_CONNECT_TIMEOUT", 5))
+        self.read_timeout = float(config.get("LLM_READ_TIMEOUT", 300))
+        # Per-stage model, context size, output cap and timeouts (e.g. a small model for medications)
+        self.stage_profiles = parse_stage_profiles(
+            config.get("LLM_STAGE_PROFILES", {}), self.model, self.context_size,
+            self.connect_timeout, self.read_timeout
+        )
+        self.session = session if session is not None else build_session(self.pool_size)
+        self.cache = get_llm_cache(config)
+        self.single_flight = get_single_flight(config)
+        self.pool = get_ollama_pool(config, self.session)
+        # A queued call may wait behind the slowest stage allowed
+        longest_read = max([self.read_timeout] + [rule["read_timeout"] for rules in self.stage_profiles.values()
+                                                  for rule in rules])
+        self.scheduler = get_scheduler(config, backend_count=len(self.pool.backends), min_wait_seconds=longest_read)
+        self.max_retries = int(config.get("LLM_MAX_RETRIES", 2))
+        self.backoff_base = float(config.get("LLM_BACKOFF_BASE", 0.5))
+        self.backoff_cap = float(config.get("LLM_BACKOFF_CAP", 8))
+        self.hedge_after = float(config.get("LLM_HEDGE_AFTER_SECONDS", 0))
+        self.breaker = get_circuit_breaker(
+            int(config.get("LLM_CIRCUIT_FAILURE_THRESHOLD", 5)),
+            float(config.get("LLM_CIRCUIT_RESET_SECONDS", 30)),
+        )
+        self.call_stats = get_call_stats()
 
-    def generate_response(self, prompt: str, temperature: float = None, max_tokens: int = None) -> str:
+    def resolve_profile(self, stage: str, prompt_tokens: int = None) -> dict:
+        """
+        Profilo (modello, contesto, limite di output) per `stage`. Con più regole si
+        usa la prima il cui max_prompt_tokens contiene il prompt; senza `prompt_tokens`
+        la prima regola. Gli stage senza profilo usano LLM_MODEL.
+        """
+        default = {"model": self.model, "context_size": self.context_size,
+                   "max_tokens": self.max_tokens, "max_prompt_tokens": None,
+                   "connect_timeout": self.connect_timeout, "read_timeout": self.read_timeout}
+        rules = self.stage_profiles.get(stage)
+        if not rules:
+            return default
+        if prompt_tokens is None:
+            return rules[0]
+        for rule in rules:
+            if rule["max_prompt_tokens"] is None or prompt_tokens <= rule["max_prompt_tokens"]:
+                return rule
+        # Longer than every rule allows: use the one with the largest context
+        return max(rules, key=lambda rule: rule["context_size"])
+
+    def stage_models(self) -> dict:
+        """Modelli configurati (LLM_MODEL e quelli dei profili per stage) con il loro num_ctx."""
+        models = {self.model: self.context_size}
+        for rules in self.stage_profiles.values():
+            for rule in rules:
+                models.setdefault(rule["model"], rule["context_size"])
+        return models
+
+    def generate_response(self, prompt: str, temperature: float = None, max_tokens: int = None,
+                          on_token=None, use_cache: bool = True, hedge: bool = False,
+                          format_schema: dict = None, stage: str = "other", validate=None) -> str:
+        """
+        Invia il prompt a Ollama e restituisce il corpo JSON grezzo della risposta.
+        Se `on_token` è passato la richiesta usa `stream: true` e la callback riceve
+        ogni frammento generato; il valore restituito ha comunque la stessa forma
+        della risposta non in streaming.
+        Le risposte sono servite dalla cache quando possibile; `use_cache=False`
+        (o `bypass_llm_cache()`) forza una nuova generazione. Vanno in cache solo le
+        risposte complete e leggibili (vedi cacheable_response, con `validate`).
+        `hedge=True` abilita le richieste "hedged" (vedi _hedged_call).
+        `format_schema` (JSON schema) vincola l'output tramite il parametro `format`
+        di Ollama, se LLM_STRUCTURED_OUTPUT è attivo.
+        `stage` (features, matching, medications, timeline) sceglie il profilo di
+        modello e i timeout in LLM_STAGE_PROFILES ed etichetta le metriche.
+        Restituisce "" se Ollama non risponde dopo tutti i tentativi.
+        """
         temperature = temperature if temperature is not None else self.temperature
-        max_tokens = max_tokens if max_tokens is not None else self.max_tokens
         try:
+            rules = self.stage_profiles.get(stage)
+            profile = self.resolve_profile(stage, estimate_tokens(prompt) if rules and len(rules) > 1 else None)
+            model = profile["model"]
+            max_tokens = max_tokens if max_tokens is not None else profile["max_tokens"]
+            timeout = (profile["connect_timeout"], profile["read_timeout"])
+            # Sampling parameters must go in "options": Ollama ignores them at top level,
+            # and a num_ctx that changes between calls forces a reload that drops the KV cache
             payload = {
-                "model": self.model,
+                "model": model,
                 "prompt": prompt,
-                "temperature": temperature,
-                "num_ctx": self.context_size,
-                "max_tokens": max_tokens,
-                "stream": False
+                "options": {
+                    "temperature": temperature,
+                    "num_ctx": profile["context_size"],
+                    "num_predict": max_tokens
+                },
+                "keep_alive": self.keep_alive,
+                "stream": on_token is not None
             }
-            # print(f"Sending request to Ollama API with payload: {payload}")
-            response = requests.post(self.api_url, json=payload)
-            print(f"Ollama API response status: {response.status_code}")
-            if response.status_code == 200:
-                # print(f"Ollama API response body (truncated): {response.text[:500]}")
-                return response.text
-            else:
-                logger.error(f"Non-200 response from Ollama API: {response.status_code} - {response.text}")
-                return ""
+            if format_schema is not None and self.structured_output:
+                payload["format"] = format_schema
+            cache = self.cache if use_cache and not is_cache_bypassed() else None
+            cache_key = make_cache_key(payload) if cache is not None else None
+            if cache is not None:
+                cached = cache.get(cache_key)
+                if cached:
+                    logger.info(f"⚡ LLM cache hit ({cache_key[:12]})")
+                    record_llm_outcome(stage, model, "cache_hit")
+                    if on_token is not None:
+                        on_token(json.loads(cached).get("response", ""))
+                    return cached
+
+            def generate():
+                # Waits for a slot of the caller's priority class (BusyError if the queue is full)
+                with self.scheduler.slot() as queue_wait:
+                    self.call_stats.incr("calls")
+                    started = time.perf_counter()
+                    text = self._send(payload, on_token, hedge=hedge, timeout=timeout)
+                    elapsed = time.perf_counter() - started
+                    self.call_stats.observe_latency(elapsed)
+                if text:
+                    if cache is not None:
+                        if cacheable_response(text, format_schema, validate):
+                            cache.set(cache_key, text)
+                        else:
+                            cache.reject()
+                            logger.warning(f"⚠️ [{stage}] Truncated or unreadable LLM response not cached "
+                                           f"({cache_key[:12]})")
+                    self._record_timings(text, stage, elapsed, queue_wait)
+                else:
+                    record_llm_outcome(stage, model, "error")
+                return text
+
+            if self.single_flight is None:
+                return generate()
+
+            # Identical prompts already in flight (this process or another worker) are awaited, not resent
+            text, shared = self.single_flight.do(cache_key or make_cache_key(payload), generate)
+            if shared and text and on_token is not None:
+                on_token(json.loads(text).get("response", ""))
+            return text
+        except BusyError:
+            raise
         except Exception as e:
             logger.error(f"Error contacting Ollama API: {e}")
             return ""
 
+    def _send(self, payload: dict, on_token=None, hedge: bool = False, timeout=None) -> str:
+        """
+        Esegue la chiamata con retry (backoff esponenziale con jitter, ogni retry su
+        un backend diverso quando possibile), dietro al circuit breaker condiviso.
+        `timeout`: (connect, read) del profilo dello stage; di default quelli globali.
+        Restituisce "" se tutti i tentativi falliscono o se il circuito è aperto.
+        """
+        if not self.breaker.allow():
+            self.call_stats.incr("short_circuited")
+            logger.error("❌ LLM circuit breaker open: failing fast without contacting Ollama")
+            return ""
+
+        timeout = timeout or (self.connect_timeout, self.read_timeout)
+        tried = []
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                delay = backoff_delay(attempt - 1, self.backoff_base, self.backoff_cap)
+                self.call_stats.incr("retries")
+                logger.warning(f"🔁 Retrying LLM call in {delay:.2f}s (attempt {attempt + 1}/{self.max_retries + 1})")
+                time.sleep(delay)
+
+            backend = self.pool.acquire(payload["model"], exclude=tried)
+            tried.append(backend)
+            try:
+                if hedge and on_token is None and self.hedge_after > 0:
+                    text = self._hedged_call(backend, payload, timeout)
+                else:
+                    text = self._call_backend(backend, payload, timeout, on_token)
+                self.breaker.record_success()
+                return text
+            except LLMRequestError as e:
+                logger.error(f"❌ LLM call failed on {backend.url}: {e}")
+                if not e.retryable:
+                    # The server answered (e.g. unknown model): it is up, retrying will not help
+                    self.breaker.record_success()
+                    return ""
+            except Exception:
+                # Anything else (malformed stream chunk, ...) still settles the breaker: an
+                # unsettled half-open probe would keep the circuit open for good
+                self.call_stats.incr("failures")
+                self.breaker.record_failure()
+                raise
+
+        self.call_stats.incr("failures")
+        self.breaker.record_failure()
+        return ""
+
+    def _call_backend(self, backend, payload: dict, timeout, on_token=None) -> str:
+        # The backend must already be leased with pool.acquire(); it is released here
+        success = False
+        self.call_stats.incr("attempts")
+        try:
+            response = self.session.post(backend.generate_url, json=payload,
+                                         stream=on_token is not None, timeout=timeout)
+            logger.debug(f"📡 Ollama API response status: {response.status_code} ({backend.url})")
+            if response.status_code == 200:
+                if on_token is not None:
+                    text = self._collect_stream(response, on_token)
+                else:
+                    text = response.text
+                success = True
+                return text
+            retryable = response.status_code >= 500 or response.status_code == 429
+            raise LLMRequestError(f"HTTP {response.status_code} - {response.text[:500]}", retryable=retryable)
+        except requests.exceptions.Timeout as e:
+            self.call_stats.incr("timeouts")
+            raise LLMRequestError(f"timeout ({e})")
+        except requests.exceptions.RequestException as e:
+            raise LLMRequestError(str(e))
+        finally:
+            self.pool.release(backend, success, model=payload.get("model"))
+
+    def _hedged_call(self, backend, payload: dict, timeout) -> str:
+        """
+        Invia la richiesta a `backend`; se dopo LLM_HEDGE_AFTER_SECONDS non ha ancora
+        risposto, ne invia una copia a un altro backend sano e usa la prima risposta
+        valida. La richiesta perdente non può essere annullata e termina in background.
+        """
+        primary = _hedge_executor.submit(self._call_backend, backend, payload, timeout)
+        done, _ = wait([primary], timeout=self.hedge_after)
+        others = [b for b in self.pool.healthy_backends() if b is not backend]
+        if done or not others:
+            return primary.result()
+
+        hedge_backend = self.pool.acquire(payload["model"], exclude=[backend])
+        self.call_stats.incr("hedges_launched")
+        logger.info(f"🪝 Hedging slow LLM call on {backend.url} with {hedge_backend.url}")
+        hedge = _hedge_executor.submit(self._call_backend, hedge_backend, payload, timeout)
+
+        pending = {primary, hedge}
+        last_error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    text = future.result()
+                except LLMRequestError as e:
+                    last_error = e
+                    continue
+                if future is hedge:
+                    self.call_stats.incr("hedges_won")
+                return text
+        raise last_error
+
+    def _record_timings(self, text: str, stage: str, elapsed: float, queue_wait: float):
+        # prompt_eval_count drops when Ollama reuses a cached prompt prefix
+        try:
+            data = json.loads(text)
+            record_llm_call(stage, data.get("model") or "unknown", data, elapsed, queue_wait)
+            logger.info(
+                f"🧮 [{stage}] Prompt eval: {data.get('prompt_eval_count')} tokens in "
+                f"{(data.get('prompt_eval_duration') or 0) / 1e9:.2f}s, "
+                f"generated {data.get('eval_count')} tokens in {(data.get('eval_duration') or 0) / 1e9:.2f}s, "
+                f"queued {queue_wait:.2f}s"
+            )
+        except Exception as e:
+            logger.debug(f"Unable to record Ollama timings: {e}")
+
+    @staticmethod
+    def _collect_stream(response, on_token) -> str:
+        # Ollama invia un oggetto JSON per riga; l'ultimo ha done=true e le statistiche
+        fragments = []
+        final = {}
+        with response:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                fragment = chunk.get("response", "")
+                if fragment:
+                    fragments.append(fragment)
+                    try:
+                        on_token(fragment)
+                    except Exception as e:
+                        logger.warning(f"⚠️ Token callback failed: {e}")
+                if chunk.get("done"):
+                    final = chunk
+        final["response"] = "".join(fragments)
+        return json.dumps(final)
+
+    def connection_stats(self) -> dict:
+        """
+        Contatori del pool HTTP: richieste inviate, connessioni TCP aperte e quante
+        richieste hanno riutilizzato una connessione già aperta.
+        """
+        requests_sent = 0
+        connections_opened = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_sent += pool.num_requests
+                connections_opened += pool.num_connections
+        return {
+            "pid": os.getpid(),
+            "pool_size": self.pool_size,
+            "requests": requests_sent,
+            "connections_opened": connections_opened,
+            "connections_reused": max(requests_sent - connections_opened, 0),
+        }
+
+
+# Processore condiviso dal processo (un'istanza per worker gunicorn)
+_processor = None
+_processor_mtime = None
+_processor_lock = threading.Lock()
+
 
 def get_llm_processor():
-    return LLMProcessor()
\ No newline at end of file
+    """
+    Restituisce il processore condiviso, thread-safe. Viene ricostruito solo quando
+    config.json cambia su disco; la sessione HTTP (e le sue connessioni) viene
+    mantenuta finché la dimensione del pool resta la stessa.
+    """
+    global _processor, _processor_mtime
+    mtime = _config_mtime()
+    processor = _processor
+    if processor is not None and mtime == _processor_mtime:
+        return processor
+
+    with _processor_lock:
+        if _processor is not None and mtime == _processor_mtime:
+            return _processor
+
+        config = load_config()
+        session = None
+        if _processor is not None and _processor.pool_size == int(config.get("LLM_POOL_SIZE", DEFAULT_POOL_SIZE)):
+            session = _processor.session
+        _processor = LLMProcessor(config=config, session=session)
+        _processor_mtime = mtime
+        logger.info(f"✅ LLM processor ready (model={_processor.model}, pool_size={_processor.pool_size})")
+        return _processor
+
+
+def get_config() -> dict:
+    """
+    Configurazione corrente senza rileggere config.json: è quella del processore
+    condiviso, ricaricata solo quando il file cambia su disco. Da usare nei percorsi
+    caldi al posto di load_config(); il dizionario è condiviso e non va modificato.
+    """
+    return get_llm_processor().config
+
+
+def submit_with_context(executor, fn, *args, **kwargs):
+    """
+    Come executor.submit, ma il task gira con una copia del contesto corrente
+    (contextvars), così impostazioni per-richiesta come bypass_llm_cache()
+    valgono anche nei thread del pool.
+    """
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def get_llm_stats() -> dict:
+    processor = get_llm_processor()
+    config = processor.config
+    return {
+        "connection_pool": processor.connection_stats(),
+        "backends": processor.pool.stats(),
+        "calls": processor.call_stats.stats(),
+        "circuit_breaker": processor.breaker.stats(),
+        "scheduler": processor.scheduler.stats(),
+        "single_flight": processor.single_flight.stats() if processor.single_flight else None,
+        "parse": parse_stats(),
+        "matching_cascade": get_cascade_stats().stats(),
+        "response_cache": processor.cache.stats() if processor.cache is not None else {"enabled": False},
+        "document_cache": document_cache_stats(config),
+        "debug_artifacts": debug_artifact_stats(config),
+    }
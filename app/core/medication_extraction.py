@@ -1,61 +1,95 @@
-import os
-import json
-import time
-import logging
-from typing import Union
-from app import logger
-from app.core.llm_processor import get_llm_processor
-from app.core.feature_extraction import extract_text_from_pdf
-
-# Ensure the logs folder exists
-os.makedirs("logs", exist_ok=True)
-
-def extract_medications_from_pdf(pdf_file: Union[str, bytes]):
-    try:
-        text = extract_text_from_pdf(pdf_file)
-        return extract_medications(text)
-    except Exception as e:
-        logger.error(f"❌ Error reading PDF for medication extraction: {str(e)}")
-        return {}
-
-def extract_medications(text: str):
-    llm = get_llm_processor()
-
-    prompt = f"""You are a medical assistant. Extract medications with dosage, frequency, and indication. Output JSON format ONLY:
-
-[
-  {{
-    "medication": "Name",
-    "dosage": "e.g., 10 mg",
-    "frequency": "e.g., twice daily",
-    "indication": "Reason prescribed"
-  }},
-  ...
-]
-
-Text:
-{text}
-"""
-    logger.info(f"Prompt sent to LLM (medication):\n{prompt[:2000]}")
-
-    try:
-        response = llm.generate_response(prompt)
-        logger.info(f"🧠 LLM Medication Response: {response[:1000]}")
-
-        filename = f"logs/llm_medication_debug_{int(time.time())}.json"
-        with open(filename, "w") as f:
-            json.dump({"prompt": prompt, "response": response}, f, indent=2)
-
-        resp_json = json.loads(response)
-        llm_text = json.loads(resp_json['response']) if isinstance(resp_json['response'], str) else resp_json['response']
-
-        if not isinstance(llm_text, list):
-            logger.error(f"❌ LLM medication output is not a list: {llm_text}")
-            return []
-
-        logger.info(f"✅ Extracted Medication Features: {json.dumps(llm_text, indent=2)}")
-        return llm_text
-
-    except Exception as e:
-        logger.exception("❌ Medication LLM parsing failed")
-        return []
+import os
+import json
+import logging
+from typing import Union
+from app import logger
+from app.core.llm_processor import get_llm_processor
+from app.core.scheduler import BusyError
+from app.core.schema_validation import MedicationList, ollama_format_schema, record_parse
+from app.core.pdf_extraction import extract_text_from_pdf
+from app.core import drug_normalization
+from app.core.document_cache import cached_document_result, code_version
+from app.core.debug_artifacts import write_debug_artifact
+from app.core.drug_normalization import annotate_drug_names, drug_normalization_version, normalize_medications
+
+# Ensure the logs folder exists
+os.makedirs("logs", exist_ok=True)
+
+def extract_medications_from_pdf(pdf_file: Union[str, bytes]):
+    try:
+        text = extract_text_from_pdf(pdf_file)
+        return extract_medications(text)
+    except BusyError:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error reading PDF for medication extraction: {str(e)}")
+        return {}
+
+MEDICATION_EXTRACTION_PROMPT = """You are a medical assistant. Extract medications with dosage, frequency, and indication. Output JSON format ONLY:
+
+{
+  "medications": [
+    {
+      "medication": "Name",
+      "dosage": "e.g., 10 mg",
+      "frequency": "e.g., twice daily",
+      "indication": "Reason prescribed"
+    },
+    ...
+  ]
+}
+"""
+
+def build_medication_prompt(text: str) -> str:
+    return f"{MEDICATION_EXTRACTION_PROMPT}\nText:\n{annotate_drug_names(text)}\n"
+
+def extract_medications(text: str, prompt: str = None):
+    """Estrae i farmaci da `text`; `prompt` sostituisce il prompt standard (es. estrazione combinata)."""
+    if prompt is None:
+        # Re-opened documents are served from the document cache without any LLM call
+        return cached_document_result(
+            "medications", text,
+            [MEDICATION_EXTRACTION_PROMPT, ollama_format_schema(MedicationList), drug_normalization_version(),
+             code_version(build_medication_prompt, extract_medications, drug_normalization)],
+            lambda: extract_medications(text, prompt=build_medication_prompt(text)),
+        )
+    llm = get_llm_processor()
+
+    logger.info(f"Prompt sent to LLM (medication):\n{prompt[:2000]}")
+
+    try:
+        response = llm.generate_response(
+            prompt, format_schema=ollama_format_schema(MedicationList), stage="medications"
+        )
+        logger.info(f"🧠 LLM Medication Response: {response[:1000]}")
+        if not response:
+            logger.error("❌ Empty response from LLM (medication)")
+            return []
+
+        write_debug_artifact("medications", {"prompt": prompt, "response": response})
+
+        resp_json = json.loads(response)
+        llm_text = json.loads(resp_json['response']) if isinstance(resp_json['response'], str) else resp_json['response']
+        if isinstance(llm_text, dict):
+            llm_text = llm_text.get("medications")
+
+        if not isinstance(llm_text, list):
+            record_parse("medications", llm.structured_output, False)
+            logger.error(f"❌ LLM medication output is not a list: {llm_text}")
+            return []
+
+        record_parse("medications", llm.structured_output, True)
+        llm_text = normalize_medications(llm_text)
+
+        logger.info(f"✅ Extracted Medication Features: {json.dumps(llm_text, indent=2)}")
+        return llm_text
+
+    except json.JSONDecodeError:
+        record_parse("medications", llm.structured_output, False)
+        logger.exception("❌ Medication LLM parsing failed")
+        return []
+    except BusyError:
+        raise
+    except Exception as e:
+        logger.exception("❌ Medication LLM parsing failed")
+        return []
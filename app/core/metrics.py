@@ -0,0 +1,202 @@
+import math
+import threading
+from bisect import bisect_left
+from typing import Dict, Tuple
+
+# Prometheus text exposition format, without an extra dependency. Metrics are
+# per process: with several gunicorn workers each one exposes its own values.
+
+PREFIX = "medmatchint_llm"
+
+TOKEN_RATE_BUCKETS = (1, 2.5, 5, 10, 20, 40, 80, 160, 320, 640, 1280, 2560)
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160, 320)
+TOKEN_COUNT_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = labels
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_labels(self.label_names, key)} {_number(value)}"
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...], buckets: Tuple[float, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = labels
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # [per-bucket counts, sum, count]
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def total(self, **labels) -> float:
+        """Somma dei valori osservati nelle serie che hanno le etichette indicate."""
+        positions = [(self.label_names.index(name), str(value)) for name, value in labels.items()]
+        with self._lock:
+            return sum(series[1] for key, series in self._series.items()
+                       if all(key[index] == value for index, value in positions))
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            items = sorted((key, ([*counts], total, count)) for key, (counts, total, count) in self._series.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_number(bound)}"'
+                yield f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.label_names, key)} {_number(round(total, 6))}"
+            yield f"{self.name}_count{_labels(self.label_names, key)} {count}"
+
+
+LABELS = ("stage", "model")
+
+llm_requests = Counter(f"{PREFIX}_requests_total",
+                       "LLM calls by stage, model and outcome (ok, error, cache_hit).", LABELS + ("outcome",))
+prompt_tokens = Counter(f"{PREFIX}_prompt_tokens_total",
+                        "Prompt tokens evaluated by Ollama (prompt_eval_count).", LABELS)
+generated_tokens = Counter(f"{PREFIX}_generated_tokens_total",
+                           "Tokens generated by Ollama (eval_count).", LABELS)
+prompt_tokens_per_call = Histogram(f"{PREFIX}_prompt_tokens",
+                                   "Prompt tokens evaluated per call.", LABELS, TOKEN_COUNT_BUCKETS)
+generated_tokens_per_call = Histogram(f"{PREFIX}_generated_tokens",
+                                      "Tokens generated per call.", LABELS, TOKEN_COUNT_BUCKETS)
+prompt_eval_rate = Histogram(f"{PREFIX}_prompt_eval_tokens_per_second",
+                             "Prompt evaluation throughput per call.", LABELS, TOKEN_RATE_BUCKETS)
+generation_rate = Histogram(f"{PREFIX}_generation_tokens_per_second",
+                            "Generation throughput per call.", LABELS, TOKEN_RATE_BUCKETS)
+load_seconds = Histogram(f"{PREFIX}_load_seconds",
+                         "Model load time reported by Ollama (load_duration).", LABELS, SECONDS_BUCKETS)
+server_seconds = Histogram(f"{PREFIX}_server_seconds",
+                           "Time spent inside Ollama per call (total_duration).", LABELS, SECONDS_BUCKETS)
+request_seconds = Histogram(f"{PREFIX}_request_seconds",
+                            "Wall-clock time of the HTTP call to Ollama, retries included.", LABELS, SECONDS_BUCKETS)
+queue_seconds = Histogram(f"{PREFIX}_queue_seconds",
+                          "Time waiting for a free slot in the local scheduler.", LABELS, SECONDS_BUCKETS)
+server_queue_seconds = Histogram(f"{PREFIX}_server_queue_seconds",
+                                 "Wall-clock time not accounted for by total_duration: queueing inside "
+                                 "Ollama plus network.", LABELS, SECONDS_BUCKETS)
+cascade_trials = Counter(f"{PREFIX}_cascade_trials_total",
+                         "Trials screened by the small matching model, by outcome "
+                         "(accepted, escalated_uncertain, escalated_malformed).", ("outcome",))
+pdf_documents = Counter(f"{PREFIX}_pdf_documents_total",
+                        "PDFs whose text was extracted, by mode (serial, parallel).", ("mode",))
+pdf_page_seconds = Histogram(f"{PREFIX}_pdf_page_seconds",
+                             "Text extraction time per PDF page, by mode and extractor (pdfminer, "
+                             "pdfplumber).", ("mode", "extractor"), SECONDS_BUCKETS)
+pdf_fallback_pages = Counter(f"{PREFIX}_pdf_fallback_pages_total",
+                             "Pages re-extracted with pdfplumber because the fast text looked broken, "
+                             "by reason (garbage, density, spacing, error).", ("reason",))
+
+REGISTRY = (
+    llm_requests, prompt_tokens, generated_tokens, prompt_tokens_per_call, generated_tokens_per_call,
+    prompt_eval_rate, generation_rate, load_seconds, server_seconds, request_seconds,
+    queue_seconds, server_queue_seconds, cascade_trials, pdf_documents, pdf_page_seconds,
+    pdf_fallback_pages,
+)
+
+
+def record_llm_call(stage: str, model: str, stats: dict, wall_seconds: float, queue_wait: float):
+    """
+    Registra una chiamata completata. `stats` è la risposta di Ollama
+    (total_duration, load_duration, prompt_eval_count/duration, eval_count/duration,
+    in nanosecondi); `wall_seconds` il tempo della chiamata HTTP e `queue_wait`
+    l'attesa nello scheduler locale.
+    """
+    labels = {"stage": stage, "model": model}
+    llm_requests.inc(stage=stage, model=model, outcome="ok")
+    request_seconds.observe(wall_seconds, **labels)
+    queue_seconds.observe(queue_wait, **labels)
+
+    prompt_count = stats.get("prompt_eval_count") or 0
+    prompt_duration = (stats.get("prompt_eval_duration") or 0) / 1e9
+    eval_count = stats.get("eval_count") or 0
+    eval_duration = (stats.get("eval_duration") or 0) / 1e9
+    total_duration = (stats.get("total_duration") or 0) / 1e9
+
+    prompt_tokens.inc(prompt_count, **labels)
+    generated_tokens.inc(eval_count, **labels)
+    prompt_tokens_per_call.observe(prompt_count, **labels)
+    generated_tokens_per_call.observe(eval_count, **labels)
+    if prompt_count and prompt_duration > 0:
+        prompt_eval_rate.observe(prompt_count / prompt_duration, **labels)
+    if eval_count and eval_duration > 0:
+        generation_rate.observe(eval_count / eval_duration, **labels)
+    if stats.get("load_duration") is not None:
+        load_seconds.observe(stats["load_duration"] / 1e9, **labels)
+    if total_duration > 0:
+        server_seconds.observe(total_duration, **labels)
+        server_queue_seconds.observe(max(wall_seconds - total_duration, 0.0), **labels)
+
+
+def record_llm_outcome(stage: str, model: str, outcome: str):
+    llm_requests.inc(stage=stage, model=model, outcome=outcome)
+
+
+def scheduler_gauges(scheduler_stats: dict):
+    """Righe gauge con lo stato corrente dello scheduler (slot occupati e code per classe)."""
+    yield f"# HELP {PREFIX}_scheduler_running LLM calls currently holding a scheduler slot."
+    yield f"# TYPE {PREFIX}_scheduler_running gauge"
+    for name, cls in scheduler_stats["classes"].items():
+        yield f'{PREFIX}_scheduler_running{{priority="{name}"}} {cls["running"]}'
+    yield f"# HELP {PREFIX}_scheduler_queued LLM calls waiting for a scheduler slot."
+    yield f"# TYPE {PREFIX}_scheduler_queued gauge"
+    for name, cls in scheduler_stats["classes"].items():
+        yield f'{PREFIX}_scheduler_queued{{priority="{name}"}} {cls["queued"]}'
+    yield f"# HELP {PREFIX}_scheduler_slots Scheduler slots (maximum concurrent LLM calls)."
+    yield f"# TYPE {PREFIX}_scheduler_slots gauge"
+    yield f"{PREFIX}_scheduler_slots {scheduler_stats['max_concurrency']}"
+
+
+def render_metrics(extra_lines=()) -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    lines.extend(extra_lines)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,224 @@
+import os
+import time
+import logging
+import threading
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OLLAMA_URL = "http://127.0.0.1:11434/api/generate"
+
+
+def normalize_base_url(url: str) -> str:
+    """Accetta sia l'URL base (http://host:11434) sia l'endpoint completo /api/generate."""
+    url = url.strip().rstrip("/")
+    for suffix in ("/api/generate", "/api/chat", "/api"):
+        if url.endswith(suffix):
+            return url[: -len(suffix)]
+    return url
+
+
+def configured_backend_urls(config: dict) -> List[str]:
+    """
+    Elenco dei backend Ollama, in ordine di priorità:
+    OLLAMA_SERVER_URLS (env, separati da virgola) → "OLLAMA_SERVERS" in config.json
+    → OLLAMA_SERVER_URL (env, singolo server, comportamento storico).
+    """
+    urls = os.getenv("OLLAMA_SERVER_URLS", "")
+    if urls.strip():
+        candidates = urls.split(",")
+    elif config.get("OLLAMA_SERVERS"):
+        candidates = config["OLLAMA_SERVERS"]
+    else:
+        candidates = [os.getenv("OLLAMA_SERVER_URL", DEFAULT_OLLAMA_URL)]
+    seen = []
+    for url in candidates:
+        base = normalize_base_url(url)
+        if base and base not in seen:
+            seen.append(base)
+    return seen
+
+
+def _model_names(model: str):
+    # "llama3.1" and "llama3.1:latest" are the same model for Ollama
+    return {model, f"{model}:latest"} if model and ":" not in model else {model}
+
+
+class OllamaBackend:
+    def __init__(self, url: str):
+        self.url = url
+        self.generate_url = f"{url}/api/generate"
+        self.outstanding = 0
+        self.healthy = True
+        self.loaded_models = set()
+        self.consecutive_failures = 0
+        self.ejected_at = None
+        self.last_probe = None
+        self.probe_latency = None
+        self.requests = 0
+        self.failures = 0
+
+    def snapshot(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "loaded_models": sorted(self.loaded_models),
+            "consecutive_failures": self.consecutive_failures,
+            "requests": self.requests,
+            "failures": self.failures,
+            "last_probe": self.last_probe,
+            "probe_latency": self.probe_latency,
+        }
+
+
+class OllamaPool:
+    """
+    Pool di backend Ollama con health check periodici e routing
+    "least outstanding requests". Le richieste vanno preferibilmente ai backend
+    che hanno già il modello caricato in memoria (/api/ps); un backend viene
+    escluso dopo `failure_threshold` errori consecutivi e riammesso al primo
+    health check o alla prima chiamata riusciti.
+    """
+
+    def __init__(self, urls: List[str], session, probe_interval: float = 15.0,
+                 failure_threshold: int = 3, probe_timeout: float = 2.0):
+        self.backends = [OllamaBackend(url) for url in urls]
+        self.session = session
+        self.probe_interval = probe_interval
+        self.failure_threshold = failure_threshold
+        self.probe_timeout = probe_timeout
+        self._lock = threading.Lock()
+        self._rotation = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    # --- health checks ---------------------------------------------------
+
+    def start(self):
+        """Avvia il thread di health check (disattivato con probe_interval <= 0)."""
+        if self._thread is not None or self.probe_interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._probe_loop, name="ollama-health", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _probe_loop(self):
+        while not self._stop.is_set():
+            self.probe_all()
+            self._stop.wait(self.probe_interval)
+
+    def probe(self, backend: OllamaBackend) -> bool:
+        started = time.perf_counter()
+        try:
+            response = self.session.get(f"{backend.url}/api/ps", timeout=self.probe_timeout)
+            response.raise_for_status()
+            models = set()
+            for entry in response.json().get("models", []):
+                models.update(name for name in (entry.get("name"), entry.get("model")) if name)
+            with self._lock:
+                backend.loaded_models = models
+                backend.probe_latency = round(time.perf_counter() - started, 4)
+                backend.last_probe = time.time()
+                if not backend.healthy:
+                    logger.info(f"✅ Ollama backend {backend.url} re-admitted")
+                backend.healthy = True
+                backend.consecutive_failures = 0
+                backend.ejected_at = None
+            return True
+        except Exception as e:
+            with self._lock:
+                backend.last_probe = time.time()
+            logger.warning(f"⚠️ Health check failed for {backend.url}: {e}")
+            self._record_failure(backend)
+            return False
+
+    def probe_all(self):
+        for backend in self.backends:
+            self.probe(backend)
+
+    def _record_failure(self, backend: OllamaBackend):
+        with self._lock:
+            backend.consecutive_failures += 1
+            if backend.healthy and backend.consecutive_failures >= self.failure_threshold:
+                backend.healthy = False
+                backend.ejected_at = time.time()
+                logger.error(f"❌ Ollama backend {backend.url} ejected after "
+                             f"{backend.consecutive_failures} consecutive failures")
+
+    # --- routing ---------------------------------------------------------
+
+    def acquire(self, model: str, exclude=()) -> OllamaBackend:
+        """
+        Sceglie un backend per `model` e ne incrementa le richieste in corso.
+        Va sempre seguito da release(). Se nessun backend è sano si prova comunque
+        quello con meno richieste in corso, invece di fallire subito.
+        """
+        names = _model_names(model)
+        with self._lock:
+            candidates = [b for b in self.backends if b.healthy and b not in exclude]
+            warm = [b for b in candidates if b.loaded_models & names]
+            pool = warm or candidates or [b for b in self.backends if b not in exclude] or self.backends
+            # Rotate the starting point so ties are spread evenly across backends
+            offset = self._rotation % len(pool)
+            self._rotation += 1
+            rotated = pool[offset:] + pool[:offset]
+            backend = min(rotated, key=lambda b: b.outstanding)
+            backend.outstanding += 1
+            backend.requests += 1
+            return backend
+
+    def release(self, backend: OllamaBackend, success: bool, model: Optional[str] = None):
+        with self._lock:
+            backend.outstanding = max(backend.outstanding - 1, 0)
+            if success:
+                if not backend.healthy:
+                    # It answered through the fallback path: no need to wait for a health check
+                    logger.info(f"✅ Ollama backend {backend.url} re-admitted after a successful call")
+                backend.healthy = True
+                backend.consecutive_failures = 0
+                backend.ejected_at = None
+                if model:
+                    # A successful generation means the model is now resident there
+                    backend.loaded_models.add(model)
+        if not success:
+            with self._lock:
+                backend.failures += 1
+            self._record_failure(backend)
+
+    def healthy_backends(self) -> List[OllamaBackend]:
+        with self._lock:
+            return [b for b in self.backends if b.healthy]
+
+    def stats(self) -> List[dict]:
+        with self._lock:
+            return [b.snapshot() for b in self.backends]
+
+
+_pool = None
+_pool_settings = None
+_pool_lock = threading.Lock()
+
+
+def get_ollama_pool(config: dict, session) -> OllamaPool:
+    """Pool condiviso dal processo; ricreato se cambiano i backend o i parametri."""
+    global _pool, _pool_settings
+    urls = configured_backend_urls(config)
+    settings = (
+        tuple(urls),
+        float(config.get("OLLAMA_HEALTH_CHECK_INTERVAL", 15)),
+        int(config.get("OLLAMA_FAILURE_THRESHOLD", 3)),
+        id(session),
+    )
+    with _pool_lock:
+        if _pool is None or settings != _pool_settings:
+            if _pool is not None:
+                _pool.stop()
+            _pool = OllamaPool(urls, session, probe_interval=settings[1], failure_threshold=settings[2])
+            # Also with a single backend: /ready reads the resident models from these probes
+            _pool.start()
+            _pool_settings = settings
+            logger.info(f"✅ Ollama backends: {', '.join(urls)}")
+        return _pool
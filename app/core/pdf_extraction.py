@@ -0,0 +1,156 @@
+import os
+import math
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Tuple
+
+from app.core.metrics import pdf_documents, pdf_fallback_pages, pdf_page_seconds
+# Page readers live in a top-level module with no `app` imports: the pool processes load
+# only that module (see _pool_context)
+from pdf_workers import EXTRACTORS, PageText, PdfSource, extract_page_range, page_count
+
+logger = logging.getLogger(__name__)
+
+
+def _load_source(pdf_file) -> PdfSource:
+    """Percorso o contenuto del PDF: gli stream vengono letti una volta sola (non si scrive su disco)."""
+    if isinstance(pdf_file, (str, os.PathLike)):
+        return os.fspath(pdf_file)
+    if isinstance(pdf_file, (bytes, bytearray)):
+        return bytes(pdf_file)
+    return pdf_file.read()
+
+
+def page_ranges(count: int, workers: int, pages_per_task: int) -> List[Tuple[int, int]]:
+    """Intervalli di pagine per i task: non più di `pages_per_task`, abbastanza da occupare tutti i worker."""
+    size = max(1, min(pages_per_task, math.ceil(count / max(workers, 1))))
+    return [(start, min(start + size, count)) for start in range(0, count, size)]
+
+
+_pool = None
+_pool_workers = None
+_pool_lock = threading.Lock()
+
+
+def _pool_context():
+    # A plain fork would copy the app's threads and locks into the children, and spawn
+    # re-runs main.py (create_app) in each of them. The fork server starts from a clean
+    # interpreter, preloads only pdf_workers (pdfminer and pdfplumber, not the `app`
+    # package: importing this module would create the Flask app in every process) and
+    # forks the workers from it.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["pdf_workers"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+def get_pdf_pool(workers: int) -> ProcessPoolExecutor:
+    """Process pool persistente del processo (ricreato se cambia il numero di worker o si rompe)."""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=_pool_context())
+            _pool_workers = workers
+            logger.info(f"🧵 PDF extraction pool started with {workers} process(es)")
+        return _pool
+
+
+def _discard_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def pdf_settings(config: Dict[str, Any] = None) -> Dict[str, Any]:
+    if config is None:
+        from app.core.llm_processor import get_config
+        config = get_config()
+    workers = int(config.get("PDF_EXTRACTION_WORKERS", 0)) or min(4, os.cpu_count() or 1)
+    extractor = config.get("PDF_EXTRACTOR", "auto")
+    if extractor not in EXTRACTORS:
+        logger.warning(f"⚠️ Unknown PDF_EXTRACTOR '{extractor}', using 'auto' ({', '.join(EXTRACTORS)})")
+        extractor = "auto"
+    return {
+        "workers": workers,
+        "min_pages": int(config.get("PDF_PARALLEL_MIN_PAGES", 16)),
+        "pages_per_task": int(config.get("PDF_PAGES_PER_TASK", 8)),
+        "extractor": extractor,
+    }
+
+
+def _extract_parallel(source: PdfSource, count: int, settings: Dict[str, Any]) -> List[PageText]:
+    pool = get_pdf_pool(settings["workers"])
+    ranges = page_ranges(count, settings["workers"], settings["pages_per_task"])
+    try:
+        futures = [pool.submit(extract_page_range, source, start, end, settings["extractor"])
+                   for start, end in ranges]
+        # Reassembled in page order, whatever order the tasks finish in
+        return [page for future in futures for page in future.result()]
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        raise
+
+
+def extract_pdf_pages(pdf_file, config: Dict[str, Any] = None, parallel: bool = None,
+                      extractor: str = None) -> List[Dict[str, Any]]:
+    """
+    Testo di ogni pagina del PDF: [{"page", "text", "seconds", "extractor", "fallback"}]
+    in ordine di pagina. L'estrattore è PDF_EXTRACTOR (o `extractor`): "auto" usa il
+    percorso veloce di pdfminer e rilegge con pdfplumber solo le pagine rotte.
+    Sopra PDF_PARALLEL_MIN_PAGES pagine gli intervalli di pagine vanno al process pool
+    (l'estrazione è CPU-bound e tiene il GIL); sotto, o con un solo worker, il percorso
+    seriale evita il costo di inviare il documento ai processi. `parallel` forza la scelta.
+    """
+    settings = pdf_settings(config)
+    if extractor is not None:
+        settings["extractor"] = extractor
+    source = _load_source(pdf_file)
+    started = time.perf_counter()
+    count = page_count(source)
+    if parallel is None:
+        parallel = count >= settings["min_pages"] and settings["workers"] > 1
+    mode = "serial"
+    if parallel:
+        try:
+            pages = _extract_parallel(source, count, settings)
+            mode = "parallel"
+        except BrokenProcessPool as e:
+            logger.warning(f"⚠️ PDF extraction pool failed ({e}), extracting serially")
+            parallel = False
+    if not parallel:
+        pages = extract_page_range(source, 0, count, settings["extractor"])
+
+    elapsed = time.perf_counter() - started
+    pdf_documents.inc(mode=mode)
+    for page in pages:
+        pdf_page_seconds.observe(page.seconds, mode=mode, extractor=page.extractor)
+        if page.fallback:
+            pdf_fallback_pages.inc(reason=page.fallback)
+    if pages:
+        slowest = max(range(len(pages)), key=lambda index: pages[index].seconds)
+        fallbacks = sum(1 for page in pages if page.fallback)
+        logger.info(f"📄 Extracted {len(pages)} page(s) in {elapsed:.2f}s ({mode}, {settings['extractor']}"
+                    f"{f', {fallbacks} page(s) re-read with pdfplumber' if fallbacks else ''}); "
+                    f"page time {sum(page.seconds for page in pages):.2f}s, slowest page {slowest + 1}: "
+                    f"{pages[slowest].seconds:.2f}s")
+    return [{"page": index + 1, "text": page.text, "seconds": round(page.seconds, 4),
+             "extractor": page.extractor, "fallback": page.fallback}
+            for index, page in enumerate(pages)]
+
+
+def extract_text_from_pdf(pdf_file, config: Dict[str, Any] = None) -> str:
+    """Testo del PDF (percorso, bytes o stream), pagine separate da un a capo."""
+    try:
+        return "\n".join(page["text"] for page in extract_pdf_pages(pdf_file, config)).strip()
+    except Exception as e:
+        logger.error(f"Error extracting text from PDF: {str(e)}")
+        raise Exception(f"Unable to extract text from PDF: {str(e)}")
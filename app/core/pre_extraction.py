@@ -0,0 +1,308 @@
+import re
+import logging
+from typing import Dict, Any, List
+
+from app.core.schema_validation import ClinicalFeatures
+
+logger = logging.getLogger(__name__)
+
+NOT_MENTIONED = "not mentioned"
+FEATURE_FIELDS = list(ClinicalFeatures.model_fields)
+
+# Vocabolari dal prompt di estrazione: valore canonico → varianti (italiano/inglese)
+BIOMARKER_TERMS = {
+    "KRAS_G12C": r"(?:KRAS\W{1,3})?p?\.?G12C",
+    "KRAS_Q61H": r"(?:KRAS\W{1,3})?p?\.?Q61H",
+    "EGFR_exon19_del": r"(?:exon|esone)\s*19\s*del\w*|del\w*\s+(?:dell['’]\s*)?(?:exon|esone)\s*19|ex19del",
+    "EGFR_L858R": r"(?:EGFR\W{1,3})?p?\.?L858R",
+    "EGFR_T790M": r"(?:EGFR\W{1,3})?p?\.?T790M",
+    "EGFR_L861Q": r"(?:EGFR\W{1,3})?p?\.?L861Q",
+    "EGFR_P772R": r"(?:EGFR\W{1,3})?p?\.?P772R",
+    "MET_amplification": r"MET\s+(?:amplification|amplificat\w*|amp)\b|amplificazione\s+(?:di\s+|del\s+)?MET",
+    "MET_exon14": r"MET\W{1,3}(?:\w+\s+){0,2}?(?:exon|esone)\s*14|(?:exon|esone)\s*14\s+(?:skipping\s+)?(?:di\s+)?MET",
+    "HER2_exon20": r"(?:HER2|ERBB2)\W{1,3}(?:\w+\s+){0,2}?(?:exon|esone)\s*20",
+    "BRAF_V600E": r"(?:BRAF\W{1,3})?p?\.?V600E",
+    "ALK": r"ALK",
+    "ROS1": r"ROS-?1",
+    "RET": r"RET",
+    "NTRK": r"NTRK[1-3]?",
+    "STK11": r"STK11",
+    "TP53": r"TP53",
+    "DNMT3A": r"DNMT3A",
+}
+
+# Gene names without a resolvable variant: the text talks about biomarkers, the LLM decides
+BIOMARKER_GENES = r"EGFR|KRAS|MET|HER2|ERBB2|BRAF|NGS"
+
+DRUG_TERMS = {
+    "carboplatin": r"carboplatin[oa]?",
+    "cisplatin": r"cisplatin[oa]?",
+    "etoposide": r"etoposide?",
+    "pemetrexed": r"pemetrexed",
+    "paclitaxel": r"(?:nab-?)?paclitaxel|taxolo",
+    "docetaxel": r"docetaxel",
+    "pembrolizumab": r"pembrolizumab|keytruda",
+    "nivolumab": r"nivolumab|opdivo",
+    "atezolizumab": r"atezolizumab|tecentriq",
+    "durvalumab": r"durvalumab|imfinzi",
+    "osimertinib": r"osimertinib|tagrisso",
+    "erlotinib": r"erlotinib|tarceva",
+    "gefitinib": r"gefitinib|iressa",
+    "sotorasib": r"sotorasib|lumykras",
+    "adagrasib": r"adagrasib",
+    "divarasib": r"divarasib",
+    "savolitinib": r"savolitinib",
+    "alectinib": r"alectinib|alecensa",
+    "crizotinib": r"crizotinib|xalkori",
+}
+
+# Generic mentions of systemic treatment: therapies may be named without a known drug
+THERAPY_CUES = r"chemio\w*|immunoterap\w*|chemotherap\w*|immunotherap\w*|sali\s+di\s+platino|platino|platinum|TKI"
+
+HISTOLOGY_TERMS = {
+    # "non a piccole cellule" / NSCLC come first so they are not read as small cell
+    "nsclc": r"non[- ]a[- ]piccole[- ]cellule|non[- ]small[- ]cell|NSCLC",
+    "adenocarcinoma": r"adenocarcinoma|adenoca",
+    "squamous": r"squamos[oa]|squamous|spinocellular[ei]|epidermoide",
+    "small_cell": r"microcitom[ao]|(?:carcinoma\s+)?a\s+piccole\s+cellule|small[- ]cell|SCLC",
+}
+
+BRAIN_TERMS = (
+    r"(?:metastas[ie]|secondarism[io]|lesion[ie]|localizzazion[ie])\s+(?:\w+\s+){0,2}?"
+    r"(?:cerebral[ie]|encefalic[hae]+|endocranic[hae]+|cerebellar[ie])"
+    r"|(?:brain|CNS|SNC)\s+metasta\w+|metasta\w+\s+(?:to\s+the\s+)?brain"
+)
+
+VALUE_TERMS = {
+    "age": r"(?P<age_noun>paziente|pz\.?|uomo|donna|signor[ae]?|sig\.r?a?)\s+(?:\w+\s+){0,3}?di\s+(?P<age>\d{2,3})\s*anni"
+           r"|(?:età|age)\s*[:=]?\s*(?P<age_label>\d{2,3})"
+           r"|(?P<age_en>\d{2,3})[\s-]*(?:year|yr)s?[\s-]*old",
+    # "Uomo/donna di N anni" is matched by the age pattern, which also records the gender
+    "gender": r"sesso\s*[:=]?\s*(?P<sex>maschile|femminile|M|F)\b"
+              r"|\d{2,3}[\s-]*(?:year|yr)s?[\s-]*old\s+(?P<sex_en>man|woman|male|female)",
+    # A range ("ECOG 0-1") is not a single value: left to the LLM
+    "ecog_ps": r"(?:ECOG(?:\s*-?\s*PS)?|PS\s*ECOG)\s*[:=]?\s*(?P<ecog>[0-4])\b(?!\s*[-–/]\s*\d)",
+    "current_stage": r"(?:stadi[oa]|stage)\s*(?:clinico\s*)?:?\s*c?(?P<stage>IV|III|II|I)[ABC]?\d?",
+    # The percentage must be in the same list item, before any other marker ("PD-L1 negativo,
+    # KRAS G12C 34%", "PD-L1 22C3 e Ki67 30%")
+    "pd_l1_tps": rf"PD-?L1(?:(?!\b(?:{BIOMARKER_GENES}|ALK|ROS-?1|RET|NTRK|Ki-?67)\b)[^.\n;,]){{0,40}}?"
+                 r"(?P<pdl1_cmp>[<>≥≤]=?)?\s*(?P<pdl1>\d{1,3}(?:[.,]\d+)?)\s*%",
+}
+
+# Checked first: "non valutabile", "non si escludono" are not negations
+UNCERTAINTY_CUES = re.compile(
+    r"\b(?:in\s+attesa|attes[oi]|richiest[oaie]|da\s+(?:eseguire|definire|(?:ri)?valutare|ripetere)|pending|"
+    r"awaited|requested|non\s+(?:valutabil|eseguit|determinabil|conclusiv)\w*|not\s+(?:evaluable|assessable|"
+    r"performed|done)|inadeguat\w*|insufficient\w*|indeterminat\w*|equivoc\w*|dubbi\w*|sospett\w*|"
+    r"suspect\w*|possibil\w*|possible|probabil\w*|probable|verosimil\w*|"
+    r"non\s+(?:si\s+)?(?:pu[oò]\s+)?esclud\w*|(?:cannot|can't)\s+be\s+(?:excluded|ruled\s+out)|not\s+excluded)\b",
+    re.IGNORECASE,
+)
+
+NEGATION_CUES = re.compile(
+    r"\b(?:negativ\w*|negative\s+for|wild[- ]?type|wt|assen\w+|senza|without|no|nessun\w*|esclu[ds]\w*|"
+    r"non(?![- ]a[- ]piccole|[- ]small))\b",
+    re.IGNORECASE,
+)
+
+# A gene name alone ("ALK", "ROS1") is not a result: it needs one of these in its clause
+POSITIVE_CUES = re.compile(
+    r"\b(?:mutat\w*|mutazion\w*|mutation\w*|mutant|riarrangiat\w*|riarrangiament\w*|rearrange\w*|"
+    r"positiv\w*|fusion\w*|fusione|traslocat\w*|traslocazion\w*|translocat\w*|amplificat\w*|"
+    r"amplification|alterat\w*|alterazion\w*|variant\w*)\b|^\W{0,2}\+",
+    re.IGNORECASE,
+)
+
+# Biomarker values that name a gene only; the others are themselves a variant token (L858R, G12C, ...)
+GENE_ONLY_BIOMARKERS = {"ALK", "ROS1", "RET", "NTRK", "STK11", "TP53", "DNMT3A"}
+
+# One term per named group; value patterns carry their own inner groups
+_TERMS = {}
+
+
+def _add_terms(field: str, terms: Dict[str, str]):
+    for canonical, pattern in terms.items():
+        _TERMS[f"t{len(_TERMS)}"] = (field, canonical, pattern)
+
+
+_add_terms("biomarkers", BIOMARKER_TERMS)
+_add_terms("biomarker_gene", {"gene": BIOMARKER_GENES})
+_add_terms("prior_systemic_therapies", DRUG_TERMS)
+_add_terms("therapy_cue", {"therapy": THERAPY_CUES})
+_add_terms("histology", HISTOLOGY_TERMS)
+_add_terms("brain_metastasis", {"brain": BRAIN_TERMS})
+for _field, _pattern in VALUE_TERMS.items():
+    _add_terms(_field, {None: _pattern})
+
+# Single pass over the text: all vocabularies and value patterns in one compiled alternation.
+# The shared word-start anchor lets the engine skip most positions without trying every
+# alternative (about 5x faster than a per-term \b). Value patterns sit in a lookahead, so
+# they match without consuming the text: terms inside their span ("PD-L1 ... KRAS G12C")
+# are still found.
+COMBINED_PATTERN = re.compile(
+    r"\b(?=\w)(?:" + "|".join(
+        rf"(?P<{name}>(?:{pattern})\b)" if field not in VALUE_TERMS else rf"(?=(?P<{name}>(?:{pattern})))"
+        for name, (field, _, pattern) in _TERMS.items()
+    ) + ")",
+    re.IGNORECASE,
+)
+
+# Changes to the vocabularies or patterns change this, invalidating cached document results
+PRE_EXTRACTION_VERSION = (COMBINED_PATTERN.pattern + UNCERTAINTY_CUES.pattern + NEGATION_CUES.pattern
+                          + POSITIVE_CUES.pattern)
+
+
+def _clause(text: str, start: int, end: int, separators: str = ".;\n"):
+    # The clause around a match: bounded by `separators`, at most 60 characters each side
+    left = max([text.rfind(sep, 0, start) for sep in separators] + [start - 60])
+    right = min([i for i in (text.find(sep, end) for sep in separators) if i != -1] + [end + 60])
+    return text[left + 1:start], text[end:right]
+
+
+def _finding(text: str, span, after: int = None, separators: str = ".;\n"):
+    """
+    Esito della menzione in `span` dal contesto nella sua frase: "uncertain" (in attesa,
+    sospetto, non valutabile), "negative", "positive" (cue esplicito) o None (solo citata).
+    `after`: caratteri della frase dopo la menzione da considerare (None = tutta).
+    """
+    before, following = _clause(text, span[0], span[1], separators)
+    if after is not None:
+        following = following[:after]
+    if UNCERTAINTY_CUES.search(before) or UNCERTAINTY_CUES.search(following):
+        return "uncertain"
+    if NEGATION_CUES.search(before) or NEGATION_CUES.search(following):
+        return "negative"
+    if POSITIVE_CUES.search(before) or POSITIVE_CUES.search(following):
+        return "positive"
+    return None
+
+
+def pdl1_bucket(comparator: str, value: str):
+    number = float(value.replace(",", "."))
+    comparator = (comparator or "").replace("≤", "<=").replace("≥", ">=")
+    if comparator.startswith("<"):
+        return "<1%" if number <= 1 else None
+    if comparator.startswith(">"):
+        return ">=50%" if number >= 50 else None
+    if number == 0:
+        return "0%"
+    if number < 1:
+        return "<1%"
+    return "1-49%" if number < 50 else ">=50%"
+
+
+def _value(field: str, match):
+    if field == "age":
+        age = int(match.group("age") or match.group("age_label") or match.group("age_en"))
+        return age if 18 <= age <= 120 else None
+    if field == "gender":
+        word = (match.group("sex") or match.group("sex_en")).lower()
+        return "female" if word in ("femminile", "f", "donna", "woman", "female") else "male"
+    if field == "ecog_ps":
+        return int(match.group("ecog"))
+    if field == "current_stage":
+        return match.group("stage").upper()
+    if field == "pd_l1_tps":
+        return pdl1_bucket(match.group("pdl1_cmp"), match.group("pdl1"))
+    return None
+
+
+def _single(values: List[Any], allowed=None):
+    # High confidence = every mention agrees (and the value is in the schema)
+    distinct = set(values)
+    if len(distinct) != 1 or None in distinct:
+        return None
+    value = distinct.pop()
+    return value if allowed is None or value in allowed else None
+
+
+def pre_extract(text: str) -> Dict[str, Any]:
+    """
+    Pre-estrazione deterministica con un solo passaggio della regex combinata.
+    Compila solo i campi ad alta confidenza (tutte le menzioni concordi, nessuna
+    ambiguità) e lascia gli altri all'LLM.
+    Restituisce {"features": campi risolti, "residual": campi da chiedere all'LLM,
+    "evidence": testo che ha deciso ogni campo}.
+    """
+    hits = {}
+    for match in COMBINED_PATTERN.finditer(text):
+        field, canonical, _ = _TERMS[match.lastgroup]
+        span, matched = match.span(match.lastgroup), match.group(match.lastgroup)
+        if field in VALUE_TERMS:
+            canonical = _value(field, match)
+            # "PD-L1 non espresso (TPS 1%)", "ECOG 2 da rivalutare": the value is not a result.
+            # The clause is read from the start of the match, so cues inside it count too
+            if _finding(text, (span[0], span[0]), separators=".;\n,") in ("uncertain", "negative"):
+                canonical = None
+        elif field == "biomarkers":
+            # Lists of results ("ALK non riarrangiato, EGFR L858R"): each item is its own clause
+            finding = _finding(text, span, after=25, separators=".;\n,")
+            if finding is None and canonical not in GENE_ONLY_BIOMARKERS:
+                finding = "positive"  # the variant itself is the result
+            canonical = (canonical, finding)
+        elif field == "brain_metastasis":
+            canonical = _finding(text, span) or "positive"
+        hits.setdefault(field, []).append((canonical, matched))
+        noun = match.group("age_noun") if field == "age" else None
+        if noun and noun.lower() not in ("paziente", "pz", "pz."):
+            gender = "female" if noun.lower() in ("donna", "signora", "sig.ra") else "male"
+            hits.setdefault("gender", []).append((gender, matched))
+
+    features, evidence = {}, {}
+
+    def resolve(field, value, matched):
+        if value is not None:
+            features[field] = value
+            evidence[field] = matched
+
+    for field, allowed in (("age", None), ("gender", None), ("ecog_ps", {0, 1, 2}),
+                           ("current_stage", {"II", "III", "IV"}), ("pd_l1_tps", None)):
+        if field in hits:
+            resolve(field, _single([value for value, _ in hits[field]], allowed), [m for _, m in hits[field]])
+
+    histologies = [value for value, _ in hits.get("histology", []) if value != "nsclc"]
+    if histologies:
+        resolve("histology", _single(histologies), [m for _, m in hits["histology"]])
+
+    # Pending, unclear or bare gene mentions ("in attesa di esito ALK") go to the LLM
+    biomarkers = hits.get("biomarkers", [])
+    positive = {canonical for (canonical, finding), _ in biomarkers if finding == "positive"}
+    unclear = any(finding in ("uncertain", None) for (_, finding), _ in biomarkers)
+    if len(positive) == 1 and not unclear:
+        resolve("biomarkers", positive.pop(), [m for _, m in biomarkers])
+    elif not positive and not unclear and "biomarker_gene" not in hits:
+        # No variant and no gene name at all, or only negative results
+        resolve("biomarkers", NOT_MENTIONED, [m for _, m in biomarkers])
+
+    # Brain metastases are only set locally when every mention is a plain positive finding:
+    # negated, doubtful or mixed reports (which CT is the latest?) are left to the LLM
+    brain = [value for value, _ in hits.get("brain_metastasis", [])]
+    if brain and all(value == "positive" for value in brain):
+        resolve("brain_metastasis", ["true"], [m for _, m in hits["brain_metastasis"]])
+
+    # Named drugs may be planned rather than given: only the absence of any therapy is certain
+    if "prior_systemic_therapies" not in hits and "therapy_cue" not in hits:
+        resolve("prior_systemic_therapies", [NOT_MENTIONED], [])
+
+    residual = [field for field in FEATURE_FIELDS if field not in features]
+    logger.info(f"⚡ Pre-extraction resolved {len(features)}/{len(FEATURE_FIELDS)} fields, "
+                f"LLM needed for: {', '.join(residual) or 'none'}")
+    return {"features": features, "residual": residual, "evidence": evidence}
+
+
+def vocabulary_matches(text: str, field: str) -> List[str]:
+    """Valori canonici del vocabolario di `field` citati in `text`, in ordine e senza duplicati."""
+    values = []
+    for match in COMBINED_PATTERN.finditer(text or ""):
+        term_field, canonical, _ = _TERMS[match.lastgroup]
+        if term_field == field and canonical not in values:
+            values.append(canonical)
+    return values
+
+
+def merge_features(llm_features: Dict[str, Any], local_features: Dict[str, Any]) -> Dict[str, Any]:
+    """Unisce i campi dell'LLM e quelli pre-estratti (che prevalgono) nell'ordine dello schema."""
+    return {
+        field: local_features.get(field, llm_features.get(field, NOT_MENTIONED))
+        for field in FEATURE_FIELDS
+    }
@@ -0,0 +1,142 @@
+import time
+import random
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class LLMRequestError(Exception):
+    """Errore di una singola chiamata a Ollama; `retryable` indica se ha senso riprovare."""
+
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Exponential backoff con "full jitter": attesa casuale in [0, min(cap, base * 2^attempt)]."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker a tre stati. Dopo `failure_threshold` chiamate fallite di fila
+    il circuito si apre e le chiamate falliscono subito; passati `reset_timeout`
+    secondi una sola chiamata di prova (half-open) decide se richiuderlo.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.times_opened = 0
+        self.short_circuited = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.short_circuited += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("✅ LLM circuit breaker closed")
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or (
+                self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold
+            ):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+                logger.error(f"❌ LLM circuit breaker opened after {self.consecutive_failures} failures; "
+                             f"failing fast for {self.reset_timeout}s")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "times_opened": self.times_opened,
+                "short_circuited": self.short_circuited,
+            }
+
+
+class CallStats:
+    """Contatori delle chiamate a Ollama e percentili di latenza sulle ultime N chiamate."""
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self.counters = {
+            "calls": 0,
+            "attempts": 0,
+            "retries": 0,
+            "timeouts": 0,
+            "failures": 0,
+            "short_circuited": 0,
+            "hedges_launched": 0,
+            "hedges_won": 0,
+        }
+
+    def incr(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def observe_latency(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.counters)
+            latencies = sorted(self._latencies)
+        if latencies:
+            def percentile(p):
+                return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 3)
+            stats["latency_seconds"] = {
+                "p50": percentile(0.50),
+                "p95": percentile(0.95),
+                "p99": percentile(0.99),
+                "max": round(latencies[-1], 3),
+                "samples": len(latencies),
+            }
+        return stats
+
+
+_breaker = CircuitBreaker()
+_call_stats = CallStats()
+
+
+def get_circuit_breaker(failure_threshold: int, reset_timeout: float) -> CircuitBreaker:
+    """Circuit breaker condiviso dal processo; le soglie seguono config.json."""
+    _breaker.failure_threshold = failure_threshold
+    _breaker.reset_timeout = reset_timeout
+    return _breaker
+
+
+def get_call_stats() -> CallStats:
+    return _call_stats
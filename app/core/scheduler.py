@@ -0,0 +1,242 @@
+import os
+import time
+import logging
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = "interactive"
+STANDARD = "standard"
+BATCH = "batch"
+
+# From most to least urgent
+PRIORITY_CLASSES = (INTERACTIVE, STANDARD, BATCH)
+
+# weight: share of the free slots a class gets when several classes are waiting
+# max_concurrency: slots a class may hold at once (None = all of them)
+# max_queue: waiting calls before new ones are rejected as busy
+# max_wait_seconds: how long a call may wait for a slot before giving up as busy. The
+# defaults are raised to LLM_READ_TIMEOUT (see get_scheduler): a queued call waits for a
+# call in flight, which may legitimately take that long
+DEFAULT_CLASSES = {
+    INTERACTIVE: {"weight": 8, "max_concurrency": None, "max_queue": 64, "max_wait_seconds": 60},
+    STANDARD: {"weight": 3, "max_concurrency": None, "max_queue": 64, "max_wait_seconds": 180},
+    BATCH: {"weight": 1, "max_concurrency": None, "max_queue": 256, "max_wait_seconds": 900},
+}
+
+_priority = contextvars.ContextVar("llm_priority", default=STANDARD)
+
+
+class BusyError(Exception):
+    """La coda LLM della classe richiesta è piena o l'attesa ha superato il limite."""
+
+    def __init__(self, priority: str, reason: str, retry_after: int = 5):
+        super().__init__(f"LLM service busy ({priority}): {reason}")
+        self.priority = priority
+        self.retry_after = retry_after
+
+
+@contextmanager
+def llm_priority(priority: str):
+    """Imposta la classe di priorità delle chiamate LLM eseguite nel blocco."""
+    if priority not in PRIORITY_CLASSES:
+        raise ValueError(f"Unknown LLM priority class '{priority}'")
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> str:
+    return _priority.get()
+
+
+class _Ticket:
+    def __init__(self, priority: str):
+        self.priority = priority
+        self.enqueued = time.perf_counter()
+        self.granted = threading.Event()
+
+
+class _PriorityClass:
+    def __init__(self, name: str, weight: float, max_concurrency, max_queue: int, max_wait_seconds: float):
+        self.name = name
+        self.weight = max(float(weight), 0.001)
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait_seconds = max_wait_seconds
+        self.waiting = deque()
+        self.running = 0
+        # Stride scheduling: the eligible class with the lowest pass value goes next
+        self.pass_value = 0.0
+        self.waits = deque(maxlen=1000)
+        self.counters = {"admitted": 0, "rejected": 0, "timed_out": 0}
+
+    def snapshot(self) -> dict:
+        stats = {
+            "weight": self.weight,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "queued": len(self.waiting),
+            "running": self.running,
+            **self.counters,
+        }
+        waits = sorted(self.waits)
+        if waits:
+            def percentile(p):
+                return round(waits[min(len(waits) - 1, int(p * len(waits)))], 3)
+            stats["queue_wait_seconds"] = {
+                "p50": percentile(0.50),
+                "p95": percentile(0.95),
+                "p99": percentile(0.99),
+                "max": round(waits[-1], 3),
+                "samples": len(waits),
+            }
+        return stats
+
+
+class LLMScheduler:
+    """
+    Scheduler delle chiamate a Ollama con classi di priorità.
+    Al massimo `max_concurrency` chiamate sono in corso insieme; quando si libera
+    uno slot viene servita la classe in attesa con il "pass" più basso (stride
+    scheduling pesato), così le richieste interattive passano avanti senza
+    affamare i batch. Ogni classe ha un limite di slot e una coda limitata: a
+    coda piena, o dopo `max_wait_seconds` di attesa, la chiamata fallisce subito
+    con BusyError.
+    """
+
+    def __init__(self, max_concurrency: int, classes: dict, min_wait_seconds: float = 0):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.classes = {}
+        for name in PRIORITY_CLASSES:
+            settings = {**DEFAULT_CLASSES[name], **classes.get(name, {})}
+            if "max_wait_seconds" not in classes.get(name, {}):
+                # Only the built-in limits are raised; an explicit override is kept as is
+                settings["max_wait_seconds"] = max(settings["max_wait_seconds"], min_wait_seconds)
+            limit = settings["max_concurrency"]
+            self.classes[name] = _PriorityClass(
+                name,
+                settings["weight"],
+                min(int(limit), self.max_concurrency) if limit else self.max_concurrency,
+                int(settings["max_queue"]),
+                float(settings["max_wait_seconds"]),
+            )
+        self.running = 0
+        self._lock = threading.Lock()
+
+    def _dispatch(self):
+        # Called with the lock held: hand free slots to waiting tickets
+        while self.running < self.max_concurrency:
+            eligible = [
+                cls for cls in self.classes.values()
+                if cls.waiting and cls.running < cls.max_concurrency
+            ]
+            if not eligible:
+                return
+            cls = min(eligible, key=lambda c: (c.pass_value, PRIORITY_CLASSES.index(c.name)))
+            ticket = cls.waiting.popleft()
+            cls.pass_value += 1.0 / cls.weight
+            cls.running += 1
+            self.running += 1
+            ticket.granted.set()
+
+    def acquire(self, priority: str) -> float:
+        """Attende uno slot per la classe `priority`; restituisce i secondi di attesa."""
+        cls = self.classes[priority]
+        ticket = _Ticket(priority)
+        with self._lock:
+            if len(cls.waiting) >= cls.max_queue:
+                cls.counters["rejected"] += 1
+                raise BusyError(priority, f"{len(cls.waiting)} calls already queued")
+            if not cls.waiting and cls.running == 0:
+                # A class returning from idle starts level with the active ones, so it
+                # cannot bank credit while it had nothing to do
+                active = [c.pass_value for c in self.classes.values() if c.waiting or c.running]
+                if active:
+                    cls.pass_value = max(cls.pass_value, min(active))
+            cls.waiting.append(ticket)
+            self._dispatch()
+
+        if not ticket.granted.wait(cls.max_wait_seconds):
+            with self._lock:
+                if not ticket.granted.is_set():
+                    cls.waiting.remove(ticket)
+                    cls.counters["timed_out"] += 1
+                    raise BusyError(priority, f"no free slot after {cls.max_wait_seconds:.0f}s",
+                                    retry_after=int(cls.max_wait_seconds // 4) or 1)
+
+        waited = time.perf_counter() - ticket.enqueued
+        with self._lock:
+            cls.counters["admitted"] += 1
+            cls.waits.append(waited)
+        if waited > 1:
+            logger.info(f"⏳ LLM call ({priority}) waited {waited:.2f}s for a slot")
+        return waited
+
+    def release(self, priority: str):
+        with self._lock:
+            self.classes[priority].running -= 1
+            self.running -= 1
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, priority: str = None):
+        """Blocco eseguito con uno slot della classe `priority` (default: quella del contesto)."""
+        priority = priority or current_priority()
+        waited = self.acquire(priority)
+        try:
+            yield waited
+        finally:
+            self.release(priority)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "running": self.running,
+                "classes": {name: cls.snapshot() for name, cls in self.classes.items()},
+            }
+
+
+_scheduler = None
+_scheduler_settings = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler(config: dict, backend_count: int = 1, min_wait_seconds: float = None) -> LLMScheduler:
+    """
+    Scheduler condiviso dal processo. LLM_SCHEDULER_MAX_CONCURRENCY = 0 (default)
+    significa OLLAMA_NUM_PARALLEL slot per ogni backend configurato. Le attese massime
+    predefinite delle classi sono almeno `min_wait_seconds` (default LLM_READ_TIMEOUT).
+    """
+    global _scheduler, _scheduler_settings
+    max_concurrency = int(config.get("LLM_SCHEDULER_MAX_CONCURRENCY", 0) or 0)
+    if max_concurrency <= 0:
+        try:
+            per_backend = max(1, int(os.getenv("OLLAMA_NUM_PARALLEL", 1)))
+        except ValueError:
+            per_backend = 1
+        max_concurrency = per_backend * max(1, backend_count)
+
+    classes = config.get("LLM_SCHEDULER_CLASSES", {}) or {}
+    min_wait = float(min_wait_seconds if min_wait_seconds is not None else config.get("LLM_READ_TIMEOUT", 300))
+    settings = (max_concurrency, repr(sorted(classes.items())), min_wait)
+    with _scheduler_lock:
+        if _scheduler is None or settings != _scheduler_settings:
+            _scheduler = LLMScheduler(max_concurrency, classes, min_wait_seconds=min_wait)
+            _scheduler_settings = settings
+            logger.info(f"✅ LLM scheduler: {max_concurrency} concurrent calls")
+            matching = config.get("TRIAL_MATCHING_CONCURRENCY", os.getenv("OLLAMA_NUM_PARALLEL", 1))
+            try:
+                if int(matching) > max_concurrency:
+                    logger.warning(f"⚠️ TRIAL_MATCHING_CONCURRENCY={matching} is above the {max_concurrency} "
+                                   f"scheduler slots: the extra batches wait in the scheduler queue "
+                                   f"(raise OLLAMA_NUM_PARALLEL or LLM_SCHEDULER_MAX_CONCURRENCY)")
+            except (TypeError, ValueError):
+                pass
+        return _scheduler
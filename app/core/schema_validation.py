@@ -1,124 +1,189 @@
-# from pydantic import BaseModel, Field, validator, ValidationError
-# from typing import Optional, List, Dict
-
-# class ClinicalFeatures(BaseModel):
-#     age: Optional[int] = Field(None, ge=0, le=120)
-#     gender: Optional[str] = Field(None, pattern=r"^(male|female|not mentioned)$")
-#     diagnosis: Optional[str] = Field(None, pattern=r"^(NSCLC|SCLC|other|not mentioned)$")
-#     stage: Optional[str] = Field(None, pattern=r"^(I|II|III|IV|not mentioned)$")
-#     ecog: Optional[str] = Field(None, pattern=r"^(0|1|2|3|4|not mentioned)$")
-#     mutations: List[str] = []
-#     metastases: List[str] = []
-#     previous_treatments: List[str] = []
-#     lab_values: Dict[str, str] = {}
-
-#     @validator("gender", "diagnosis", "stage", "ecog", pre=True, always=True)
-#     def null_or_valid(cls, v):
-#         if v is None or v == "null":
-#             return "not mentioned"
-#         return v
-
-#     @validator("mutations", "metastases", "previous_treatments", pre=True, always=True)
-#     def ensure_list(cls, v):
-#         return v if isinstance(v, list) else []
-
-#     @validator("lab_values", pre=True, always=True)
-#     def ensure_dict(cls, v):
-#         return v if isinstance(v, dict) else {}
-from pydantic import BaseModel, Field, validator, ValidationError
-from typing import Optional, List, ClassVar
-
-class ClinicalFeatures(BaseModel):
-    age: Optional[int] = Field(None, ge=0, le=120, description="Age of the patient as an integer or null")
-    
-    gender: str = Field(
-        ...,
-        pattern=r"^(male|female|not mentioned)$",
-        description="Gender of the patient"
-    )
-    
-    diagnosis: str = Field(
-        ...,
-        pattern=r"^(NSCLC|SCLC|adenocarcinoma|squamous cell lung cancer|other|not mentioned)$",
-        description="Diagnosis of the patient"
-    )
-    
-    stage: str = Field(
-        ...,
-        pattern=r"^(I|II|III|IV|not mentioned)$",
-        description="Cancer stage of the patient"
-    )
-    
-    ecog_ps: str = Field(
-        ...,
-        pattern=r"^(0|1|2|3|4|not mentioned)$",
-        description="ECOG Performance Status"
-    )
-    
-    mutations: List[str] = Field(
-        default_factory=list,
-        description="List of detected genetic mutations (strictly controlled)"
-    )
-    
-    metastases: List[str] = Field(
-        default_factory=list,
-        description="List of metastasis locations (strictly controlled)"
-    )
-    
-    previous_treatments: List[str] = Field(
-        default_factory=list,
-        description="List of previous treatments (strictly controlled)"
-    )
-    
-    PD_L1: str = Field(
-        ...,
-        pattern=r"^(<1%|1-49%|>50%|not mentioned)$",
-        description="PD-L1 expression level"
-    )
-
-    # Allowed values as Class Variables (not fields)
-    ALLOWED_MUTATIONS: ClassVar[set] = {
-        "EGFR", "ALK", "ROS1", "BRAF V600E", "KRAS", "HER2", 
-        "PD-L1", "NTRK", "RET", "MET", "not mentioned"
-    }
-    
-    ALLOWED_METASTASES: ClassVar[set] = {
-        "brain", "liver", "bone", "lymph nodes", "adrenal", 
-        "peritoneal", "pleural", "skin", "not mentioned"
-    }
-    
-    ALLOWED_TREATMENTS: ClassVar[set] = {
-        "chemotherapy", "radiation", "surgery", "immunotherapy", 
-        "carboplatin", "cisplatin", "paclitaxel", "docetaxel", 
-        "pembrolizumab", "nivolumab", "atezolizumab", "durvalumab", 
-        "osimertinib", "erlotinib", "gefitinib", "crizotinib", 
-        "alectinib", "not mentioned"
-    }
-
-    @validator("mutations", pre=True, always=True)
-    def validate_mutations(cls, value):
-        if not isinstance(value, list):
-            raise ValueError("Mutations must be a list.")
-        for mutation in value:
-            if mutation not in cls.ALLOWED_MUTATIONS:
-                raise ValueError(f"Invalid mutation: {mutation}. Allowed values are: {cls.ALLOWED_MUTATIONS}")
-        return value if value else ["not mentioned"]
-
-    @validator("metastases", pre=True, always=True)
-    def validate_metastases(cls, value):
-        if not isinstance(value, list):
-            raise ValueError("Metastases must be a list.")
-        for metastasis in value:
-            if metastasis not in cls.ALLOWED_METASTASES:
-                raise ValueError(f"Invalid metastasis: {metastasis}. Allowed values are: {cls.ALLOWED_METASTASES}")
-        return value if value else ["not mentioned"]
-
-    @validator("previous_treatments", pre=True, always=True)
-    def validate_treatments(cls, value):
-        if not isinstance(value, list):
-            raise ValueError("Previous treatments must be a list.")
-        for treatment in value:
-            if treatment not in cls.ALLOWED_TREATMENTS:
-                raise ValueError(f"Invalid treatment: {treatment}. Allowed values are: {cls.ALLOWED_TREATMENTS}")
-        return value if value else ["not mentioned"]
-
+import copy
+import threading
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, ValidationError
+from typing import Optional, List, Literal, Union, Annotated, Dict, Any
+
+NOT_MENTIONED = "not mentioned"
+
+# Allowed values, kept identical to the schema in the extraction prompt
+Histology = Literal["squamous", "adenocarcinoma", "small_cell", "not mentioned"]
+Stage = Literal["II", "III", "IV", "not mentioned"]
+LineOfTherapy = Literal["1L", "2L", ">=3L", "adjuvant", "neoadjuvant", "maintenance", "not mentioned"]
+PDL1 = Literal["0%", "<1%", "1-49%", ">=50%", "not mentioned"]
+Biomarker = Literal[
+    "KRAS_G12C", "EGFR_exon19_del", "EGFR_L858R", "EGFR_T790M", "EGFR_L861Q", "EGFR_P772R",
+    "MET_amplification", "MET_exon14", "HER2_exon20", "ALK", "ROS1", "RET", "NTRK", "BRAF_V600E",
+    "STK11", "TP53", "DNMT3A", "KRAS_Q61H", "not mentioned"
+]
+SystemicTherapy = Literal[
+    "carboplatin", "cisplatin", "etoposide", "pemetrexed", "paclitaxel", "docetaxel",
+    "pembrolizumab", "nivolumab", "atezolizumab", "durvalumab", "osimertinib", "erlotinib",
+    "gefitinib", "sotorasib", "adagrasib", "divarasib", "savolitinib", "alectinib", "crizotinib",
+    "other", "not mentioned"
+]
+
+
+class ClinicalFeatures(BaseModel):
+    """Feature cliniche estratte da extract_features_with_llm (stesso schema del prompt)."""
+    model_config = ConfigDict(extra="ignore")
+
+    age: Union[Annotated[int, Field(ge=0, le=120)], Literal["not mentioned"]] = Field(
+        ..., description="Age of the patient in years"
+    )
+    gender: Literal["male", "female", "not mentioned"] = Field(..., description="Gender of the patient")
+    ecog_ps: Literal[0, 1, 2, "not mentioned"] = Field(..., description="ECOG Performance Status")
+    histology: Histology = Field(..., description="Tumour histology")
+    current_stage: Stage = Field(..., description="Current cancer stage")
+    line_of_therapy: LineOfTherapy = Field(..., description="Line of therapy the patient is a candidate for")
+    pd_l1_tps: PDL1 = Field(..., description="PD-L1 tumour proportion score bucket")
+    biomarkers: Biomarker = Field(..., description="Actionable biomarker")
+    brain_metastasis: List[Literal["true", "false", "not mentioned"]] = Field(
+        ..., description="Brain metastasis on the most recent CT/PET"
+    )
+    prior_systemic_therapies: List[SystemicTherapy] = Field(
+        ..., description="Oncological treatments already administered"
+    )
+    comorbidities: List[str] = Field(..., description="Comorbidities, from the COMORBIDITÀ section")
+    concomitant_treatments: List[str] = Field(
+        ..., description="Home therapies (names only), from the 'terapie domiciliari' section"
+    )
+
+
+class Medication(BaseModel):
+    medication: str
+    dosage: str
+    frequency: str
+    indication: str
+
+
+class MedicationList(BaseModel):
+    medications: List[Medication]
+
+
+class TimelineEvent(BaseModel):
+    date: Optional[str] = Field(None, description="YYYY-MM-DD or null")
+    event: str
+    details: str
+
+
+class Timeline(BaseModel):
+    events: List[TimelineEvent]
+
+
+class TrialVerdict(BaseModel):
+    trial_id: str
+    title: str
+    description: str
+    match_score: Annotated[int, Field(ge=0, le=100)]
+    overall_recommendation: str
+    criteria_analysis: str
+    summary: str
+
+
+class TrialVerdictBatch(BaseModel):
+    verdicts: List[TrialVerdict]
+
+
+def _inline_refs(node, definitions):
+    # Ollama's grammar converter is most reliable with a self-contained schema;
+    # "title" annotations are dropped (but not properties that happen to be called "title")
+    if isinstance(node, dict):
+        if "$ref" in node:
+            name = node["$ref"].rsplit("/", 1)[-1]
+            return _inline_refs(copy.deepcopy(definitions[name]), definitions)
+        inlined = {}
+        for key, value in node.items():
+            if key == "properties":
+                inlined[key] = {name: _inline_refs(prop, definitions) for name, prop in value.items()}
+            elif key != "title" or not isinstance(value, str):
+                inlined[key] = _inline_refs(value, definitions)
+        return inlined
+    if isinstance(node, list):
+        return [_inline_refs(item, definitions) for item in node]
+    return node
+
+
+_schema_cache = {}
+
+
+def ollama_format_schema(model: type, fields: List[str] = None) -> Dict[str, Any]:
+    """
+    JSON schema del modello Pydantic, pronto per il parametro `format` di Ollama.
+    Con `fields` lo schema è ristretto a quei campi (estrazione dei soli campi residui).
+    """
+    if model not in _schema_cache:
+        schema = model.model_json_schema()
+        definitions = schema.pop("$defs", {})
+        _schema_cache[model] = _inline_refs(schema, definitions)
+    schema = _schema_cache[model]
+    if fields is None:
+        return schema
+    return {
+        **schema,
+        "properties": {name: spec for name, spec in schema["properties"].items() if name in fields},
+        "required": [name for name in schema.get("required", []) if name in fields],
+    }
+
+
+_field_adapters = {}
+
+
+def validate_fields(model: type, data: Dict[str, Any], fields: List[str] = None):
+    """
+    Validazione campo per campo (un campo errato non invalida gli altri).
+    Restituisce (validi, non validi {campo: valore}, mancanti) per `fields`
+    (default: tutti i campi del modello).
+    """
+    valid, invalid, missing = {}, {}, []
+    for name in fields or list(model.model_fields):
+        if name not in data:
+            missing.append(name)
+            continue
+        key = (model, name)
+        if key not in _field_adapters:
+            info = model.model_fields[name]
+            annotation = Annotated[(info.annotation, *info.metadata)] if info.metadata else info.annotation
+            _field_adapters[key] = TypeAdapter(annotation)
+        try:
+            valid[name] = _field_adapters[key].validate_python(data[name], strict=True)
+        except ValidationError:
+            invalid[name] = data[name]
+    return valid, invalid, missing
+
+
+# Parse outcomes per stage, split by structured ("format") vs free-text generation,
+# so the failure rate before/after enabling LLM_STRUCTURED_OUTPUT can be compared
+_parse_counters = {}
+_parse_lock = threading.Lock()
+
+
+def record_parse(stage: str, structured: bool, ok: bool):
+    mode = "structured" if structured else "free_text"
+    with _parse_lock:
+        counters = _parse_counters.setdefault(stage, {}).setdefault(mode, {"parsed": 0, "failed": 0})
+        counters["parsed" if ok else "failed"] += 1
+
+
+# Field-level outcomes of validation: fixed locally, repaired by the LLM, re-extracted or defaulted
+_repair_counters = {}
+
+
+def record_repair(stage: str, outcome: str, count: int = 1):
+    if not count:
+        return
+    with _parse_lock:
+        counters = _repair_counters.setdefault(stage, {})
+        counters[outcome] = counters.get(outcome, 0) + count
+
+
+def parse_stats() -> Dict[str, Any]:
+    with _parse_lock:
+        stats = copy.deepcopy(_parse_counters)
+        repairs = copy.deepcopy(_repair_counters)
+    for modes in stats.values():
+        for counters in modes.values():
+            total = counters["parsed"] + counters["failed"]
+            counters["failure_rate"] = round(counters["failed"] / total, 4) if total else 0.0
+    for stage, counters in repairs.items():
+        stats.setdefault(stage, {})["field_repairs"] = counters
+    return stats
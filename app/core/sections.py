@@ -0,0 +1,222 @@
+import re
+import bisect
+import logging
+from datetime import date
+from typing import Dict, Any, List, Optional
+
+from app.core.token_budget import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+NOT_MENTIONED = "not mentioned"
+
+# Canonical section → heading patterns (Italian clinical letters, case-insensitive)
+SECTION_HEADINGS = {
+    "summary": r"sintesi\s+clinica|riassunto\s+clinico|conclusioni|valutazione",
+    "diagnosis": r"diagnosi(\s+oncologica)?|istologia|esame\s+istologico|biologia\s+molecolare|ngs",
+    "history": r"anamnesi(\s+\w+)?|storia\s+clinica|decorso(\s+clinico)?",
+    "comorbidities": r"comorbidit[àa]'?|patologie\s+concomitanti",
+    "home_therapy": r"terapi[ae]\s+domiciliar[ei]|terapia\s+in\s+atto|farmaci\s+in\s+uso",
+    "treatments": r"terapie\s+(oncologiche\s+)?precedenti|trattamenti(\s+precedenti)?|terapia\s+oncologica",
+    "imaging": r"tc|tac|pet(\s*-?\s*tc)?|rm|rmn|risonanza(\s+magnetica)?|esami\s+strumentali|imaging|stadiazione",
+    "exam": r"esame\s+obiettivo|e\.o\.|parametri\s+vitali|performance\s+status",
+}
+
+# A heading is a short line that starts with a known title, optionally followed by ":" or a date
+_HEADING_RE = re.compile(
+    r"^[ \t]*(?:#+\s*|\*\*)?(?P<title>" + "|".join(f"(?P<{key}>{pattern})" for key, pattern in SECTION_HEADINGS.items())
+    + r")\b[^\n]{0,60}$",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+_DATE_RE = re.compile(r"\b(\d{1,2})[/.-](\d{1,2})[/.-](\d{4})\b|\b(\d{4})-(\d{2})-(\d{2})\b")
+
+# Field groups and the sections each one reads ("preamble" = text before the first heading)
+FIELD_GROUPS = {
+    "clinical": {
+        "fields": ["age", "gender", "ecog_ps", "histology", "current_stage", "line_of_therapy",
+                   "pd_l1_tps", "biomarkers"],
+        "sections": ["preamble", "summary", "diagnosis", "history", "exam"],
+    },
+    "metastasis": {
+        "fields": ["brain_metastasis"],
+        "sections": ["imaging", "summary", "diagnosis"],
+    },
+    "therapies": {
+        "fields": ["prior_systemic_therapies"],
+        "sections": ["treatments", "history", "summary"],
+    },
+    "comorbidities": {
+        "fields": ["comorbidities"],
+        "sections": ["comorbidities"],
+    },
+    "home_therapy": {
+        "fields": ["concomitant_treatments"],
+        "sections": ["home_therapy"],
+    },
+}
+
+LIST_FIELDS = {"brain_metastasis", "prior_systemic_therapies", "comorbidities", "concomitant_treatments"}
+
+
+def latest_date(text: str) -> Optional[date]:
+    """Data più recente citata nel testo (gg/mm/aaaa, gg-mm-aaaa o aaaa-mm-gg)."""
+    found = []
+    for match in _DATE_RE.finditer(text):
+        try:
+            if match.group(3):
+                found.append(date(int(match.group(3)), int(match.group(2)), int(match.group(1))))
+            else:
+                found.append(date(int(match.group(4)), int(match.group(5)), int(match.group(6))))
+        except ValueError:
+            continue
+    return max(found) if found else None
+
+
+def split_sections(text: str) -> List[Dict[str, Any]]:
+    """
+    Divide il documento nelle sezioni riconosciute dai titoli. Restituisce una lista
+    di {"key", "title", "start", "text"} in ordine di documento; il testo prima del
+    primo titolo è la sezione "preamble". Una sezione ripetuta (più visite) compare
+    più volte.
+    """
+    sections = []
+    matches = list(_HEADING_RE.finditer(text))
+    first_start = matches[0].start() if matches else len(text)
+    if text[:first_start].strip():
+        sections.append({"key": "preamble", "title": "", "start": 0, "text": text[:first_start]})
+    for index, match in enumerate(matches):
+        end = matches[index + 1].start() if index + 1 < len(matches) else len(text)
+        key = next(name for name in SECTION_HEADINGS if match.group(name))
+        sections.append({"key": key, "title": match.group("title").strip(), "start": match.start(),
+                         "text": text[match.start():end]})
+    return sections
+
+
+def _longest_fit(text: str, position: int, ends: List[int], budget: int) -> int:
+    # Largest end in `ends` with text[position:end] within budget (binary search on the estimate)
+    low, high, best = 0, len(ends) - 1, None
+    while low <= high:
+        middle = (low + high) // 2
+        if estimate_tokens(text[position:ends[middle]]) <= budget:
+            best, low = ends[middle], middle + 1
+        else:
+            high = middle - 1
+    return best
+
+
+def _cut_to_budget(text: str, start: int, budget: int) -> List[Dict[str, Any]]:
+    """Taglia un paragrafo troppo lungo tra le parole, in pezzi entro `budget` token stimati."""
+    words = [match.end() for match in re.finditer(r"\S+\s*", text)]
+    pieces, position = [], 0
+    while position < len(text):
+        following = words[bisect.bisect_right(words, position):] or [len(text)]
+        end = _longest_fit(text, position, following, budget)
+        if end is None:
+            # A single "word" over the budget (e.g. a base64 blob): cut it by characters
+            end = _longest_fit(text, position, list(range(position + 1, following[0] + 1)), budget) or position + 1
+        pieces.append({"start": start + position, "text": text[position:end]})
+        position = end
+    return pieces
+
+
+def _split_to_budget(text: str, start: int, budget: int) -> List[Dict[str, Any]]:
+    """Divide un testo troppo lungo in pezzi entro `budget` token, tagliando sui paragrafi."""
+    if estimate_tokens(text) <= budget:
+        return [{"start": start, "text": text}]
+    pieces, current, current_start, offset = [], "", start, start
+    for paragraph in re.split(r"(?<=\n)(?=\s*\n)", text):
+        if current and estimate_tokens(current + paragraph) > budget:
+            pieces.append({"start": current_start, "text": current})
+            current = ""
+        if estimate_tokens(paragraph) > budget:
+            # A single huge paragraph: split it between words
+            pieces.extend(_cut_to_budget(paragraph, offset, budget))
+        else:
+            if not current:
+                current_start = offset
+            current += paragraph
+        offset += len(paragraph)
+    if current.strip():
+        pieces.append({"start": current_start, "text": current})
+    return pieces
+
+
+def plan_chunks(text: str, budget: int) -> List[Dict[str, Any]]:
+    """
+    Piano di estrazione per un documento lungo: per ogni gruppo di campi, le sole
+    sezioni pertinenti accorpate in chunk entro `budget` token. Se il documento non
+    ha titoli riconoscibili si usano chunk consecutivi con tutti i campi.
+    Ogni chunk: {"group", "fields", "start", "text", "date"}.
+    """
+    sections = split_sections(text)
+    headed = [section for section in sections if section["key"] != "preamble"]
+    chunks = []
+    if not headed:
+        all_fields = [field for group in FIELD_GROUPS.values() for field in group["fields"]]
+        for piece in _split_to_budget(text, 0, budget):
+            chunks.append({"group": "all", "fields": all_fields, **piece})
+    else:
+        for group_name, group in FIELD_GROUPS.items():
+            relevant = [section for section in sections if section["key"] in group["sections"]]
+            if not relevant:
+                continue
+            pieces = []
+            for section in relevant:
+                pieces.extend(_split_to_budget(section["text"], section["start"], budget))
+            # Pack consecutive pieces of the group together while the joined text fits
+            current = None
+            for piece in pieces:
+                joined = current["text"] + "\n" + piece["text"] if current else None
+                if joined is not None and estimate_tokens(joined) <= budget:
+                    current["text"] = joined
+                    continue
+                current = {"group": group_name, "fields": group["fields"], "start": piece["start"],
+                           "text": piece["text"]}
+                chunks.append(current)
+    for chunk in chunks:
+        chunk["date"] = latest_date(chunk["text"])
+    logger.info(f"✂️ Split document into {len(sections)} sections and {len(chunks)} extraction chunks")
+    return chunks
+
+
+def _is_mentioned(value) -> bool:
+    if isinstance(value, list):
+        return any(_is_mentioned(item) for item in value)
+    return value is not None and value != "" and value != NOT_MENTIONED
+
+
+def _recency(chunk: Dict[str, Any]):
+    # Most recent first: dated chunks by date, then later position in the document
+    return (chunk["date"] or date.min, chunk["start"])
+
+
+def reduce_features(partials: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Unisce in modo deterministico i JSON parziali ({"chunk", "features"}):
+    - campi singoli e brain_metastasis: vince il chunk più recente (data più recente
+      citata, poi posizione nel documento) che ha un valore, così per le metastasi
+      prevale la TC/PET più recente;
+    - liste di terapie, comorbidità e farmaci: unione senza duplicati, in ordine di documento.
+    Ogni campo viene letto solo dai chunk del gruppo che lo contiene.
+    """
+    merged = {}
+    for group in FIELD_GROUPS.values():
+        for field in group["fields"]:
+            candidates = [
+                partial for partial in partials
+                if field in partial["chunk"]["fields"] and _is_mentioned(partial["features"].get(field))
+            ]
+            if field in LIST_FIELDS and field != "brain_metastasis":
+                values, seen = [], set()
+                for partial in sorted(candidates, key=lambda p: p["chunk"]["start"]):
+                    for item in partial["features"][field]:
+                        if _is_mentioned(item) and str(item).lower() not in seen:
+                            seen.add(str(item).lower())
+                            values.append(item)
+                merged[field] = values or [NOT_MENTIONED]
+            elif candidates:
+                merged[field] = max(candidates, key=lambda p: _recency(p["chunk"]))["features"][field]
+            else:
+                merged[field] = [NOT_MENTIONED] if field in LIST_FIELDS else NOT_MENTIONED
+    return merged
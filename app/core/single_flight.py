@@ -0,0 +1,239 @@
+import os
+import time
+import logging
+import threading
+
+from app.core.storage_crypto import EncryptionUnavailable, encryption_settings, get_storage_cipher
+
+try:
+    import fcntl
+except ImportError:  # Windows: only in-process coalescing
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOCK_DIR = "cache/inflight"
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalescenza delle chiamate identiche in corso ("single flight").
+    Nello stesso processo i chiamanti con la stessa chiave aspettano la chiamata
+    del primo (il "leader") e ne condividono il risultato. Tra worker gunicorn
+    diversi il leader tiene un flock su `<lock_dir>/<chiave>.lock` e, finito,
+    scrive il risultato in `<chiave>.result`: chi trova il lock occupato aspetta
+    e rilegge quel file invece di rigenerare. I file risultato scadono dopo
+    `result_ttl` secondi; con un `cipher` (ENCRYPT_AT_REST) sono cifrati e i nomi
+    dei file sono HMAC della chiave.
+    """
+
+    def __init__(self, lock_dir: str = None, wait_timeout: float = 300.0, result_ttl: float = 60.0,
+                 cipher=None):
+        self.lock_dir = lock_dir if fcntl is not None else None
+        self.wait_timeout = wait_timeout
+        self.result_ttl = result_ttl
+        self.cipher = cipher
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.counters = {
+            "leaders": 0,
+            "coalesced_local": 0,
+            "coalesced_remote": 0,
+            "lock_timeouts": 0,
+        }
+        if self.lock_dir:
+            try:
+                os.makedirs(self.lock_dir, exist_ok=True)
+            except OSError as e:
+                logger.error(f"❌ Unable to create single-flight directory {self.lock_dir}, "
+                             f"coalescing within this process only: {e}")
+                self.lock_dir = None
+
+    def _count(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+
+    def do(self, key: str, fn):
+        """
+        Esegue fn() una sola volta per tutte le chiamate concorrenti con la stessa chiave.
+        Restituisce (risultato, shared): `shared` è True se il risultato è stato
+        prodotto da un'altra chiamata.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.counters["coalesced_local"] += 1
+
+        if not leader:
+            logger.info(f"🔗 Waiting for identical in-flight LLM call ({key[:12]})")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result, shared = self._run_across_workers(key, fn)
+            return call.result, shared
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    # --- cross-worker coalescing -----------------------------------------
+
+    def _run_across_workers(self, key: str, fn):
+        if not self.lock_dir:
+            self._count("leaders")
+            return fn(), False
+
+        name = self.cipher.name(key) if self.cipher else key
+        lock_path = os.path.join(self.lock_dir, f"{name}.lock")
+        result_path = os.path.join(self.lock_dir, f"{name}.result")
+        fd, waited = self._acquire_file_lock(lock_path)
+        if fd is None:
+            # Another worker held the lock for too long: do not block the request any further
+            self._count("lock_timeouts")
+            self._count("leaders")
+            return fn(), False
+
+        try:
+            # Only reuse a result if another worker was generating it while we waited:
+            # a leftover file from an earlier, non-overlapping call must not be served
+            shared = self._read_result(result_path) if waited else None
+            if shared is not None:
+                self._count("coalesced_remote")
+                logger.info(f"🔗 Reused LLM result produced by another worker ({key[:12]})")
+                return shared, True
+
+            self._count("leaders")
+            result = fn()
+            if result:
+                self._write_result(result_path, result)
+            return result, False
+        finally:
+            # Unlink while still holding the lock, so waiters can detect a stale inode
+            try:
+                os.unlink(lock_path)
+            except OSError:
+                pass
+            os.close(fd)
+            self._sweep()
+
+    def _acquire_file_lock(self, path: str):
+        """
+        flock esclusivo su `path`. Restituisce (fd, waited), con fd None se il lock
+        non è stato ottenuto entro wait_timeout.
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        delay = 0.01
+        waited = False
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                waited = True
+                if time.monotonic() >= deadline:
+                    return None, waited
+                time.sleep(delay)
+                delay = min(delay * 2, 0.25)
+                continue
+            try:
+                # The previous holder unlinks the file before releasing it: make sure we
+                # locked the file that is currently at `path`, not an orphaned inode
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    return fd, waited
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+            waited = True
+
+    def _read_result(self, path: str):
+        try:
+            if time.time() - os.path.getmtime(path) > self.result_ttl:
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                result = f.read()
+            return (self.cipher.decrypt_text(result) if self.cipher else result) or None
+        except Exception:
+            # Unreadable or written with another key: the waiter generates it itself
+            return None
+
+    def _write_result(self, path: str, result: str):
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(self.cipher.encrypt_text(result) if self.cipher else result)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"⚠️ Unable to share LLM result with other workers: {e}")
+
+    def _sweep(self):
+        """Rimuove i file risultato scaduti."""
+        cutoff = time.time() - self.result_ttl
+        try:
+            with os.scandir(self.lock_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith((".result", ".tmp")) and entry.stat().st_mtime < cutoff:
+                        try:
+                            os.unlink(entry.path)
+                        except OSError:
+                            pass
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.counters)
+            stats["in_flight"] = len(self._calls)
+        stats["lock_dir"] = self.lock_dir
+        stats["encrypted"] = bool(self.cipher)
+        return stats
+
+
+_single_flight = None
+_single_flight_settings = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight(config: dict):
+    """
+    Restituisce lo SingleFlight del processo, o None se disattivato
+    (LLM_SINGLE_FLIGHT_ENABLED=false). Viene ricreato solo se cambiano i parametri.
+    """
+    global _single_flight, _single_flight_settings
+    if not config.get("LLM_SINGLE_FLIGHT_ENABLED", True):
+        return None
+
+    settings = (
+        config.get("LLM_SINGLE_FLIGHT_DIR", DEFAULT_LOCK_DIR) or None,
+        float(config.get("LLM_READ_TIMEOUT", 300)),
+        encryption_settings(config),
+    )
+    with _single_flight_lock:
+        if _single_flight is None or settings != _single_flight_settings:
+            lock_dir, wait_timeout, _ = settings
+            try:
+                cipher = get_storage_cipher(config)
+            except EncryptionUnavailable as e:
+                # Still coalesce, but never write results to disk in plaintext
+                logger.error(f"❌ Single-flight results not shared across workers, "
+                             f"encryption requested but unavailable: {e}")
+                lock_dir, cipher = None, None
+            _single_flight = SingleFlight(lock_dir, wait_timeout=wait_timeout, cipher=cipher)
+            _single_flight_settings = settings
+        return _single_flight
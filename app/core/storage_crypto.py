@@ -0,0 +1,84 @@
+import os
+import hmac
+import hashlib
+import logging
+import threading
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:  # optional: only needed with ENCRYPT_AT_REST
+    Fernet = None
+    InvalidToken = ValueError
+
+logger = logging.getLogger(__name__)
+
+# Fernet key (urlsafe base64, 32 bytes): never stored in config.json
+ENCRYPTION_KEY_ENV = "STORAGE_ENCRYPTION_KEY"
+
+
+class EncryptionUnavailable(RuntimeError):
+    """ENCRYPT_AT_REST è attivo ma la chiave o il pacchetto `cryptography` mancano."""
+
+
+class StorageCipher:
+    """
+    Cifratura at-rest comune a tutto ciò che salva prompt e risposte su disco (cache
+    LLM, cache per documento, risultati single-flight, artefatti di debug): valori
+    cifrati con Fernet e nomi/chiavi sostituiti da un HMAC, così né il contenuto né
+    l'impronta del documento compaiono in chiaro.
+    """
+
+    def __init__(self, key: bytes):
+        self._fernet = Fernet(key)
+        self._secret = key
+
+    def encrypt(self, data: bytes) -> bytes:
+        return self._fernet.encrypt(data)
+
+    def decrypt(self, token: bytes) -> bytes:
+        """Solleva InvalidToken con una chiave diversa (ruotata) o dati corrotti."""
+        return self._fernet.decrypt(token)
+
+    def encrypt_text(self, text: str) -> str:
+        return self.encrypt(text.encode("utf-8")).decode("ascii")
+
+    def decrypt_text(self, token: str) -> str:
+        return self.decrypt(token.encode("ascii")).decode("utf-8")
+
+    def name(self, key: str) -> str:
+        """Chiave o nome di file da usare su disco al posto di `key`."""
+        return hmac.new(self._secret, key.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+_cipher = None
+_cipher_key = None
+_cipher_lock = threading.Lock()
+
+
+def encryption_settings(config: dict):
+    """(attiva, chiave): da includere nelle impostazioni degli store che si ricreano se cambiano."""
+    return bool(config.get("ENCRYPT_AT_REST", False)), os.getenv(ENCRYPTION_KEY_ENV)
+
+
+def get_storage_cipher(config: dict):
+    """
+    Cipher del processo, o None con ENCRYPT_AT_REST=false. Se la cifratura è richiesta
+    ma non disponibile solleva EncryptionUnavailable: chi chiama deve disattivare lo
+    store piuttosto che scrivere dati clinici in chiaro.
+    """
+    global _cipher, _cipher_key
+    enabled, key = encryption_settings(config)
+    if not enabled:
+        return None
+    if Fernet is None:
+        raise EncryptionUnavailable("the 'cryptography' package is not installed")
+    if not key:
+        raise EncryptionUnavailable(f"{ENCRYPTION_KEY_ENV} is not set")
+    with _cipher_lock:
+        if key != _cipher_key:
+            try:
+                _cipher = StorageCipher(key.encode("ascii"))
+            except ValueError as e:
+                raise EncryptionUnavailable(f"{ENCRYPTION_KEY_ENV} is not a valid Fernet key ({e})")
+            _cipher_key = key
+        return _cipher
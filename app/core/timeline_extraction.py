@@ -1,71 +1,103 @@
-import os
-import json
-import time
-import re
-import logging
-from typing import Union
-from app import logger
-from app.core.llm_processor import get_llm_processor
-from app.core.feature_extraction import extract_text_from_pdf
-
-# Ensure the logs folder exists
-os.makedirs("logs", exist_ok=True)
-
-def extract_timeline_from_pdf(pdf_file: Union[str, bytes]):
-    try:
-        text = extract_text_from_pdf(pdf_file)
-        return extract_timeline(text)
-    except Exception as e:
-        logger.error(f"❌ Error reading PDF for timeline extraction: {str(e)}")
-        return {}
-
-def extract_timeline(text: str):
-    llm = get_llm_processor()
-
-    prompt = f"""You are a medical assistant. Extract a timeline of clinical events. Output ONLY a JSON array like:
-
-[
-  {{
-    "date": "YYYY-MM-DD" or null,
-    "event": "Short description",
-    "details": "Optional long description"
-  }},
-  ...
-]
-
-Text:
-{text}
-"""
-
-    logger.info(f"Prompt sent to LLM (timeline):\n{prompt[:2000]}")
-
-    try:
-        response = llm.generate_response(prompt)
-        logger.info(f"🧠 LLM Timeline Response: {response[:1000]}")
-
-        filename = f"logs/llm_timeline_debug_{int(time.time())}.json"
-        with open(filename, "w") as f:
-            json.dump({"prompt": prompt, "response": response}, f, indent=2)
-
-        resp_json = json.loads(response)
-        raw = resp_json.get("response", "")
-        json_match = re.search(r"\[.*\]", raw, re.DOTALL)
-
-        if not json_match:
-            logger.error("❌ No JSON array found in timeline LLM response.")
-            return []
-
-        json_text = json_match.group(0)
-        llm_text = json.loads(json_text)
-
-
-        if not isinstance(llm_text, list):
-            logger.error(f"❌ LLM timeline output is not a list: {llm_text}")
-            return []
-
-        logger.info(f"✅ Extracted Timeline Features: {json.dumps(llm_text, indent=2)}")
-        return llm_text
-
-    except Exception as e:
-        logger.exception("❌ Timeline LLM parsing failed")
-        return []
+import os
+import json
+import re
+import logging
+from typing import Union
+from app import logger
+from app.core.llm_processor import get_llm_processor
+from app.core.scheduler import BusyError
+from app.core.schema_validation import Timeline, ollama_format_schema, record_parse
+from app.core.pdf_extraction import extract_text_from_pdf
+from app.core.document_cache import cached_document_result, code_version
+from app.core.debug_artifacts import write_debug_artifact
+
+# Ensure the logs folder exists
+os.makedirs("logs", exist_ok=True)
+
+def extract_timeline_from_pdf(pdf_file: Union[str, bytes]):
+    try:
+        text = extract_text_from_pdf(pdf_file)
+        return extract_timeline(text)
+    except BusyError:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error reading PDF for timeline extraction: {str(e)}")
+        return {}
+
+TIMELINE_EXTRACTION_PROMPT = """You are a medical assistant. Extract a timeline of clinical events. Output ONLY a JSON object like:
+
+{
+  "events": [
+    {
+      "date": "YYYY-MM-DD" or null,
+      "event": "Short description",
+      "details": "Optional long description"
+    },
+    ...
+  ]
+}
+"""
+
+def build_timeline_prompt(text: str) -> str:
+    return f"{TIMELINE_EXTRACTION_PROMPT}\nText:\n{text}\n"
+
+def extract_timeline(text: str, prompt: str = None):
+    """Estrae la timeline da `text`; `prompt` sostituisce il prompt standard (es. estrazione combinata)."""
+    if prompt is None:
+        # Re-opened documents are served from the document cache without any LLM call
+        return cached_document_result(
+            "timeline", text,
+            [TIMELINE_EXTRACTION_PROMPT, ollama_format_schema(Timeline), code_version(build_timeline_prompt, extract_timeline)],
+            lambda: extract_timeline(text, prompt=build_timeline_prompt(text)),
+        )
+    llm = get_llm_processor()
+
+
+    logger.info(f"Prompt sent to LLM (timeline):\n{prompt[:2000]}")
+
+    try:
+        response = llm.generate_response(
+            prompt, format_schema=ollama_format_schema(Timeline), stage="timeline"
+        )
+        logger.info(f"🧠 LLM Timeline Response: {response[:1000]}")
+        if not response:
+            logger.error("❌ Empty response from LLM (timeline)")
+            return []
+
+        write_debug_artifact("timeline", {"prompt": prompt, "response": response})
+
+        resp_json = json.loads(response)
+        raw = resp_json.get("response", "")
+        try:
+            llm_text = json.loads(raw)
+        except json.JSONDecodeError:
+            # Free-text answer (structured output disabled): look for the JSON array
+            json_match = re.search(r"\[.*\]", raw, re.DOTALL)
+            if not json_match:
+                record_parse("timeline", llm.structured_output, False)
+                logger.error("❌ No JSON array found in timeline LLM response.")
+                return []
+            llm_text = json.loads(json_match.group(0))
+
+        if isinstance(llm_text, dict):
+            llm_text = llm_text.get("events")
+
+        if not isinstance(llm_text, list):
+            record_parse("timeline", llm.structured_output, False)
+            logger.error(f"❌ LLM timeline output is not a list: {llm_text}")
+            return []
+
+        record_parse("timeline", llm.structured_output, True)
+
+        logger.info(f"✅ Extracted Timeline Features: {json.dumps(llm_text, indent=2)}")
+        return llm_text
+
+    except json.JSONDecodeError:
+        record_parse("timeline", llm.structured_output, False)
+        logger.exception("❌ Timeline LLM parsing failed")
+        return []
+    except BusyError:
+        raise
+    except Exception as e:
+        logger.exception("❌ Timeline LLM parsing failed")
+        return []
@@ -0,0 +1,95 @@
+import re
+import json
+import math
+import logging
+from typing import Dict, Any, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Approximates the pre-tokenisation of llama-style BPE vocabularies: words (with their
+# leading space), short digit groups, punctuation runs and whitespace runs
+_PIECE_RE = re.compile(r" ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+", re.UNICODE)
+
+# Average characters per token for a single word piece (Italian/English clinical text)
+CHARS_PER_TOKEN = 4.0
+
+# Estimates are approximate: keep a margin so a batch never overflows num_ctx
+SAFETY_FACTOR = 1.1
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Stima locale del numero di token di `text`, senza tokenizer del modello.
+    Ogni parola conta ceil(len / CHARS_PER_TOKEN) token, numeri e punteggiatura
+    un token per gruppo; il risultato include un margine di sicurezza.
+    """
+    if not text:
+        return 0
+    tokens = 0
+    for piece in _PIECE_RE.findall(text):
+        stripped = piece.strip()
+        if not stripped:
+            tokens += 1
+        elif stripped[0].isalpha():
+            tokens += math.ceil(len(stripped) / CHARS_PER_TOKEN)
+        else:
+            tokens += max(1, math.ceil(len(stripped) / 2))
+    return math.ceil(tokens * SAFETY_FACTOR)
+
+
+def pack_trials(trials: List[Dict[str, Any]], prefix_tokens: int, context_size: int,
+                output_tokens_per_trial: int = 400, max_trials_per_batch: int = None,
+                headroom: int = 256) -> Tuple[List[List[Dict[str, Any]]], Dict[str, Any]]:
+    """
+    Raggruppa i trial nel minor numero di batch che entrano nella finestra di contesto
+    (first-fit decreasing). Ogni trial costa i suoi token di prompt più i token di
+    output riservati per il suo verdetto; il prefisso del paziente e `headroom` sono
+    pagati da ogni batch. I trial mantengono l'ordine originale dentro ogni batch e i
+    batch sono ordinati per il loro primo trial, così il risultato è deterministico.
+
+    Restituisce (batch, statistiche con fill ratio per batch e medio).
+    """
+    capacity = context_size - prefix_tokens - headroom
+    costs = [
+        estimate_tokens(json.dumps(trial, indent=2)) + output_tokens_per_trial
+        for trial in trials
+    ]
+
+    bins = []  # each bin: {"indices": [...], "used": tokens}
+    order = sorted(range(len(trials)), key=lambda i: costs[i], reverse=True)
+    for index in order:
+        cost = costs[index]
+        target = None
+        for candidate in bins:
+            if max_trials_per_batch and len(candidate["indices"]) >= max_trials_per_batch:
+                continue
+            if candidate["used"] + cost <= capacity:
+                target = candidate
+                break
+        if target is None:
+            if cost > capacity:
+                logger.warning(
+                    f"⚠️ Trial {trials[index].get('id')} needs ~{cost} tokens but only {max(capacity, 0)} "
+                    f"are available next to the patient prefix; it will be sent alone and may be truncated"
+                )
+            target = {"indices": [], "used": 0}
+            bins.append(target)
+        target["indices"].append(index)
+        target["used"] += cost
+
+    for candidate in bins:
+        candidate["indices"].sort()
+    bins.sort(key=lambda candidate: candidate["indices"][0])
+
+    batches = [[trials[i] for i in candidate["indices"]] for candidate in bins]
+    fill_ratios = [
+        round((prefix_tokens + candidate["used"]) / context_size, 3) for candidate in bins
+    ]
+    stats = {
+        "batches": len(batches),
+        "prefix_tokens": prefix_tokens,
+        "capacity_tokens": capacity,
+        "fill_ratios": fill_ratios,
+        "mean_fill_ratio": round(sum(fill_ratios) / len(fill_ratios), 3) if fill_ratios else 0.0,
+    }
+    return batches, stats
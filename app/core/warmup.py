@@ -0,0 +1,134 @@
+import time
+import logging
+import threading
+
+from app.core.llm_processor import get_llm_processor
+from app.core.metrics import record_llm_call
+
+logger = logging.getLogger(__name__)
+
+WARMUP_PROMPT = "Reply with OK."
+
+_state = {
+    "state": "cold",  # cold → warming → ready | failed
+    "started_at": None,
+    "finished_at": None,
+    "backends": {},
+    "error": None,
+}
+_state_lock = threading.Lock()
+
+
+def _warm_backend(processor, backend, model: str, context_size: int) -> dict:
+    """
+    Carica il modello su un backend e ne misura la latenza a caldo.
+    La prima richiesta senza prompt fa solo caricare il modello (con keep_alive);
+    la seconda, un prompt minimo con un solo token di output, misura la latenza
+    di una chiamata con il modello già residente.
+    """
+    url = backend.generate_url
+    # Loading a large model can take longer than a generation: the "warmup" stage profile may say so
+    profile = processor.resolve_profile("warmup")
+    timeout = (profile["connect_timeout"], profile["read_timeout"])
+    started = time.perf_counter()
+    response = processor.session.post(url, json={"model": model, "keep_alive": processor.keep_alive},
+                                      timeout=timeout)
+    response.raise_for_status()
+    load_seconds = time.perf_counter() - started
+
+    payload = {
+        "model": model,
+        "prompt": WARMUP_PROMPT,
+        "options": {"temperature": 0, "num_ctx": context_size, "num_predict": 1},
+        "keep_alive": processor.keep_alive,
+        "stream": False,
+    }
+    started = time.perf_counter()
+    response = processor.session.post(url, json=payload, timeout=timeout)
+    response.raise_for_status()
+    warm_latency = time.perf_counter() - started
+    record_llm_call("warmup", model, response.json(), warm_latency, 0.0)
+    backend.loaded_models.add(model)
+    return {
+        "load_seconds": round(load_seconds, 3),
+        "warm_latency_seconds": round(warm_latency, 3),
+        "warmed_at": time.time(),
+    }
+
+
+def warm_up_model():
+    """
+    Precarica LLM_MODEL e i modelli dei profili per stage su tutti i backend;
+    aggiorna lo stato letto da /ready (che considera solo LLM_MODEL).
+    """
+    with _state_lock:
+        if _state["state"] == "warming":
+            return
+        _state.update(state="warming", started_at=time.time(), error=None)
+
+    results, errors = {}, []
+    try:
+        processor = get_llm_processor()
+        for model, context_size in processor.stage_models().items():
+            logger.info(f"🔥 Warming up {model} (keep_alive={processor.keep_alive})...")
+            for backend in processor.pool.backends:
+                try:
+                    result = _warm_backend(processor, backend, model, context_size)
+                except Exception as e:
+                    errors.append(f"{model} on {backend.url}: {e}")
+                    logger.error(f"❌ Warm-up of {model} failed on {backend.url}: {e}")
+                    continue
+                if model == processor.model:
+                    results[backend.url] = result
+                logger.info(f"✅ {model} warm on {backend.url}: loaded in {result['load_seconds']:.2f}s, "
+                            f"warm latency {result['warm_latency_seconds']:.3f}s")
+    except Exception as e:
+        errors.append(str(e))
+        logger.error(f"❌ LLM warm-up failed: {e}")
+
+    with _state_lock:
+        _state["backends"].update(results)
+        _state.update(
+            state="ready" if results else "failed",
+            finished_at=time.time(),
+            error="; ".join(errors) or None,
+        )
+
+
+def start_model_warmup():
+    """Avvia il warm-up in un thread, senza rallentare l'avvio dell'applicazione."""
+    threading.Thread(target=warm_up_model, name="llm-warmup", daemon=True).start()
+
+
+def readiness() -> dict:
+    """
+    Stato di prontezza del worker: pronto se il modello risulta residente su almeno
+    un backend sano e non è in corso un warm-up. Non interroga Ollama: usa lo stato
+    del pool aggiornato dall'health check periodico (/api/ps), dal warm-up e dalle
+    chiamate riuscite, quindi un load balancer che chiama /ready spesso non genera
+    traffico verso i backend. Se il modello non è caricato (mai caricato o keep_alive
+    scaduto) viene avviato un warm-up in background.
+    """
+    processor = get_llm_processor()
+    model_names = {processor.model, f"{processor.model}:latest"}
+    resident = [b.url for b in processor.pool.healthy_backends() if b.loaded_models & model_names]
+    probes = [b.last_probe for b in processor.pool.backends if b.last_probe is not None]
+
+    with _state_lock:
+        state = dict(_state, backends=dict(_state["backends"]))
+    if not resident and state["state"] != "warming":
+        start_model_warmup()
+        state["state"] = "warming"
+
+    latencies = [info["warm_latency_seconds"] for url, info in state["backends"].items() if url in resident]
+    return {
+        "ready": bool(resident) and state["state"] != "warming",
+        "state": state["state"],
+        "model": processor.model,
+        "keep_alive": processor.keep_alive,
+        "resident_on": resident,
+        "checked_at": max(probes) if probes else None,
+        "warm_latency_seconds": min(latencies) if latencies else None,
+        "backends": state["backends"],
+        "error": state["error"],
+    }
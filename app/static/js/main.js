@@ -104,17 +104,36 @@ document.addEventListener('DOMContentLoaded', function() {
         }
 
         try {
-            const response = await fetch('/process', {
+            const response = await fetch('/process_stream', {
                 method: 'POST',
                 body: formData
             });
 
-            const data = await response.json();
-            if (response.ok) {
-                displayResults(data);
-                resultsSection.classList.remove('d-none');
-            } else {
+            const contentType = response.headers.get('Content-Type') || '';
+            if (!response.ok || !contentType.includes('application/x-ndjson')) {
+                const data = await response.json();
                 showAlert(data.error || 'An error occurred while processing the document.', 'danger');
+                return;
+            }
+
+            // Read the NDJSON stream: the document, then features, then each batch of trial verdicts.
+            // The events are collected into the same shape as the /process response.
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            const result = { features: {}, matched_trials: [] };
+
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
+                for (const line of lines) {
+                    if (line.trim()) {
+                        handleStreamEvent(JSON.parse(line), result);
+                    }
+                }
             }
         } catch (error) {
             showAlert('An error occurred while processing the document.', 'danger');
@@ -123,6 +142,35 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
+    // Handle a single event from /process_stream, updating `result` and the page
+    function handleStreamEvent(event, result) {
+        switch (event.event) {
+            case 'document':
+                result.text = event.text;
+                result.pdf_filename = event.pdf_filename;
+                break;
+            case 'features':
+                result.features = event.features;
+                result.highlights = event.highlights;
+                displayFeatures(result.features);
+                if (resultsSection) resultsSection.classList.remove('d-none');
+                break;
+            case 'screened':
+            case 'trials':
+                result.matched_trials = result.matched_trials.concat(event.verdicts || []);
+                result.matched_trials.sort((a, b) => (b.match_score || 0) - (a.match_score || 0));
+                displayMatches(result.matched_trials);
+                break;
+            case 'done':
+                result.matched_trials = event.matched_trials || result.matched_trials;
+                displayResults(result);
+                break;
+            case 'error':
+                showAlert(event.error || 'An error occurred while processing the document.', 'danger');
+                break;
+        }
+    }
+
     // Display the extracted features and matched trials
     function displayResults(data) {
         displayFeatures(data.features);
@@ -1,7 +1,6 @@
 #  `app/utils.py` 
 import os
 import json
-import pdfplumber
 import logging
 import requests
 import re
@@ -9,20 +8,12 @@ import time
 import shutil
 from datetime import datetime, timedelta
 from flask import current_app
+# PDF text extraction lives in app.core.pdf_extraction; kept importable from here
+from app.core.pdf_extraction import extract_text_from_pdf
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def extract_text_from_pdf(pdf_stream):
-    text = ""
-    try:
-        with pdfplumber.open(pdf_stream) as pdf:
-            for page in pdf.pages:
-                text += (page.extract_text() or "") + "\n"
-        return text.strip()
-    except Exception as e:
-        logging.error(f"Error extracting text from PDF: {str(e)}")
-        raise Exception(f"Could not extract text from PDF: {str(e)}")
 ''' 
 def extract_features(text):
     try:
@@ -345,211 +336,6 @@ def clean_expired_files(max_age_minutes=30):
     except Exception as e:
         logging.error(f"Errore durante la pulizia dei file scaduti: {str(e)}")
 '''
-def basic_feature_extraction(text):
-
-    features = {
-        "age": {"value": None, "source": ""},
-        "gender": {"value": None, "source": ""},
-        "diagnosis": {"value": None, "source": ""},
-        "stage": {"value": None, "source": ""},
-        "ecog": {"value": None, "source": ""},
-        "mutations": [],
-        "metastases": [],
-        "previous_treatments": [],
-        "lab_values": {}
-    }
-
-    # Salviamo anche il testo originale per mostrarlo nella UI
-    features["original_text"] = text
-
-    # Basic age extraction
-    age_match = re.search(r'(\d+)[\s-]*(?:year|yr)s?[\s-]*old', text, re.IGNORECASE)
-    if age_match:
-        features["age"]["value"] = int(age_match.group(1))
-        features["age"]["source"] = age_match.group(0)
-
-    # Basic gender extraction
-    if re.search(r'\b(male|man)\b', text, re.IGNORECASE):
-        features["gender"]["value"] = "male"
-        features["gender"]["source"] = "male reference in text"
-    elif re.search(r'\b(female|woman)\b', text, re.IGNORECASE):
-        features["gender"]["value"] = "female"
-        features["gender"]["source"] = "female reference in text"
-
-    # Basic diagnosis patterns
-    cancer_types = [
-        "lung cancer", "breast cancer", "colorectal cancer", "prostate cancer",
-        "melanoma", "leukemia", "lymphoma", "pancreatic cancer", "ovarian cancer",
-        "non-small cell lung cancer", "NSCLC", "small cell lung cancer", "SCLC",
-        "glioblastoma", "glioma", "hepatocellular carcinoma", "HCC"
-    ]
-
-    for cancer in cancer_types:
-        if cancer.lower() in text.lower():
-            features["diagnosis"]["value"] = cancer
-
-            # Try to find a more precise context
-            context_match = re.search(r'([^.]*' + re.escape(cancer) + r'[^.]*\.)', text, re.IGNORECASE)
-            if context_match:
-                features["diagnosis"]["source"] = context_match.group(1).strip()
-            else:
-                features["diagnosis"]["source"] = f"contains '{cancer}'"
-
-            break
-
-    # Stage extraction
-    stage_match = re.search(r'stage\s+(I{1,3}V?|IV|III|II|I)([A-C])?', text, re.IGNORECASE)
-    if stage_match:
-        features["stage"]["value"] = stage_match.group(1) + (stage_match.group(2) or "")
-        features["stage"]["source"] = stage_match.group(0)
-
-    # ECOG extraction
-    ecog_match = re.search(r'ECOG\s*(?:PS|performance status)?\s*(?:of|:)?\s*([0-4])', text, re.IGNORECASE)
-    if ecog_match:
-        features["ecog"]["value"] = int(ecog_match.group(1))
-        features["ecog"]["source"] = ecog_match.group(0)
-
-    # Common mutations
-    mutations = [
-        "EGFR", "ALK", "ROS1", "BRAF V600E", "KRAS", "HER2", "BRCA1", "BRCA2", 
-        "PD-L1", "MSI-H", "dMMR", "NTRK", "RET", "MET"
-    ]
-
-    # Tracciamo le mutazioni già trovate per evitare duplicati
-    found_mutations = set()
-
-    for mutation in mutations:
-        # Se la mutazione è già stata trovata, saltiamo
-        if mutation in found_mutations:
-            continue
-
-        pattern = r'([^.]*\b' + re.escape(mutation) + r'\b[^.]*\.)'
-        best_match = None
-        best_match_text = ""
-
-        # Cerchiamo tutte le occorrenze e manteniamo la migliore (quella con più informazioni)
-        for match in re.finditer(pattern, text, re.IGNORECASE):
-            match_text = match.group(0).strip()
-
-            # Se è la prima occorrenza o è più informativa della precedente
-            if best_match is None or len(match_text) > len(best_match_text):
-                # Controlliamo se contiene termini specifici come "mutazione" o "mut" che indicano informazioni più specifiche
-                specificity_terms = ["mutazione", "mut ", "mut:", "mutation", "alterazione", "delezione", "inserzione", "traslocazione"]
-                current_specificity = any(term in match_text.lower() for term in specificity_terms)
-                previous_specificity = any(term in best_match_text.lower() for term in specificity_terms) if best_match_text else False
-
-                # Se la nuova è più specifica o la precedente non era specifica
-                if current_specificity or not previous_specificity:
-                    best_match = match
-                    best_match_text = match_text
-
-        # Se abbiamo trovato almeno un'occorrenza per questa mutazione
-        if best_match is not None:
-            features["mutations"].append({
-                "value": mutation,
-                "source": best_match_text
-            })
-            found_mutations.add(mutation)
-
-    # Common metastasis sites
-    metastasis_sites = [
-        "brain", "liver", "bone", "lung", "adrenal", "lymph node", 
-        "peritoneal", "pleural", "skin"
-    ]
-
-    # Tracciamo i siti metastatici già trovati per evitare duplicati
-    found_metastases = set()
-
-    for site in metastasis_sites:
-        # Se il sito è già stato trovato, saltiamo
-        if site in found_metastases:
-            continue
-
-        pattern = r'([^.]*\b' + re.escape(site) + r'(?:\s+metastases|\s+metastasis|\s+lesions|\s+mets|\s+spread)[^.]*\.)'
-        best_match = None
-        best_match_text = ""
-
-        # Cerchiamo tutte le occorrenze e manteniamo la migliore (quella con più informazioni)
-        for match in re.finditer(pattern, text, re.IGNORECASE):
-            match_text = match.group(0).strip()
-
-            # Se è la prima occorrenza o è più informativa della precedente
-            if best_match is None or len(match_text) > len(best_match_text):
-                best_match = match
-                best_match_text = match_text
-
-        # Se abbiamo trovato almeno un'occorrenza per questo sito metastatico
-        if best_match is not None:
-            features["metastases"].append({
-                "value": site,
-                "source": best_match_text
-            })
-            found_metastases.add(site)
-
-    # Common treatments
-    treatments = [
-        "chemotherapy", "radiation", "surgery", "immunotherapy", 
-        "carboplatin", "cisplatin", "paclitaxel", "docetaxel", "pembrolizumab",
-        "nivolumab", "atezolizumab", "durvalumab", "trastuzumab", "osimertinib",
-        "erlotinib", "gefitinib", "crizotinib", "alectinib", "cetuximab"
-    ]
-
-    # Tracciamo i trattamenti già trovati per evitare duplicati
-    found_treatments = set()
-
-    for treatment in treatments:
-        # Se il trattamento è già stato trovato, saltiamo
-        if treatment in found_treatments:
-            continue
-
-        pattern = r'([^.]*\b(?:previous|prior|received|treated with|therapy with)\s[^.]*\b' + re.escape(treatment) + r'\b[^.]*\.)'
-        best_match = None
-        best_match_text = ""
-
-        # Cerchiamo tutte le occorrenze e manteniamo la migliore
-        for match in re.finditer(pattern, text, re.IGNORECASE):
-            match_text = match.group(0).strip()
-
-            # Se è la prima occorrenza o è più informativa della precedente
-            if best_match is None or len(match_text) > len(best_match_text):
-                # Controlliamo se contiene termini specifici come "cicli" o "dosaggio" che indicano informazioni più specifiche
-                specificity_terms = ["cicli", "ciclo", "dose", "dosaggio", "mg", "gr", "effetti collaterali", "tossicità"]
-                current_specificity = any(term in match_text.lower() for term in specificity_terms)
-                previous_specificity = any(term in best_match_text.lower() for term in specificity_terms) if best_match_text else False
-
-                # Se la nuova è più specifica o la precedente non era specifica
-                if current_specificity or not previous_specificity:
-                    best_match = match
-                    best_match_text = match_text
-
-        # Se abbiamo trovato almeno un'occorrenza per questo trattamento
-        if best_match is not None:
-            features["previous_treatments"].append({
-                "value": treatment,
-                "source": best_match_text
-            })
-            found_treatments.add(treatment)
-
-    # Common lab values
-    lab_tests = {
-        "hemoglobin": r'(?:Hgb|Hemoglobin|Hb)[\s:]+(\d+\.?\d*)\s*(?:g/dL|g/dl)',
-        "wbc": r'(?:WBC|White blood cells?)[\s:]+(\d+\.?\d*)\s*(?:K/μL|x10\^9/L)',
-        "platelets": r'(?:PLT|Platelets)[\s:]+(\d+\.?\d*)\s*(?:K/μL|x10\^9/L)',
-        "creatinine": r'(?:Cr|Creatinine)[\s:]+(\d+\.?\d*)\s*(?:mg/dL|mg/dl)',
-        "alt": r'(?:ALT|SGPT)[\s:]+(\d+\.?\d*)\s*(?:U/L|IU/L)',
-        "ast": r'(?:AST|SGOT)[\s:]+(\d+\.?\d*)\s*(?:U/L|IU/L)'
-    }
-
-    for lab_name, pattern in lab_tests.items():
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            features["lab_values"][lab_name] = {
-                "value": match.group(0),
-                "source": match.group(0)
-            }
-
-    return features
-
 def match_trials(patient_features):
 
     try:
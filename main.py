@@ -52,18 +52,20 @@ logging.basicConfig(
 logger = logging.getLogger("medmatchint")
 logger.setLevel(logging.INFO)
 
-# Create the Flask app using the factory pattern
-app = create_app()
+# Create the Flask app using the factory pattern. The PDF extraction pool processes
+# re-import this file as __mp_main__: they must not create (and warm up) another app.
+if __name__ != '__mp_main__':
+    app = create_app()
 
-with app.app_context():
-    logger.info("🔧 Ensuring database schema is ready...")
-    
-    try:
-        # Initialize the database schema within the app context
-        db.create_all()  
-        logger.info("✅ Database schema is ready.")
-    except Exception as e:
-        logger.error(f"❌ Error ensuring database schema: {str(e)}")
+    with app.app_context():
+        logger.info("🔧 Ensuring database schema is ready...")
+
+        try:
+            # Initialize the database schema within the app context
+            db.create_all()
+            logger.info("✅ Database schema is ready.")
+        except Exception as e:
+            logger.error(f"❌ Error ensuring database schema: {str(e)}")
 
 # Running the app
 if __name__ == '__main__':
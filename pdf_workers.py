@@ -0,0 +1,199 @@
+# pdf_workers.py
+"""
+Lettura del testo delle pagine PDF, eseguita anche nei processi del pool di
+app/core/pdf_extraction.py. Il fork server precarica solo questo modulo: non deve
+importare nulla da `app` (il pacchetto crea l'app Flask, il database e i moduli LLM),
+altrimenti ogni processo del pool caricherebbe l'intera applicazione.
+"""
+import io
+import re
+import time
+import logging
+import unicodedata
+from typing import List, NamedTuple, Optional, Union
+
+import pdfplumber
+from pdfminer.pdfdevice import PDFTextDevice
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdffont import PDFUnicodeNotDefined
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdftypes import resolve1
+
+logger = logging.getLogger(__name__)
+
+PdfSource = Union[str, bytes]
+
+# Quality limits of the fast text: beyond these the page is re-extracted with pdfplumber
+MAX_GARBAGE_RATIO = 0.02   # unmapped glyphs (U+FFFD, "(cid:N)"), control and private-use characters
+MIN_GLYPH_DENSITY = 0.9    # characters in the text per glyph drawn on the page
+MIN_CHARS_PER_AREA = 5e-5  # characters per square point (25 on an A4 page): scans have fewer
+MAX_MEAN_WORD_LENGTH = 15  # clinical Italian averages 6-7; longer "words" mean lost spaces
+MIN_MEAN_LINE_LENGTH = 3   # shorter lines mean the glyphs were drawn out of reading order
+
+# How pdfminer and pdfplumber write a glyph whose code has no Unicode mapping
+CID_GLYPH = re.compile(r"\(cid:\d+\)")
+
+
+class PageText(NamedTuple):
+    text: str
+    seconds: float
+    extractor: str
+    glyphs: Optional[int] = None  # glyphs drawn (fast path only), for the density check
+    area: Optional[float] = None  # page size in square points (fast path only), for the sparse check
+    fallback: Optional[str] = None  # why the fast text was discarded
+
+
+def _stream(source: PdfSource):
+    return open(source, "rb") if isinstance(source, str) else io.BytesIO(source)
+
+
+def _open(source: PdfSource, pages: List[int] = None):
+    return pdfplumber.open(source if isinstance(source, str) else io.BytesIO(source), pages=pages)
+
+
+def page_count(source: PdfSource) -> int:
+    with _stream(source) as fp:
+        document = PDFDocument(PDFParser(fp))
+        try:
+            return int(resolve1(resolve1(document.catalog["Pages"])["Count"]))
+        except Exception:
+            # Broken page tree: count the pages pdfminer can actually reach
+            return sum(1 for _ in PDFPage.create_pages(document))
+
+
+class _StreamTextDevice(PDFTextDevice):
+    """
+    Testo nell'ordine del content stream, senza oggetti di layout: ogni glifo viene
+    decodificato e accodato; a capo quando cambia la linea di base, spazio quando
+    c'è un salto orizzontale tra due glifi.
+    """
+
+    def reset(self):
+        self.parts = []
+        self.glyphs = 0
+        self._last = None  # (x where the previous glyph ends, baseline, font height)
+
+    def render_char(self, matrix, font, fontsize, scaling, rise, cid, ncs, graphicstate) -> float:
+        try:
+            text = font.to_unichr(cid)
+        except PDFUnicodeNotDefined:
+            text = "\ufffd"
+        advance = font.char_width(cid) * fontsize * scaling
+        a, b, c, d, x, y = matrix
+        height = fontsize * (abs(d) or abs(a) or 1)
+        if self._last is not None:
+            last_x, last_y, last_height = self._last
+            if abs(y - last_y) > 0.5 * max(height, last_height):
+                self.parts.append("\n")
+            elif x - last_x > 0.15 * height and text != " " and self.parts[-1] != " ":
+                self.parts.append(" ")
+        self.parts.append(text)
+        if not text.isspace():
+            self.glyphs += 1
+        self._last = (x + advance * a, y, height)
+        return advance
+
+    def text(self) -> str:
+        return "".join(self.parts).strip()
+
+
+class PdfTextExtractor:
+    """Interfaccia degli estrattori: testo delle pagine [start, end) del PDF, in ordine."""
+    name = None
+
+    def extract(self, source: PdfSource, start: int, end: int) -> List[PageText]:
+        raise NotImplementedError
+
+
+class PdfplumberExtractor(PdfTextExtractor):
+    """Estrazione completa: oggetti carattere e layout di pdfplumber (lenta, la più robusta)."""
+    name = "pdfplumber"
+
+    def extract(self, source: PdfSource, start: int, end: int) -> List[PageText]:
+        pages = []
+        with _open(source, pages=list(range(start + 1, end + 1))) as pdf:
+            for page in pdf.pages:
+                started = time.perf_counter()
+                text = page.extract_text() or ""
+                pages.append(PageText(text, time.perf_counter() - started, self.name))
+        return pages
+
+
+class PdfminerStreamExtractor(PdfTextExtractor):
+    """Percorso veloce: content stream di pdfminer con analisi del layout disattivata."""
+    name = "pdfminer"
+
+    def extract(self, source: PdfSource, start: int, end: int) -> List[PageText]:
+        pages = []
+        with _stream(source) as fp:
+            manager = PDFResourceManager(caching=True)
+            device = _StreamTextDevice(manager)
+            interpreter = PDFPageInterpreter(manager, device)
+            for page in PDFPage.get_pages(fp, pagenos=set(range(start, end))):
+                started = time.perf_counter()
+                device.reset()
+                interpreter.process_page(page)
+                x0, y0, x1, y1 = page.cropbox
+                pages.append(PageText(device.text(), time.perf_counter() - started, self.name, device.glyphs,
+                                      area=abs((x1 - x0) * (y1 - y0))))
+        return pages
+
+
+def fast_text_problem(page: PageText) -> Optional[str]:
+    """
+    Motivo per scartare il testo del percorso veloce (None se sembra corretto):
+    "sparse" (poco o nessun testo per l'area della pagina: scansione o testo disegnato
+    come immagine), "garbage" (glifi senza Unicode, caratteri di controllo o privati),
+    "density" (meno caratteri dei glifi disegnati), "spacing" (parole attaccate),
+    "order" (righe di uno o due caratteri: glifi fuori dall'ordine di lettura).
+    """
+    text = CID_GLYPH.sub("\ufffd", page.text)
+    characters = [c for c in text if not c.isspace()]
+    if page.area and len(characters) < MIN_CHARS_PER_AREA * page.area:
+        return "sparse"
+    if not characters:
+        return None
+    garbage = sum(1 for c in characters if c == "\ufffd" or unicodedata.category(c) in ("Cc", "Co"))
+    if garbage > MAX_GARBAGE_RATIO * len(characters):
+        return "garbage"
+    if page.glyphs and len(characters) < MIN_GLYPH_DENSITY * page.glyphs:
+        return "density"
+    if len(characters) >= 100:
+        if len(characters) / len(text.split()) > MAX_MEAN_WORD_LENGTH:
+            return "spacing"
+        lines = [line for line in text.split("\n") if line.strip()]
+        if len(characters) / len(lines) < MIN_MEAN_LINE_LENGTH:
+            return "order"
+    return None
+
+
+class AutoExtractor(PdfTextExtractor):
+    """Percorso veloce; le pagine il cui testo sembra rotto vengono rilette con pdfplumber."""
+    name = "auto"
+
+    def extract(self, source: PdfSource, start: int, end: int) -> List[PageText]:
+        try:
+            pages = EXTRACTORS["pdfminer"].extract(source, start, end)
+        except Exception as e:
+            logger.warning(f"⚠️ Fast PDF extraction failed on pages {start + 1}-{end} ({e}), using pdfplumber")
+            return [page._replace(fallback="error") for page in EXTRACTORS["pdfplumber"].extract(source, start, end)]
+        broken = {index: reason for index, page in enumerate(pages) if (reason := fast_text_problem(page))}
+        if broken:
+            with _open(source, pages=[start + index + 1 for index in broken]) as pdf:
+                for index, page in zip(broken, pdf.pages):
+                    started = time.perf_counter()
+                    text = page.extract_text() or ""
+                    seconds = pages[index].seconds + time.perf_counter() - started
+                    pages[index] = PageText(text, seconds, "pdfplumber", fallback=broken[index])
+        return pages
+
+
+EXTRACTORS = {extractor.name: extractor for extractor in (PdfplumberExtractor(), PdfminerStreamExtractor(),
+                                                           AutoExtractor())}
+
+
+def extract_page_range(source: PdfSource, start: int, end: int, extractor: str) -> List[PageText]:
+    """Task del process pool: pagine [start, end) con l'estrattore indicato."""
+    return EXTRACTORS[extractor].extract(source, start, end)
@@ -1,7 +1,14 @@
 # scripts/__init__.py
 __all__ = [
+    'bench_drug_normalization',
+    'bench_highlight',
+    'bench_pdf_extraction',
+    'bench_pdf_extractors',
+    'bench_pre_extraction',
     'database_utils',
     'db_init',
+    'ollama_stub',
+    'replay_cascade',
     'trials_manager',
     'update_trials'
 ]
\ No newline at end of file
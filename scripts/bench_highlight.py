@@ -0,0 +1,109 @@
+# scripts/bench_highlight.py
+"""
+Benchmark of the source highlighter (app/core/highlighting.py) on long letters.
+
+Builds a synthetic clinical letter of --pages pages (about 3000 characters each) and a
+set of *_source_text snippets, then compares the previous implementation (one re.sub
+over the whole document per key) with the single-pass engine:
+
+    python scripts/bench_highlight.py --pages 100 --sources 24
+
+It also reports how many <mark> tags end up nested inside another one, which the
+per-key re.sub produced for overlapping sources.
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from app.core.highlighting import collect_sources, find_source_spans, render_highlights
+
+PAGE = """Visita di controllo del {day:02d}/{month:02d}/2024 - pagina {page}
+Sintesi Clinica: paziente di 67 anni con adenocarcinoma polmonare stadio IVB, EGFR Exon 19 deletion.
+ECOG PS 1. PD-L1 TPS 60%. In trattamento con osimertinib 80 mg/die, ben tollerato.
+TC torace-addome del {day:02d}/{month:02d}/2024: stabilità dei secondarismi linfonodali, pleurici ed ossei.
+Non si evidenziano metastasi cerebrali alla RM encefalo. Funzionalità renale ed epatica nella norma.
+COMORBIDITÀ: ipertensione arteriosa in terapia, diabete mellito tipo 2, dislipidemia.
+Terapie domiciliari: Losaprex (losartan) 50 mg, Omeprazolo 20 mg, metformina 1000 mg x 2.
+"""
+
+SOURCES = [
+    "paziente di 67 anni", "adenocarcinoma polmonare", "adenocarcinoma polmonare stadio IVB",
+    "stadio IVB", "EGFR Exon 19 deletion", "Exon 19", "ECOG PS 1", "PD-L1 TPS 60%", "TPS 60%",
+    "osimertinib 80 mg/die", "osimertinib", "secondarismi linfonodali, pleurici ed ossei",
+    "pleurici ed ossei", "Non si evidenziano metastasi cerebrali", "metastasi cerebrali",
+    "ipertensione arteriosa", "diabete mellito tipo 2", "dislipidemia", "Losaprex (losartan)",
+    "losartan", "Omeprazolo", "metformina", "RM encefalo", "Funzionalità renale",
+]
+
+
+def build_letter(pages: int) -> str:
+    padding = "Esame obiettivo: torace con murmure vescicolare conservato, addome trattabile. " * 25
+    return "\n".join(PAGE.format(day=page % 28 + 1, month=page % 12 + 1, page=page + 1) + padding
+                     for page in range(pages))
+
+
+def per_key_sub(text: str, features: dict) -> str:
+    # Previous implementation of highlight_sources
+    for key, value in features.items():
+        if key.endswith('_source_text') and isinstance(value, str) and value.strip():
+            escaped = re.escape(value.strip())
+            text = re.sub(f"({escaped})", r'<mark>\1</mark>', text, flags=re.IGNORECASE)
+    return text
+
+
+def single_pass(text: str, features: dict) -> str:
+    return render_highlights(text, find_source_spans(text, collect_sources(features)))
+
+
+def nested_marks(html: str) -> int:
+    depth, nested = 0, 0
+    for tag in re.findall(r"</?mark>", html):
+        if tag == "<mark>":
+            depth += 1
+            nested += depth > 1
+        else:
+            depth -= 1
+    return nested
+
+
+def best_of(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare per-key re.sub with the single-pass highlighter.')
+    parser.add_argument('--pages', type=int, default=100, help='pages in the synthetic letter')
+    parser.add_argument('--sources', type=int, default=len(SOURCES), help='number of *_source_text keys')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per implementation (best is reported)')
+    args = parser.parse_args()
+
+    text = build_letter(args.pages)
+    features = {f"field{index}_source_text": SOURCES[index % len(SOURCES)] for index in range(args.sources)}
+
+    legacy = per_key_sub(text, features)
+    spans = find_source_spans(text, collect_sources(features))
+    report = {
+        "pages": args.pages,
+        "chars": len(text),
+        "sources": args.sources,
+        "per_key_sub_ms": round(best_of(lambda: per_key_sub(text, features), args.repeat), 2),
+        "single_pass_ms": round(best_of(lambda: single_pass(text, features), args.repeat), 2),
+        "spans_only_ms": round(best_of(lambda: find_source_spans(text, collect_sources(features)), args.repeat), 2),
+        "spans": len(spans),
+        "nested_marks_per_key_sub": nested_marks(legacy),
+        "nested_marks_single_pass": nested_marks(render_highlights(text, spans)),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# scripts/bench_pdf_extraction.py
+"""
+Benchmark of PDF text extraction (app/core/pdf_extraction.py): serial page walk vs the
+page-range process pool.
+
+Builds synthetic clinical letters of 1, 20 and 200 pages (plain PDF with text content,
+no extra dependency) and times both paths, checking they return the same text:
+
+    python scripts/bench_pdf_extraction.py --pages 1 20 200 --workers 4
+
+Real documents can be added with --pdf (e.g. anonymised referral bundles).
+The first parallel run starts the worker processes and is reported separately.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from app.core.pdf_extraction import extract_pdf_pages, pdf_settings
+
+LINES = [
+    "Visita di controllo del {day:02d}/03/2024 - pagina {page}",
+    "Sintesi Clinica: paziente di 67 anni con adenocarcinoma polmonare stadio IVB.",
+    "EGFR Exon 19 deletion. ECOG PS 1. PD-L1 TPS 60%.",
+    "In trattamento con osimertinib 80 mg/die, ben tollerato.",
+    "TC torace-addome: stabilita dei secondarismi linfonodali, pleurici ed ossei.",
+    "Non si evidenziano metastasi cerebrali alla RM encefalo.",
+    "COMORBIDITA: ipertensione arteriosa, diabete mellito tipo 2, dislipidemia.",
+    "Terapie domiciliari: Losaprex 50 mg, Omeprazolo 20 mg, metformina 1000 mg x 2.",
+]
+
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+# Composite font without a ToUnicode map: glyph codes cannot be turned back into text,
+# like in some scanned-then-OCR'd or "printed to PDF" documents
+UNMAPPED_FONT = (b"<< /Type /Font /Subtype /Type0 /BaseFont /Unmapped /Encoding /Identity-H "
+                 b"/DescendantFonts [<< /Type /Font /Subtype /CIDFontType2 /BaseFont /Unmapped "
+                 b"/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> /DW 500 >>] >>")
+
+
+def build_pdf(pages: int, lines_per_page: int = 48, unmapped: bool = False) -> bytes:
+    """PDF minimale (Helvetica, una colonna di testo per pagina) scritto a mano."""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               UNMAPPED_FONT if unmapped else b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page in range(pages):
+        rows = [LINES[row % len(LINES)].format(day=page % 28 + 1, page=page + 1) for row in range(lines_per_page)]
+        if unmapped:
+            shown = " ".join("<%s> '" % "".join(f"{ord(c):04X}" for c in row) for row in rows)
+        else:
+            shown = " ".join(f"({_escape(row)}) '" for row in rows)
+        stream = f"BT /F1 10 Tf 12 TL 40 800 Td {shown} ET".encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects))
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % kid for kid in kids), len(kids))
+
+    out, offsets = [b"%PDF-1.4\n"], []
+    position = len(out[0])
+    for number, body in enumerate(objects, start=1):
+        chunk = b"%d 0 obj\n%s\nendobj\n" % (number, body)
+        offsets.append(position)
+        out.append(chunk)
+        position += len(chunk)
+    out.append(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    out.extend(b"%010d 00000 n \n" % offset for offset in offsets)
+    out.append(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, position))
+    return b"".join(out)
+
+
+def timed(fn):
+    started = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - started
+
+
+def bench(name: str, data, config: dict, repeat: int) -> dict:
+    serial_runs, parallel_runs = [], []
+    for _ in range(repeat):
+        serial, seconds = timed(lambda: extract_pdf_pages(data, config, parallel=False))
+        serial_runs.append(seconds)
+        parallel, seconds = timed(lambda: extract_pdf_pages(data, config, parallel=True))
+        parallel_runs.append(seconds)
+    page_seconds = [page["seconds"] for page in serial]
+    return {
+        "document": name,
+        "pages": len(serial),
+        "serial_s": round(min(serial_runs), 3),
+        "parallel_s": round(min(parallel_runs), 3),
+        "speedup": round(min(serial_runs) / min(parallel_runs), 2),
+        "page_ms_mean": round(1000 * sum(page_seconds) / max(len(page_seconds), 1), 2),
+        "page_ms_max": round(1000 * max(page_seconds, default=0), 2),
+        "same_text": [page["text"] for page in serial] == [page["text"] for page in parallel],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare serial and process-pool PDF text extraction.')
+    parser.add_argument('--pages', type=int, nargs='+', default=[1, 20, 200], help='synthetic document sizes')
+    parser.add_argument('--pdf', nargs='*', default=[], help='real PDF files to include')
+    parser.add_argument('--workers', type=int, default=0, help='pool size (0 = auto, as PDF_EXTRACTION_WORKERS)')
+    parser.add_argument('--pages-per-task', type=int, default=8, help='pages per pool task')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per path (best is reported)')
+    args = parser.parse_args()
+
+    config = {"PDF_EXTRACTION_WORKERS": args.workers, "PDF_PAGES_PER_TASK": args.pages_per_task}
+    documents = [(f"synthetic-{pages}p", build_pdf(pages)) for pages in args.pages]
+    documents += [(os.path.basename(path), path) for path in args.pdf]
+
+    # Pool start-up (fork server + workers) is paid once per process, not per request
+    _, startup = timed(lambda: extract_pdf_pages(documents[0][1], config, parallel=True))
+    report = {
+        "cpus": os.cpu_count(),
+        "workers": pdf_settings(config)["workers"],
+        "pool_startup_s": round(startup, 3),
+        "results": [bench(name, data, config, args.repeat) for name, data in documents],
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# scripts/bench_pdf_extractors.py
+"""
+Benchmark of the PDF text extractors (pdf_workers.py): the pdfminer text
+stream (no layout analysis), pdfplumber and "auto" (fast path with per-page fallback).
+
+For each extractor reports pages/sec over the corpus and, against pdfplumber, the
+output-diff rate (pages whose whitespace-normalized text differs) and the mean text
+similarity; for "auto" also how many pages fell back and why:
+
+    python scripts/bench_pdf_extractors.py --pdf path/to/letters/ other.pdf
+
+Without --pdf a synthetic corpus is used (clean letters plus one PDF whose font has no
+ToUnicode map, which must fall back).
+"""
+import os
+import sys
+import json
+import time
+import difflib
+import argparse
+from collections import Counter
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from pdf_workers import EXTRACTORS, page_count
+from scripts.bench_pdf_extraction import build_pdf
+
+
+def normalized(text: str) -> str:
+    return " ".join(text.split())
+
+
+def load_corpus(paths):
+    documents = []
+    for path in paths:
+        if os.path.isdir(path):
+            documents += [(name, os.path.join(path, name)) for name in sorted(os.listdir(path))
+                          if name.lower().endswith('.pdf')]
+        else:
+            documents.append((os.path.basename(path), path))
+    corpus = []
+    for name, path in documents:
+        with open(path, 'rb') as f:
+            corpus.append((name, f.read()))
+    return corpus
+
+
+def run(extractor: str, corpus, repeat: int):
+    """Migliore di `repeat` passate sul corpus: (secondi, pagine per documento)."""
+    best, pages = None, None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        pages = [EXTRACTORS[extractor].extract(data, 0, page_count(data)) for _, data in corpus]
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the fast PDF text path with pdfplumber.')
+    parser.add_argument('--pdf', nargs='*', default=[], help='PDF files or directories (the corpus)')
+    parser.add_argument('--pages', type=int, default=20, help='pages per synthetic document')
+    parser.add_argument('--repeat', type=int, default=3, help='passes per extractor (best is reported)')
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.pdf) if args.pdf else [
+        ("synthetic-letter", build_pdf(args.pages)),
+        ("synthetic-short", build_pdf(1)),
+        ("synthetic-unmapped-font", build_pdf(2, unmapped=True)),
+    ]
+    results = {name: run(name, corpus, args.repeat) for name in ("pdfplumber", "pdfminer", "auto")}
+    reference = [page.text for document in results["pdfplumber"][1] for page in document]
+
+    report = {"documents": len(corpus), "pages": len(reference), "extractors": {}}
+    for name, (seconds, documents) in results.items():
+        texts = [page.text for document in documents for page in document]
+        ratios = [difflib.SequenceMatcher(None, normalized(a), normalized(b), autojunk=False).ratio()
+                  for a, b in zip(texts, reference)]
+        entry = {
+            "seconds": round(seconds, 3),
+            "pages_per_s": round(len(texts) / seconds, 1) if seconds else None,
+            "diff_rate": round(sum(normalized(a) != normalized(b) for a, b in zip(texts, reference))
+                               / max(len(texts), 1), 3),
+            "mean_similarity": round(sum(ratios) / max(len(ratios), 1), 4),
+        }
+        if name == "auto":
+            entry["fallbacks"] = dict(Counter(page.fallback for document in documents
+                                              for page in document if page.fallback))
+        report["extractors"][name] = entry
+    speedup = results["pdfplumber"][0] / results["auto"][0] if results["auto"][0] else None
+    report["auto_speedup"] = round(speedup, 2) if speedup else None
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
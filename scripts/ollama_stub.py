@@ -0,0 +1,147 @@
+# scripts/ollama_stub.py
+"""
+Stub HTTP servers that mimic the parts of the Ollama API used by MedMatchINT
+(/api/generate with and without streaming, /api/ps, /api/tags).
+
+Useful to exercise the backend pool, timeouts and streaming without a GPU:
+
+    python scripts/ollama_stub.py --port 11501 --count 3 --delay 1.5
+    OLLAMA_SERVER_URLS=http://127.0.0.1:11501,http://127.0.0.1:11502,http://127.0.0.1:11503 flask run
+"""
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def fake_answer(prompt: str, structured: bool = False) -> str:
+    """
+    Risposta plausibile in base al tipo di prompt (matching, farmaci, timeline, feature).
+    Con `structured` (richiesta con "format") le liste sono avvolte nell'oggetto dello schema.
+    """
+    def wrap(key, items):
+        return json.dumps({key: items} if structured else items)
+
+    if "### TRIALS:" in prompt:
+        trial_ids = re.findall(r'"id": "(NCT\d+)"', prompt)
+        return wrap("verdicts", [
+            {
+                "trial_id": trial_id,
+                "title": "Stub trial",
+                "description": "Stub description",
+                "match_score": sum(map(ord, trial_id)) % 101,
+                "overall_recommendation": "NOT ELIGIBLE",
+                "criteria_analysis": "Stub analysis",
+                "summary": "Stub summary",
+            }
+            for trial_id in trial_ids
+        ])
+    lowered = prompt.lower()
+    if "medication" in lowered:
+        return wrap("medications", [{"medication": "losartan", "dosage": "50 mg", "frequency": "once daily",
+                                     "indication": "hypertension"}])
+    if "timeline" in lowered:
+        return wrap("events", [{"date": "2024-01-15", "event": "Diagnosis", "details": "Stub event"}])
+    return json.dumps({
+        "age": 65, "gender": "male", "ecog_ps": 1, "histology": "adenocarcinoma",
+        "current_stage": "IV", "line_of_therapy": "1L", "pd_l1_tps": ">=50%",
+        "biomarkers": "KRAS_G12C", "brain_metastasis": ["false"],
+        "prior_systemic_therapies": ["not mentioned"], "comorbidities": ["not mentioned"],
+        "concomitant_treatments": ["losartan"],
+    })
+
+
+def make_handler(model: str, delay: float, fail_rate: float, name: str):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, fmt, *args):
+            sys.stderr.write(f"[{name}] {fmt % args}\n")
+
+        def _send_json(self, body: dict, status: int = 200):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _write_chunk(self, data: bytes):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+        def do_GET(self):
+            if self.path in ("/api/ps", "/api/tags"):
+                return self._send_json({"models": [{"name": model, "model": model}]})
+            self._send_json({"error": "not found"}, 404)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            if self.path != "/api/generate":
+                return self._send_json({"error": "not found"}, 404)
+            if random.random() < fail_rate:
+                return self._send_json({"error": "stub failure"}, 500)
+
+            time.sleep(delay)
+            prompt = payload.get("prompt", "")
+            text = fake_answer(prompt, structured="format" in payload)
+            stats = {
+                "total_duration": int(delay * 1e9),
+                "load_duration": 1_000_000,
+                "prompt_eval_count": len(prompt) // 4,
+                "prompt_eval_duration": int(delay * 0.3e9),
+                "eval_count": len(text) // 4,
+                "eval_duration": int(delay * 0.6e9),
+            }
+            final = {"model": payload.get("model"), "response": "", "done": True, "context": [1, 2, 3], **stats}
+
+            if not payload.get("stream"):
+                final["response"] = text
+                return self._send_json(final)
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for start in range(0, len(text), 8):
+                chunk = {"model": payload.get("model"), "response": text[start:start + 8], "done": False}
+                self._write_chunk((json.dumps(chunk) + "\n").encode())
+            self._write_chunk((json.dumps(final) + "\n").encode())
+            self.wfile.write(b"0\r\n\r\n")
+
+    return StubHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run one or more stub Ollama servers.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11501, help="port of the first server")
+    parser.add_argument("--count", type=int, default=1, help="number of servers on consecutive ports")
+    parser.add_argument("--delay", type=float, default=0.5, help="seconds per generation")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of generations answered with HTTP 500")
+    parser.add_argument("--model", default="llama3.1:8b", help="model reported as loaded by /api/ps")
+    args = parser.parse_args()
+
+    servers = []
+    for offset in range(args.count):
+        port = args.port + offset
+        handler = make_handler(args.model, args.delay, args.fail_rate, f"stub:{port}")
+        server = ThreadingHTTPServer((args.host, port), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        print(f"✅ Stub Ollama listening on http://{args.host}:{port}")
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# scripts/replay_cascade.py
+"""
+Replay set for the matching cascade: runs trial matching for each saved patient twice,
+with the large model only and with the small → large cascade, and compares rankings
+and GPU time (Ollama total_duration).
+
+Patients are JSON files with the extracted features, either a plain features object or
+a matching debug artifact (logs/debug/matching_*.json.gz, or .json.gz.enc with
+ENCRYPT_AT_REST, which stores them under "llm_text"):
+
+    python scripts/replay_cascade.py logs/debug/matching_*.json.gz --top-k 5 --min-spearman 0.9
+
+The LLM cache is bypassed so both runs really hit Ollama. Exits with status 1 when a
+patient falls outside the tolerances.
+"""
+import os
+import sys
+import json
+import argparse
+import logging
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from app.core.debug_artifacts import read_debug_artifact
+from app.core.feature_extraction import match_trials_llm
+from app.core.llm_cache import bypass_llm_cache
+from app.core.metrics import server_seconds
+from app.core.scheduler import BATCH, llm_priority
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def load_patient(path: str) -> dict:
+    data = read_debug_artifact(path)
+    return data.get("llm_text", data) if isinstance(data, dict) else {}
+
+
+def ranking(verdicts: list) -> list:
+    # Same order as the UI: score descending, ties broken by trial id for determinism
+    ordered = sorted(verdicts, key=lambda v: (-(v.get("match_score") or 0), str(v.get("trial_id"))))
+    return [str(v.get("trial_id")) for v in ordered]
+
+
+def spearman(reference: list, candidate: list) -> float:
+    common = [trial_id for trial_id in reference if trial_id in candidate]
+    n = len(common)
+    if n < 2:
+        return 1.0
+    position = {trial_id: rank for rank, trial_id in enumerate(c for c in candidate if c in common)}
+    d2 = sum((rank - position[trial_id]) ** 2 for rank, trial_id in enumerate(common))
+    return 1 - 6 * d2 / (n * (n * n - 1))
+
+
+def run(features: dict, cascade: bool):
+    before = server_seconds.total()
+    with bypass_llm_cache(), llm_priority(BATCH):
+        verdicts = match_trials_llm(features, cascade=cascade)
+    return verdicts, server_seconds.total() - before
+
+
+def compare(path: str, top_k: int) -> dict:
+    features = load_patient(path)
+    baseline, baseline_seconds = run(features, cascade=False)
+    cascaded, cascade_seconds = run(features, cascade=True)
+
+    reference, candidate = ranking(baseline), ranking(cascaded)
+    baseline_scores = {str(v.get("trial_id")): v.get("match_score") or 0 for v in baseline}
+    score_diffs = [abs(baseline_scores[str(v.get("trial_id"))] - (v.get("match_score") or 0))
+                   for v in cascaded if str(v.get("trial_id")) in baseline_scores]
+    escalated = sum(1 for v in cascaded if v.get("escalated"))
+    return {
+        "patient": path,
+        "trials": len(baseline),
+        "escalated": escalated,
+        "escalation_rate": round(escalated / len(cascaded), 4) if cascaded else 0.0,
+        "spearman": round(spearman(reference, candidate), 4),
+        f"top{top_k}_overlap": round(len(set(reference[:top_k]) & set(candidate[:top_k])) / max(top_k, 1), 4),
+        "mean_abs_score_diff": round(sum(score_diffs) / len(score_diffs), 2) if score_diffs else 0.0,
+        "gpu_seconds_large_only": round(baseline_seconds, 2),
+        "gpu_seconds_cascade": round(cascade_seconds, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare cascade matching with large-model-only matching.')
+    parser.add_argument('patients', nargs='+', help='JSON files with patient features')
+    parser.add_argument('--top-k', type=int, default=5, help='size of the top of the ranking to compare')
+    parser.add_argument('--min-spearman', type=float, default=0.9, help='minimum rank correlation per patient')
+    parser.add_argument('--min-top-k-overlap', type=float, default=0.8, help='minimum top-k overlap per patient')
+    parser.add_argument('--output', help='write the full report to this JSON file')
+    args = parser.parse_args()
+
+    results = [compare(path, args.top_k) for path in args.patients]
+    overlap_key = f"top{args.top_k}_overlap"
+    failures = [r for r in results if r["spearman"] < args.min_spearman or r[overlap_key] < args.min_top_k_overlap]
+
+    large = sum(r["gpu_seconds_large_only"] for r in results)
+    cascade = sum(r["gpu_seconds_cascade"] for r in results)
+    summary = {
+        "patients": len(results),
+        "mean_escalation_rate": round(sum(r["escalation_rate"] for r in results) / len(results), 4),
+        "mean_spearman": round(sum(r["spearman"] for r in results) / len(results), 4),
+        f"mean_{overlap_key}": round(sum(r[overlap_key] for r in results) / len(results), 4),
+        "gpu_seconds_per_patient_large_only": round(large / len(results), 2),
+        "gpu_seconds_per_patient_cascade": round(cascade / len(results), 2),
+        "gpu_seconds_saved": f"{(1 - cascade / large):.0%}" if large else "n/a",
+        "out_of_tolerance": [r["patient"] for r in failures],
+    }
+
+    for r in results:
+        print(f"{r['patient']}: escalated {r['escalated']}/{r['trials']}, spearman {r['spearman']}, "
+              f"{overlap_key} {r[overlap_key]}, GPU-s {r['gpu_seconds_large_only']} → {r['gpu_seconds_cascade']}")
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"summary": summary, "patients": results}, f, indent=2)
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import json
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from app.core.llm_processor import LLMProcessor
+from scripts.ollama_stub import make_handler
+
+BACKEND = "http://ollama.test:11434"
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, body: dict):
+        self.text = json.dumps(body)
+
+
+class RecordingSession:
+    """Risponde a /api/generate senza rete e registra il timeout di ogni chiamata."""
+
+    def __init__(self, answer: str = '{"ok": true}', done_reason: str = "stop"):
+        self.answer = answer
+        self.done_reason = done_reason
+        self.calls = []
+
+    def post(self, url, json=None, stream=False, timeout=None):
+        self.calls.append({"url": url, "payload": json, "timeout": timeout})
+        return FakeResponse({"model": json["model"], "response": self.answer, "done": True,
+                             "done_reason": self.done_reason})
+
+
+@pytest.fixture
+def make_processor(monkeypatch):
+    monkeypatch.delenv("OLLAMA_SERVER_URLS", raising=False)
+
+    def make(answer: str = '{"ok": true}', done_reason: str = "stop", **overrides):
+        """Processor su un solo backend finto; le chiamate sono in `processor.session.calls`."""
+        config = {
+            "LLM_MODEL": "llama3.1:8b",
+            "LLM_CONTEXT_SIZE": 8192,
+            "LLM_TEMPERATURE": 0,
+            "LLM_CACHE_ENABLED": False,
+            "LLM_SINGLE_FLIGHT_ENABLED": False,
+            "OLLAMA_SERVERS": [BACKEND],
+            "OLLAMA_HEALTH_CHECK_INTERVAL": 0,
+            "LLM_CONNECT_TIMEOUT": 3,
+            "LLM_READ_TIMEOUT": 120,
+            "LLM_MAX_RETRIES": 0,
+            **overrides,
+        }
+        return LLMProcessor(config, session=RecordingSession(answer, done_reason))
+    return make
+
+
+@pytest.fixture
+def ollama_stubs():
+    """Avvia server stub di Ollama (scripts/ollama_stub.py) su porte libere; restituisce la funzione."""
+    servers = []
+
+    def start(model: str = "llama3.1:8b", delay: float = 0.0, port: int = 0) -> str:
+        server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(model, delay, 0.0, f"stub:{port}"))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    def stop(url: str):
+        for server in list(servers):
+            if url.endswith(f":{server.server_address[1]}"):
+                server.shutdown()
+                server.server_close()
+                servers.remove(server)
+
+    start.stop = stop
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
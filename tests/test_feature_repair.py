@@ -0,0 +1,80 @@
+import json
+
+from app.core.feature_repair import normalize_field, validate_and_repair
+from app.core.schema_validation import parse_stats
+
+VALID = {
+    "age": 67, "gender": "male", "ecog_ps": 1, "histology": "adenocarcinoma", "current_stage": "IV",
+    "line_of_therapy": "1L", "pd_l1_tps": ">=50%", "biomarkers": "KRAS_G12C", "brain_metastasis": ["false"],
+    "prior_systemic_therapies": ["carboplatin"], "comorbidities": ["ipertensione"],
+    "concomitant_treatments": ["losartan"],
+}
+
+
+class RepairLLM:
+    """LLM finto: restituisce `answer` come testo generato e registra i prompt di riparazione."""
+
+    def __init__(self, answer: dict):
+        self.answer = answer
+        self.calls = []
+
+    def generate_response(self, prompt, **kwargs):
+        self.calls.append({"prompt": prompt, **kwargs})
+        return json.dumps({"response": json.dumps(self.answer)})
+
+
+def test_out_of_schema_values_are_fixed_locally():
+    raw = dict(VALID, age="67 anni", gender="M", current_stage="stadio IVB", pd_l1_tps="60%",
+               ecog_ps="ECOG 1", brain_metastasis="no", prior_systemic_therapies="carboplatino, pemetrexed",
+               comorbidities=[])
+    llm = RepairLLM({})
+    repaired = validate_and_repair(raw, llm=llm, stage="test_local")
+
+    assert repaired == dict(VALID, prior_systemic_therapies=["carboplatin", "pemetrexed"],
+                            comorbidities=["not mentioned"])
+    assert llm.calls == []
+    # The empty list is valid and only filled in: seven fields needed normalizing
+    assert parse_stats()["test_local"]["field_repairs"] == {"normalized": 7}
+
+
+def test_only_unfixable_fields_go_to_the_llm():
+    raw = dict(VALID, histology="carcinoma NAS", biomarkers="EGFR non mutato")
+    llm = RepairLLM({"histology": "squamous", "biomarkers": "not mentioned"})
+    repaired = validate_and_repair(raw, llm=llm, stage="test_llm")
+
+    assert repaired == dict(VALID, histology="squamous", biomarkers="not mentioned")
+    assert len(llm.calls) == 1
+    prompt = llm.calls[0]["prompt"]
+    assert "carcinoma NAS" in prompt and "EGFR non mutato" in prompt
+    assert "losartan" not in prompt  # valid fields are not sent again
+    assert set(llm.calls[0]["format_schema"]["properties"]) == {"histology", "biomarkers"}
+    assert parse_stats()["test_llm"]["field_repairs"] == {"repaired": 2}
+
+
+def test_missing_fields_are_reextracted_alone():
+    raw = {field: value for field, value in VALID.items() if field not in ("age", "ecog_ps")}
+    asked = []
+
+    def reextract(fields):
+        asked.append(fields)
+        return {"age": 67, "ecog_ps": 7}
+
+    repaired = validate_and_repair(raw, reextract=reextract, stage="test_missing")
+    assert asked == [["age", "ecog_ps"]]
+    # The re-extracted ECOG is still out of schema: it falls back instead of breaking the rest
+    assert repaired == dict(VALID, ecog_ps="not mentioned")
+    assert parse_stats()["test_missing"]["field_repairs"] == {"reextracted": 1, "defaulted": 1}
+
+
+def test_failed_repair_keeps_the_valid_fields():
+    class BrokenLLM:
+        def generate_response(self, prompt, **kwargs):
+            return "not json"
+
+    repaired = validate_and_repair(dict(VALID, histology="???"), llm=BrokenLLM(), stage="test_broken")
+    assert repaired == dict(VALID, histology="not mentioned")
+
+
+def test_negated_terms_are_not_normalized():
+    assert normalize_field("biomarkers", "ALK negativo") is None
+    assert normalize_field("histology", "non squamoso") is None
@@ -0,0 +1,41 @@
+from app.core.highlighting import collect_sources, find_source_spans, render_highlights
+
+
+def test_overlapping_sources_become_one_span():
+    text = "Adenocarcinoma polmonare stadio IVB, EGFR Exon 19 deletion."
+    sources = collect_sources({
+        "histology_source_text": "adenocarcinoma polmonare",
+        "current_stage_source_text": "polmonare stadio IVB",
+        "biomarkers_source_text": ["Exon 19", "EGFR Exon 19 deletion"],
+    })
+    spans = find_source_spans(text, sources)
+
+    assert [(span["start"], span["end"]) for span in spans] == [(0, 35), (37, 58)]
+    assert spans[0]["fields"] == ["histology", "current_stage"]
+    assert spans[1]["fields"] == ["biomarkers"]
+    assert render_highlights(text, spans) == \
+        "<mark>Adenocarcinoma polmonare stadio IVB</mark>, <mark>EGFR Exon 19 deletion</mark>."
+
+
+def test_source_starting_inside_a_longer_match_extends_it():
+    # "stadio IVB con" begins inside "polmonare stadio": only a restart inside the match finds it
+    text = "polmonare stadio IVB con metastasi"
+    sources = {"polmonare stadio": ["histology"], "stadio IVB con metastasi": ["current_stage"]}
+    assert find_source_spans(text, sources) == [
+        {"start": 0, "end": len(text), "fields": ["histology", "current_stage"]}
+    ]
+
+
+def test_line_breaks_word_boundaries_and_punctuation():
+    text = "ECOG PS\n1; PD-L1 (TPS 60%), paziente anziano"
+    sources = collect_sources({}, {
+        "ecog_ps": ["ECOG PS 1"], "pd_l1_tps": ["(TPS 60%)"], "age": ["ziano"],
+    })
+    spans = find_source_spans(text, sources)
+    assert [text[span["start"]:span["end"]] for span in spans] == ["ECOG PS\n1", "(TPS 60%)"]
+
+
+def test_no_sources_no_spans():
+    assert find_source_spans("testo", {}) == []
+    assert find_source_spans("", {"testo": ["age"]}) == []
+    assert render_highlights("testo", []) == "testo"
@@ -0,0 +1,111 @@
+import json
+
+from app.core import llm_cache
+from app.core.llm_cache import TieredCache, bypass_llm_cache
+from app.core.llm_processor import cacheable_response
+
+
+class Clock:
+    def __init__(self, now: float = 1_000_000.0):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+
+def test_memory_tier_is_an_lru():
+    cache = TieredCache("test", None, max_memory_entries=2)
+    cache.set("a", "1")
+    cache.set("b", "2")
+    assert cache.get("a") == "1"  # "a" is now the most recent
+    cache.set("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["memory_hits"] == 3
+    assert stats["misses"] == 1
+
+
+def test_disk_tier_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "llm.sqlite")
+    TieredCache("test", path).set("key", "value")
+    other = TieredCache("test", path)  # another worker: empty memory tier
+    assert other.get("key") == "value"
+    assert other.stats()["disk_hits"] == 1
+    assert other.get("key") == "value"
+    assert other.stats()["memory_hits"] == 1
+
+
+def test_entries_expire_after_the_ttl(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(llm_cache.time, "time", clock.time)
+    path = str(tmp_path / "llm.sqlite")
+    cache = TieredCache("test", path, ttl_seconds=60)
+    cache.set("key", "value")
+    clock.now += 30
+    assert cache.get("key") == "value"
+    clock.now += 31
+    assert cache.get("key") is None
+    assert TieredCache("test", path, ttl_seconds=60).get("key") is None
+    assert cache.stats()["evictions"] >= 1
+
+
+def test_disk_tier_keeps_the_most_recently_used_entries(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(llm_cache.time, "time", clock.time)
+    path = str(tmp_path / "llm.sqlite")
+    cache = TieredCache("test", path, max_memory_entries=1, max_disk_entries=2)
+    for key in ("a", "b"):
+        cache.set(key, key)
+        clock.now += 1
+    TieredCache("test", path).get("a")  # read from disk: "a" becomes the most recent
+    clock.now += 1
+    cache.set("c", "c")
+    reader = TieredCache("test", path)
+    assert reader.get("b") is None
+    assert reader.get("a") == "a"
+    assert reader.get("c") == "c"
+
+
+def ollama_body(response: str, done_reason: str = "stop") -> str:
+    return json.dumps({"model": "m", "response": response, "done": True, "done_reason": done_reason})
+
+
+def test_only_complete_readable_answers_are_cacheable():
+    schema = {"type": "object"}
+    assert cacheable_response(ollama_body('{"age": 67}'), schema)
+    # Prose around the JSON (structured output off) is still readable
+    assert cacheable_response(ollama_body('Here it is: {"age": 67} done'), schema)
+    assert not cacheable_response(ollama_body('{"age": 67}', done_reason="length"), schema)
+    assert not cacheable_response(ollama_body('{"age": 6'), schema)
+    assert not cacheable_response("not json", schema)
+    # Free text is fine when no JSON was asked for, unless the caller says otherwise
+    assert cacheable_response(ollama_body("OK"))
+    assert not cacheable_response(ollama_body("OK"), validate=lambda text: text == "KO")
+
+
+def cached_processor(make_processor, tmp_path, **answer):
+    return make_processor(LLM_CACHE_ENABLED=True, LLM_CACHE_DISK_PATH=str(tmp_path / "llm.sqlite"), **answer)
+
+
+def test_truncated_answers_are_not_replayed(make_processor, tmp_path):
+    processor = cached_processor(make_processor, tmp_path, answer='{"age": 6', done_reason="length")
+    session = processor.session
+    schema = {"type": "object"}
+    processor.generate_response("prompt", format_schema=schema, stage="features")
+    processor.generate_response("prompt", format_schema=schema, stage="features")
+    assert len(session.calls) == 2
+    assert processor.cache.stats()["rejected"] == 2
+
+
+def test_cache_hit_and_bypass(make_processor, tmp_path):
+    processor = cached_processor(make_processor, tmp_path, answer='{"age": 67}')
+    session = processor.session
+    first = processor.generate_response("prompt", format_schema={"type": "object"}, stage="features")
+    assert processor.generate_response("prompt", format_schema={"type": "object"}, stage="features") == first
+    assert len(session.calls) == 1
+    with bypass_llm_cache():
+        processor.generate_response("prompt", format_schema={"type": "object"}, stage="features")
+    assert len(session.calls) == 2
@@ -0,0 +1,15 @@
+def test_stage_profiles_set_their_own_timeouts(make_processor):
+    processor = make_processor(LLM_STAGE_PROFILES={
+        "matching": {"read_timeout": 600},
+        "matching_screen": {"model": "llama3.2:3b", "connect_timeout": 1, "read_timeout": 20},
+    })
+
+    processor.generate_response("features prompt", stage="features")
+    processor.generate_response("matching prompt", stage="matching")
+    processor.generate_response("screening prompt", stage="matching_screen")
+
+    session = processor.session
+    assert [call["timeout"] for call in session.calls] == [(3.0, 120.0), (3.0, 600.0), (1.0, 20.0)]
+    assert session.calls[2]["payload"]["model"] == "llama3.2:3b"
+    # Queued calls may wait behind the slowest stage
+    assert processor.scheduler.classes["interactive"].max_wait_seconds >= 600
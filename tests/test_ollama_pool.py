@@ -0,0 +1,92 @@
+import threading
+from collections import Counter
+
+import requests
+
+from app.core.llm_processor import LLMProcessor
+from app.core.ollama_pool import OllamaPool
+
+MODEL = "llama3.1:8b"
+SMALL_MODEL = "llama3.2:3b"
+
+
+def by_url(pool: OllamaPool, url: str):
+    return next(backend for backend in pool.backends if backend.url == url)
+
+
+def test_requests_go_to_the_least_busy_backend(ollama_stubs, monkeypatch):
+    monkeypatch.delenv("OLLAMA_SERVER_URLS", raising=False)
+    urls = [ollama_stubs(delay=0.3) for _ in range(3)]
+    processor = LLMProcessor({
+        "LLM_MODEL": MODEL, "LLM_CONTEXT_SIZE": 4096, "LLM_TEMPERATURE": 0,
+        "LLM_CACHE_ENABLED": False, "LLM_SINGLE_FLIGHT_ENABLED": False,
+        "OLLAMA_SERVERS": urls, "OLLAMA_HEALTH_CHECK_INTERVAL": 0,
+        "LLM_SCHEDULER_MAX_CONCURRENCY": 3, "LLM_MAX_RETRIES": 0,
+    })
+    threads = [threading.Thread(target=processor.generate_response, args=(f"prompt {i}",)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    # Three slow calls at once: each backend takes exactly one
+    assert Counter(backend.requests for backend in processor.pool.backends) == Counter({1: 3})
+    assert all(backend.outstanding == 0 for backend in processor.pool.backends)
+
+
+def test_least_outstanding_then_rotation(ollama_stubs):
+    urls = [ollama_stubs() for _ in range(3)]
+    pool = OllamaPool(urls, requests.Session(), probe_interval=0)
+    held = [pool.acquire(MODEL) for _ in range(3)]
+    assert sorted(backend.url for backend in held) == sorted(urls)
+    pool.release(held[0], True)
+    # The only backend with nothing outstanding gets the next call
+    assert pool.acquire(MODEL) is held[0]
+
+
+def test_backends_with_the_model_loaded_are_preferred(ollama_stubs):
+    large, small = ollama_stubs(model=MODEL), ollama_stubs(model=SMALL_MODEL)
+    pool = OllamaPool([large, small], requests.Session(), probe_interval=0)
+    pool.probe_all()
+    assert by_url(pool, small).loaded_models == {SMALL_MODEL}
+
+    busy = pool.acquire(SMALL_MODEL)
+    assert busy.url == small
+    # Still the warm backend, even with a call outstanding there
+    assert pool.acquire(SMALL_MODEL).url == small
+    assert pool.acquire(MODEL).url == large
+
+
+def test_failed_backend_is_ejected_and_readmitted(ollama_stubs):
+    first, second = ollama_stubs(), ollama_stubs()
+    pool = OllamaPool([first, second], requests.Session(), probe_interval=0, failure_threshold=2)
+    pool.probe_all()
+    port = int(second.rsplit(":", 1)[1])
+    ollama_stubs.stop(second)
+    pool.session.close()  # a crashed server also drops the kept-alive connections
+
+    pool.probe_all()
+    assert by_url(pool, second).healthy  # one failure is below the threshold
+    pool.probe_all()
+    assert not by_url(pool, second).healthy
+    assert by_url(pool, second).ejected_at is not None
+    assert all(pool.acquire(MODEL).url == first for _ in range(4))
+
+    # Back on the same port: the next health check re-admits it
+    ollama_stubs(port=port)
+    pool.probe_all()
+    backend = by_url(pool, second)
+    assert backend.healthy and backend.ejected_at is None and backend.consecutive_failures == 0
+
+
+def test_successful_call_readmits_an_ejected_backend(ollama_stubs):
+    url = ollama_stubs()
+    pool = OllamaPool([url], requests.Session(), probe_interval=0, failure_threshold=1)
+    backend = pool.backends[0]
+    pool.release(pool.acquire(MODEL), False)
+    assert not backend.healthy
+
+    # With no healthy backend the pool still tries this one; a success re-admits it
+    assert pool.acquire(MODEL) is backend
+    pool.release(backend, True, model=MODEL)
+    assert backend.healthy and MODEL in backend.loaded_models
@@ -0,0 +1,67 @@
+from pdf_workers import EXTRACTORS, PageText, fast_text_problem
+from scripts.bench_pdf_extraction import build_pdf
+
+A4 = 595 * 842
+
+LETTER = "\n".join([
+    "Sintesi Clinica: paziente di 67 anni con adenocarcinoma polmonare stadio IVB.",
+    "EGFR Exon 19 deletion. ECOG PS 1. PD-L1 TPS 60%.",
+    "In trattamento con osimertinib 80 mg/die, ben tollerato.",
+    "Non si evidenziano metastasi cerebrali alla RM encefalo.",
+] * 3)
+
+
+def fast_page(text: str, glyphs: int = None, area: float = A4) -> PageText:
+    if glyphs is None:
+        glyphs = sum(1 for c in text if not c.isspace())
+    return PageText(text, 0.01, "pdfminer", glyphs, area=area)
+
+
+def test_clean_page_keeps_the_fast_text():
+    assert fast_text_problem(fast_page(LETTER)) is None
+    # Short final page: a signature line is still enough text for an A4 page
+    assert fast_text_problem(fast_page("Dott.ssa Maria Rossi, UO Oncologia Medica - Firma digitale")) is None
+
+
+def test_scanned_page_is_sparse():
+    assert fast_text_problem(fast_page("", glyphs=0)) == "sparse"
+    # Only the page number is a text layer, the letter itself is an image
+    assert fast_text_problem(fast_page("Pagina 1 di 3")) == "sparse"
+    # Without the page size the check cannot be made
+    assert fast_text_problem(fast_page("", glyphs=0, area=None)) is None
+
+
+def test_unmapped_glyphs_are_garbage():
+    words = LETTER.split(" ")
+    words[5] = "\ufffd" * 14
+    assert fast_text_problem(fast_page(" ".join(words))) == "garbage"
+    cid = LETTER.replace("osimertinib", "(cid:18)(cid:22)(cid:12)(cid:16)(cid:5)(cid:21)(cid:23)")
+    assert fast_text_problem(fast_page(cid)) == "garbage"
+    private = LETTER.replace("adenocarcinoma", "\ue000" * 14)
+    assert fast_text_problem(fast_page(private)) == "garbage"
+
+
+def test_glyphs_missing_from_the_text():
+    drawn = sum(1 for c in LETTER if not c.isspace())
+    assert fast_text_problem(fast_page(LETTER, glyphs=2 * drawn)) == "density"
+
+
+def test_lost_spaces():
+    assert fast_text_problem(fast_page(LETTER.replace(" ", ""))) == "spacing"
+
+
+def test_glyphs_out_of_reading_order():
+    assert fast_text_problem(fast_page("\n".join(LETTER.replace(" ", "")))) == "order"
+
+
+def test_auto_extractor_rereads_only_broken_pages():
+    clean = EXTRACTORS["auto"].extract(build_pdf(2), 0, 2)
+    assert [page.extractor for page in clean] == ["pdfminer", "pdfminer"]
+    assert all(page.fallback is None for page in clean)
+
+    unmapped = EXTRACTORS["auto"].extract(build_pdf(2, unmapped=True), 0, 2)
+    assert [page.extractor for page in unmapped] == ["pdfplumber", "pdfplumber"]
+    assert [page.fallback for page in unmapped] == ["garbage", "garbage"]
+
+    blank = EXTRACTORS["auto"].extract(build_pdf(1, lines_per_page=0), 0, 1)
+    assert [(page.extractor, page.fallback, page.text) for page in blank] == [("pdfplumber", "sparse", "")]
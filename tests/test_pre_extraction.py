@@ -0,0 +1,58 @@
+from app.core.pre_extraction import NOT_MENTIONED, merge_features, pre_extract
+
+
+def features(text: str) -> dict:
+    return pre_extract(text)["features"]
+
+
+def test_clean_report_is_resolved_locally():
+    resolved = features("Uomo di 67 anni. Adenocarcinoma polmonare stadio IV. EGFR L858R. "
+                        "ECOG PS 1. PD-L1 TPS 60%.")
+    assert resolved["age"] == 67
+    assert resolved["gender"] == "male"
+    assert resolved["current_stage"] == "IV"
+    assert resolved["biomarkers"] == "EGFR_L858R"
+    assert resolved["ecog_ps"] == 1
+    assert resolved["pd_l1_tps"] == ">=50%"
+
+
+def test_pd_l1_does_not_take_a_percentage_from_the_next_item():
+    resolved = features("Paziente di 67 anni. PD-L1 negativo, KRAS G12C 34%.")
+    assert "pd_l1_tps" not in resolved
+    # The value pattern no longer swallows the variant after it
+    assert resolved["biomarkers"] == "KRAS_G12C"
+
+    resolved = features("PD-L1 non espresso, Ki67 30%")
+    assert "pd_l1_tps" not in resolved
+
+    resolved = features("PD-L1 22C3 e KRAS G12C 34%")
+    assert "pd_l1_tps" not in resolved
+    assert resolved["biomarkers"] == "KRAS_G12C"
+
+
+def test_negated_or_uncertain_values_go_to_the_llm():
+    assert "pd_l1_tps" not in features("PD-L1 non espresso (TPS 1%).")
+    assert "pd_l1_tps" not in features("PD-L1 TPS 5% non valutabile.")
+    assert "ecog_ps" not in features("ECOG 2 da rivalutare.")
+
+
+def test_ecog_range_is_not_a_single_value():
+    assert "ecog_ps" not in features("ECOG 0-1.")
+    assert "ecog_ps" not in features("ECOG PS 1/2.")
+
+
+def test_decimal_pd_l1():
+    assert features("PD-L1 TPS 1,5%.")["pd_l1_tps"] == "1-49%"
+
+
+def test_biomarker_list_items_are_read_separately():
+    assert features("ALK non riarrangiato, EGFR L858R.")["biomarkers"] == "EGFR_L858R"
+    assert features("EGFR L858R, ALK negativo.")["biomarkers"] == "EGFR_L858R"
+    assert "biomarkers" not in features("In attesa di esito EGFR L858R.")
+
+
+def test_unresolved_fields_are_left_to_the_llm():
+    merged = merge_features({"pd_l1_tps": "0%", "age": 50}, features("Paziente di 67 anni. PD-L1 negativo."))
+    assert merged["age"] == 67
+    assert merged["pd_l1_tps"] == "0%"
+    assert merged["comorbidities"] == NOT_MENTIONED
@@ -0,0 +1,81 @@
+import threading
+import time
+
+import pytest
+
+from app.core.scheduler import BATCH, INTERACTIVE, STANDARD, BusyError, LLMScheduler
+
+
+def waiter(scheduler: LLMScheduler, priority: str, order: list):
+    def run():
+        with scheduler.slot(priority):
+            order.append(priority)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def wait_until_queued(scheduler: LLMScheduler, priority: str, count: int = 1):
+    deadline = time.monotonic() + 5
+    while len(scheduler.classes[priority].waiting) < count:
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_default_waits_cover_the_read_timeout():
+    scheduler = LLMScheduler(1, {STANDARD: {"max_wait_seconds": 10}}, min_wait_seconds=300)
+    assert scheduler.classes[INTERACTIVE].max_wait_seconds == 300
+    assert scheduler.classes[BATCH].max_wait_seconds == 900
+    # Explicit overrides are kept
+    assert scheduler.classes[STANDARD].max_wait_seconds == 10
+
+
+def test_queued_call_runs_when_the_slot_frees():
+    scheduler = LLMScheduler(1, {}, min_wait_seconds=300)
+    order = []
+    with scheduler.slot(INTERACTIVE):
+        thread = waiter(scheduler, INTERACTIVE, order)
+        wait_until_queued(scheduler, INTERACTIVE)
+    thread.join(5)
+    assert order == [INTERACTIVE]
+    assert scheduler.stats()["classes"][INTERACTIVE]["admitted"] == 2
+
+
+def test_wait_past_the_class_limit_is_busy():
+    scheduler = LLMScheduler(1, {INTERACTIVE: {"max_wait_seconds": 0.05}})
+    with scheduler.slot(BATCH):
+        with pytest.raises(BusyError) as error:
+            scheduler.acquire(INTERACTIVE)
+    assert error.value.priority == INTERACTIVE
+    assert error.value.retry_after >= 1
+    stats = scheduler.stats()
+    assert stats["classes"][INTERACTIVE]["timed_out"] == 1
+    assert stats["classes"][INTERACTIVE]["queued"] == 0
+    assert stats["running"] == 0
+
+
+def test_full_queue_is_rejected_at_once():
+    scheduler = LLMScheduler(1, {BATCH: {"max_queue": 1}}, min_wait_seconds=300)
+    order = []
+    with scheduler.slot(INTERACTIVE):
+        thread = waiter(scheduler, BATCH, order)
+        wait_until_queued(scheduler, BATCH)
+        started = time.monotonic()
+        with pytest.raises(BusyError):
+            scheduler.acquire(BATCH)
+        assert time.monotonic() - started < 1
+    thread.join(5)
+    assert scheduler.stats()["classes"][BATCH]["rejected"] == 1
+
+
+def test_interactive_goes_before_queued_batch_work():
+    scheduler = LLMScheduler(1, {}, min_wait_seconds=300)
+    order = []
+    with scheduler.slot(STANDARD):
+        threads = [waiter(scheduler, BATCH, order)]
+        wait_until_queued(scheduler, BATCH)
+        threads.append(waiter(scheduler, INTERACTIVE, order))
+        wait_until_queued(scheduler, INTERACTIVE)
+    for thread in threads:
+        thread.join(5)
+    assert order == [INTERACTIVE, BATCH]
@@ -0,0 +1,83 @@
+from datetime import date
+
+from app.core.sections import FIELD_GROUPS, plan_chunks, reduce_features
+from app.core.token_budget import estimate_tokens
+
+RECORD = """Paziente di 67 anni, sesso maschile.
+
+Anamnesi
+Ex fumatore. Adenocarcinoma polmonare diagnosticato nel 2022.
+{history}
+
+Comorbidità
+Ipertensione arteriosa, diabete mellito tipo 2.
+
+Terapie domiciliari
+Losaprex 50 mg, Omeprazolo 20 mg.
+
+Trattamenti precedenti
+Carboplatino + pemetrexed per 4 cicli (2022), poi osimertinib.
+
+TC del 10/01/2023
+Metastasi cerebrali multiple.
+
+RM del 15/06/2024
+Non si evidenziano metastasi cerebrali dopo radioterapia.
+"""
+
+
+def make_record(history_sentences: int = 0) -> str:
+    history = " ".join(f"Controllo {i}: condizioni stabili, prosegue terapia." for i in range(history_sentences))
+    return RECORD.format(history=history)
+
+
+def test_chunks_stay_within_budget():
+    # One history paragraph far larger than the budget forces the split between words
+    text = make_record(history_sentences=400)
+    budget = 120
+    chunks = plan_chunks(text, budget)
+    assert chunks
+    for chunk in chunks:
+        assert estimate_tokens(chunk["text"]) <= budget
+
+
+def test_each_group_reads_only_its_sections():
+    chunks = plan_chunks(make_record(), budget=4000)
+    groups = {chunk["group"]: chunk for chunk in chunks}
+    assert set(groups) == set(FIELD_GROUPS)
+    assert "Losaprex" in groups["home_therapy"]["text"]
+    assert "Losaprex" not in groups["metastasis"]["text"]
+    assert "Metastasi cerebrali" in groups["metastasis"]["text"]
+    assert "Metastasi cerebrali" not in groups["home_therapy"]["text"]
+    for chunk in chunks:
+        assert chunk["fields"] == FIELD_GROUPS[chunk["group"]]["fields"]
+
+
+def partial(group: str, start: int, features: dict, chunk_date: date = None) -> dict:
+    chunk = {"group": group, "fields": FIELD_GROUPS[group]["fields"], "start": start, "date": chunk_date}
+    return {"chunk": chunk, "features": features}
+
+
+def test_reduce_reads_each_field_only_from_its_group():
+    partials = [
+        partial("clinical", 0, {"age": 67, "ecog_ps": 1, "brain_metastasis": ["true"],
+                                "concomitant_treatments": ["aspirin"]}),
+        partial("metastasis", 300, {"brain_metastasis": ["true"], "age": 99}, date(2023, 1, 10)),
+        partial("metastasis", 400, {"brain_metastasis": ["false"]}, date(2024, 6, 15)),
+        partial("home_therapy", 200, {"concomitant_treatments": ["losartan", "omeprazole"], "ecog_ps": 3}),
+        partial("therapies", 250, {"prior_systemic_therapies": ["carboplatin", "pemetrexed"]}),
+        partial("therapies", 260, {"prior_systemic_therapies": ["Pemetrexed", "osimertinib"]}),
+    ]
+    merged = reduce_features(partials)
+
+    # Values from chunks of other groups are ignored, even when present
+    assert merged["age"] == 67
+    assert merged["ecog_ps"] == 1
+    assert merged["concomitant_treatments"] == ["losartan", "omeprazole"]
+    # Brain metastases: the most recent imaging chunk wins
+    assert merged["brain_metastasis"] == ["false"]
+    # Lists: union in document order, case-insensitive duplicates dropped
+    assert merged["prior_systemic_therapies"] == ["carboplatin", "pemetrexed", "osimertinib"]
+    # Groups without any chunk are "not mentioned"
+    assert merged["comorbidities"] == ["not mentioned"]
+    assert merged["histology"] == "not mentioned"
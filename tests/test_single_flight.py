@@ -0,0 +1,113 @@
+import os
+import threading
+import time
+
+import pytest
+
+from app.core.single_flight import SingleFlight
+
+KEY = "a" * 64
+
+
+def run_in_threads(count: int, target):
+    results = [None] * count
+
+    def run(index):
+        try:
+            results[index] = target()
+        except Exception as e:
+            results[index] = e
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_identical_calls_in_one_process_run_once():
+    flight = SingleFlight()
+    release, calls = threading.Event(), []
+
+    def generate():
+        calls.append(1)
+        release.wait(5)
+        return "answer"
+
+    threads, results = run_in_threads(5, lambda: flight.do(KEY, generate))
+    wait_for(lambda: flight.stats()["coalesced_local"] == 4)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert sorted(results) == [("answer", False)] + [("answer", True)] * 4
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_leader_error_reaches_the_waiters():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def generate():
+        release.wait(5)
+        raise RuntimeError("ollama down")
+
+    threads, results = run_in_threads(3, lambda: flight.do(KEY, generate))
+    wait_for(lambda: flight.stats()["coalesced_local"] == 2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert all(isinstance(result, RuntimeError) for result in results)
+    # The failed key is not stuck: the next call runs again
+    assert flight.do(KEY, lambda: "retry") == ("retry", False)
+
+
+def test_other_worker_reuses_the_result_it_waited_for(tmp_path):
+    # Two instances on one directory behave like two gunicorn workers (separate flocks)
+    worker_a, worker_b = SingleFlight(str(tmp_path)), SingleFlight(str(tmp_path))
+    release, calls = threading.Event(), []
+
+    def generate():
+        calls.append(1)
+        release.wait(5)
+        return "answer"
+
+    threads_a, results_a = run_in_threads(1, lambda: worker_a.do(KEY, generate))
+    wait_for(lambda: worker_a.stats()["leaders"] == 1)
+    threads_b, results_b = run_in_threads(1, lambda: worker_b.do(KEY, generate))
+    time.sleep(0.05)  # worker B is now polling the lock
+    release.set()
+    for thread in threads_a + threads_b:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert results_a == [("answer", False)]
+    assert results_b == [("answer", True)]
+    assert worker_b.stats()["coalesced_remote"] == 1
+
+
+def test_leftover_result_is_not_served_to_a_later_call(tmp_path):
+    worker_a, worker_b = SingleFlight(str(tmp_path)), SingleFlight(str(tmp_path))
+    assert worker_a.do(KEY, lambda: "old") == ("old", False)
+    assert worker_b.do(KEY, lambda: "new") == ("new", False)
+
+
+def test_encrypted_results_hide_key_and_content(tmp_path):
+    storage_crypto = pytest.importorskip("app.core.storage_crypto")
+    if storage_crypto.Fernet is None:
+        pytest.skip("cryptography is not installed")
+    cipher = storage_crypto.StorageCipher(storage_crypto.Fernet.generate_key())
+    flight = SingleFlight(str(tmp_path), cipher=cipher)
+    flight.do(KEY, lambda: "patient answer")
+
+    names = os.listdir(tmp_path)
+    assert names and not any(KEY in name for name in names)
+    for name in names:
+        with open(tmp_path / name, "rb") as f:
+            assert b"patient answer" not in f.read()
@@ -0,0 +1,64 @@
+import pytest
+
+from app.core import warmup
+from app.core.llm_processor import LLMProcessor
+
+MODEL = "llama3.1:8b"
+
+
+@pytest.fixture
+def fresh_state(monkeypatch):
+    state = {"state": "cold", "started_at": None, "finished_at": None, "backends": {}, "error": None}
+    monkeypatch.setattr(warmup, "_state", state)
+    return state
+
+
+def use_processor(monkeypatch, processor):
+    monkeypatch.setattr(warmup, "get_llm_processor", lambda: processor)
+    warmups = []
+    monkeypatch.setattr(warmup, "start_model_warmup", lambda: warmups.append(1))
+    return warmups
+
+
+def no_probe(*args, **kwargs):
+    pytest.fail("readiness() must not call Ollama")
+
+
+def test_readiness_reads_the_cached_pool_state(make_processor, monkeypatch, fresh_state):
+    processor = make_processor()
+    monkeypatch.setattr(processor.session, "get", no_probe, raising=False)
+    warmups = use_processor(monkeypatch, processor)
+    backend = processor.pool.backends[0]
+
+    # Nothing loaded yet: not ready, and a warm-up is started once
+    status = warmup.readiness()
+    assert not status["ready"] and status["state"] == "warming" and warmups == [1]
+
+    # The health checker saw the model resident after the warm-up finished
+    fresh_state.update(state="ready", backends={backend.url: {"warm_latency_seconds": 0.05}})
+    backend.loaded_models = {MODEL}
+    backend.last_probe = 1234.0
+    status = warmup.readiness()
+    assert status["ready"] and status["resident_on"] == [backend.url]
+    assert status["warm_latency_seconds"] == 0.05 and status["checked_at"] == 1234.0
+    assert warmups == [1]
+
+    # Ejected by the health checker: no longer ready, without asking Ollama again
+    backend.healthy = False
+    assert not warmup.readiness()["ready"]
+
+
+def test_warm_up_makes_the_worker_ready(ollama_stubs, monkeypatch, fresh_state):
+    monkeypatch.delenv("OLLAMA_SERVER_URLS", raising=False)
+    processor = LLMProcessor({
+        "LLM_MODEL": MODEL, "LLM_CONTEXT_SIZE": 4096, "LLM_CACHE_ENABLED": False,
+        "LLM_SINGLE_FLIGHT_ENABLED": False, "OLLAMA_SERVERS": [ollama_stubs(model=MODEL)],
+        "OLLAMA_HEALTH_CHECK_INTERVAL": 0,
+    })
+    use_processor(monkeypatch, processor)
+    warmup.warm_up_model()
+    monkeypatch.setattr(processor.session, "get", no_probe)
+
+    status = warmup.readiness()
+    assert status["ready"] and status["state"] == "ready"
+    assert status["warm_latency_seconds"] is not None